@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark for ARTIM timers on many associations.
+
+Starts and stops the ARTIM timer of many DICOMUpperLayerServiceProvider
+instances, as happens on association state changes, with the timers
+scheduled directly on the reactor and on a shared timerwheel.TimerWheel.
+Prints the time taken and the size of the reactor's timer heap.
+"""
+
+import os
+import sys
+import time
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from twisted.internet import reactor
+from twisteddicom import upper_layer, timerwheel
+
+def heap_size():
+    # Entries in the reactor's timer heap, including cancelled calls that
+    # have not been pruned yet.
+    return len(reactor._pendingTimedCalls) + len(reactor._newTimedCalls)
+
+def run(connections, rounds, use_wheel):
+    wheel = timerwheel.TimerWheel(reactor = reactor)
+    protocols = [upper_layer.DICOMUpperLayerServiceProvider() for i in xrange(connections)]
+    for protocol in protocols:
+        protocol.timer_wheel = wheel if use_wheel else reactor
+    max_heap_size = 0
+    start = time.time()
+    for i in xrange(rounds):
+        for protocol in protocols:
+            protocol.start_ARTIM()
+        reactor.runUntilCurrent()
+        max_heap_size = max(max_heap_size, heap_size())
+        for protocol in protocols:
+            protocol.stop_ARTIM()
+        reactor.runUntilCurrent()
+        max_heap_size = max(max_heap_size, heap_size())
+    elapsed = time.time() - start
+    return elapsed, max_heap_size
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--connections", type = "int", default = 10000,
+                      help = "number of associations [%default]")
+    parser.add_option("--rounds", type = "int", default = 10,
+                      help = "start/stop rounds per association [%default]")
+    options, args = parser.parse_args()
+
+    for name, use_wheel in (("reactor.callLater", False), ("TimerWheel", True)):
+        elapsed, max_heap_size = run(options.connections, options.rounds, use_wheel)
+        print "%-18s %6i connections: %7.3f s, %6.2f us/timer operation, at most %6i reactor timer heap entries" % (
+            name, options.connections, elapsed, 1e6 * elapsed / (2 * options.rounds * options.connections), max_heap_size)
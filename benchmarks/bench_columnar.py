@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Benchmark for C-FIND matching with the columnar engine.
+
+Fills a columnar.ColumnStore with synthetic study data sets and times
+study level queries with range, single value, wildcard and list of UID
+keys, compared with matching every data set with a compiled query.
+Needs numpy.
+"""
+
+import os
+import sys
+import time
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dicom
+from twisteddicom import columnar, utils
+
+def make_dataset(i):
+    ds = dicom.dataset.Dataset()
+    ds.PatientID = "P%07i" % (i // 3,)
+    ds.PatientName = "Doe^John%i" % (i % 1000,)
+    ds.StudyInstanceUID = "1.2.3.%i" % (i,)
+    ds.StudyDate = "20%02i%02i%02i" % (i % 13, i % 12 + 1, i % 28 + 1)
+    ds.AccessionNumber = "A%07i" % (i,)
+    ds.Modality = ["CT", "MR", "US", "CR"][i % 4]
+    return ds
+
+def make_query(**kw):
+    query = dicom.dataset.Dataset()
+    query.QueryRetrieveLevel = "STUDY"
+    query.StudyInstanceUID = ""
+    query.PatientID = ""
+    for keyword, value in kw.iteritems():
+        setattr(query, keyword, value)
+    return query
+
+queries = [
+    ("date range", dict(StudyDate = "20120301-20120315", Modality = "US")),
+    ("patient id", dict(PatientID = "P0012345")),
+    ("name prefix", dict(PatientName = "Doe^John12*", StudyDate = "20100101-")),
+    ("wildcard", dict(AccessionNumber = "*99?9")),
+    ("uid list", dict(StudyInstanceUID = "1.2.3.10\\1.2.3.20\\1.2.3.30")),
+    ]
+
+def timed(func, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        result = func()
+    return (time.time() - start) / rounds, result
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-n", type = "int", default = 200000,
+                      help = "data sets [%default]")
+    parser.add_option("--rounds", type = "int", default = 20,
+                      help = "runs of each query [%default]")
+    parser.add_option("--scan", type = "int", default = 20000,
+                      help = "data sets matched one at a time for comparison [%default]")
+    options, args = parser.parse_args()
+
+    store = columnar.ColumnStore(keywords = ["PatientID", "PatientName", "StudyInstanceUID", "StudyDate", "AccessionNumber", "Modality"])
+    start = time.time()
+    for i in xrange(options.n):
+        store.add(make_dataset(i))
+    store.columns()
+    print "%i data sets, columns built in %.1f s" % (options.n, time.time() - start)
+
+    for name, kw in queries:
+        query = make_query(**kw)
+        select, (hits, exact) = timed(lambda: store.select(query), options.rounds)
+        find, results = timed(lambda: list(store.find(query)), options.rounds)
+        matcher = utils.compile_query(query)
+        scan, ignored = timed(lambda: [matcher.match(ds) for ds in store.datasets[:options.scan]], 1)
+        print "%-12s %6i matches, select %8.3f ms, find %8.3f ms, compiled query scan %8.0f ms (extrapolated)" % (
+            name, len(results), select * 1e3, find * 1e3, scan * options.n / options.scan * 1e3)
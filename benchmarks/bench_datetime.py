@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Benchmark for parsing DICOM dates and times.
+
+Parses DA, TM and DT values with utils.parse_da_dt_tm and with
+utils.date_time_ordinal, and matches them against a range parsed on every
+comparison and against a utils.DateRange, printing values per second.
+"""
+
+import os
+import sys
+import time
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dicom
+from twisteddicom import utils
+
+values = {
+    "DA": ["2012%02i%02i" % (i % 12 + 1, i % 28 + 1) for i in range(1000)],
+    "TM": ["%02i%02i%02i.%06i" % (i % 24, i % 60, i % 60, i) for i in range(1000)],
+    "DT": ["2012%02i%02i%02i%02i%02i.%06i+0100" % (i % 12 + 1, i % 28 + 1, i % 24, i % 60, i % 60, i) for i in range(1000)],
+    }
+
+ranges = {
+    "DA": ("20120301", "20120615"),
+    "TM": ("080000", "170000"),
+    "DT": ("20120301000000.000000+0100", "20120615000000.000000+0100"),
+    }
+
+def rate(func, values, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        for value in values:
+            func(value)
+    return len(values) * rounds / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--rounds", type = "int", default = 50,
+                      help = "parses of each value [%default]")
+    options, args = parser.parse_args()
+
+    for vr in ("DA", "TM", "DT"):
+        minvalue, maxvalue = ranges[vr]
+        def parse_range(value):
+            return (utils.parse_da_dt_tm(minvalue, vr) <= utils.parse_da_dt_tm(value, vr) <=
+                    utils.parse_da_dt_tm(maxvalue, vr))
+        date_range = utils.DateRange("%s-%s" % (minvalue, maxvalue), vr)
+        slow = rate(lambda value: utils.parse_da_dt_tm(value, vr), values[vr], options.rounds)
+        fast = rate(lambda value: utils.date_time_ordinal(value, vr), values[vr], options.rounds)
+        print "%s parse  parse_da_dt_tm: %9.0f/s, date_time_ordinal: %9.0f/s, %5.1fx" % (vr, slow, fast, fast / slow)
+        slow = rate(parse_range, values[vr], options.rounds)
+        fast = rate(date_range.__contains__, values[vr], options.rounds)
+        print "%s range  parsed per value: %9.0f/s, DateRange:         %9.0f/s, %5.1fx" % (vr, slow, fast, fast / slow)
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark for the DIMSE command set codec.
+
+Packs and unpacks C-STORE-RQ and C-STORE-RSP messages with
+dimsemessages.pack_command_set/unpack_command_set and, for comparison,
+through pydicom, and prints messages per second for each.
+"""
+
+import os
+import sys
+import time
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dicom
+from twisteddicom import dimsemessages
+
+def to_dataset(command_set):
+    ds = dicom.dataset.Dataset()
+    for tag, value in command_set.iteritems():
+        ds.add_new(tag, dimsemessages.DimseDicomDictionary[tag][0], value)
+    return ds
+
+def pydicom_pack(msg):
+    ds = to_dataset(dimsemessages.unpack_command_set(msg.pack()))
+    del ds[0x00000000] # Command Group Length
+    return lambda: dimsemessages.pack_dataset_with_commandgrouplength(ds)
+
+def pydicom_unpack(msg):
+    s = msg.pack()
+    return lambda: msg.__class__().unpack(dimsemessages.unpack_dataset(s))
+
+def fast_pack(msg):
+    return msg.pack
+
+def fast_unpack(msg):
+    s = msg.pack()
+    return lambda: msg.__class__().unpack(dimsemessages.unpack_command_set(s))
+
+def rate(func, n):
+    start = time.time()
+    for i in xrange(n):
+        func()
+    return n / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-n", type = "int", default = 20000,
+                      help = "messages per measurement [%default]")
+    options, args = parser.parse_args()
+
+    messages = [dimsemessages.C_STORE_RQ(message_id = 1, affected_sop_class_uid = "1.2.840.10008.5.1.4.1.1.2",
+                                         affected_sop_instance_uid = "1.2.826.0.1.3680043.2.1125.1.12345678901234567890"),
+                dimsemessages.C_STORE_RSP(message_id_being_responded_to = 1, affected_sop_class_uid = "1.2.840.10008.5.1.4.1.1.2",
+                                          affected_sop_instance_uid = "1.2.826.0.1.3680043.2.1125.1.12345678901234567890")]
+    for msg in messages:
+        name = msg.__class__.__name__
+        for operation, pydicom_func, fast_func in (("pack", pydicom_pack, fast_pack), 
+                                                   ("unpack", pydicom_unpack, fast_unpack)):
+            slow = rate(pydicom_func(msg), options.n)
+            fast = rate(fast_func(msg), options.n)
+            print "%-12s %-6s pydicom: %9.0f msg/s, struct: %9.0f msg/s, %5.1fx" % (
+                name, operation, slow, fast, fast / slow)
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark for DIMSE message and PDU dispatch.
+
+Dispatches each DIMSE message class through
+DIMSEProtocol.DIMSE_command_received and each PDU class through
+DICOMUpperLayerServiceProtocol.pdu_received, and prints the time per
+dispatch, both to the *_received methods (the default) and to handlers
+set with register_DIMSE_handler/register_PDU_handler. Neither depends on
+the class.
+"""
+
+import os
+import sys
+import time
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from twisteddicom import dimse, dimsemessages, sockhandler, pdu
+
+def noop(*args):
+    pass
+
+# Subclasses with no-op *_received methods, dispatched to by name
+DIMSEReceiver = type("DIMSEReceiver", (dimse.DIMSEProtocol,), 
+                     dict((name, noop) for name in dimse.DIMSE_handler_names.itervalues()))
+PDUReceiver = type("PDUReceiver", (sockhandler.DICOMUpperLayerServiceProtocol,), 
+                   dict((name, noop) for name in sockhandler.PDU_handler_names.itervalues()))
+
+def per_call(func, arg, n):
+    start = time.time()
+    for i in xrange(n):
+        func(arg)
+    return 1e9 * (time.time() - start) / n
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-n", type = "int", default = 200000,
+                      help = "dispatches per class [%default]")
+    options, args = parser.parse_args()
+
+    protocol = DIMSEReceiver()
+    registered = DIMSEReceiver()
+    for dimse_class in dimsemessages.commands:
+        registered.register_DIMSE_handler(dimse_class, noop)
+    print "%-20s %10s %10s" % ("", "method", "registered")
+    for dimse_class in sorted(dimsemessages.commands, key = dimsemessages.commands.get):
+        cmd = dimse_class()
+        print "%-20s %7.0f ns %7.0f ns" % (dimse_class.__name__, 
+                                           per_call(lambda cmd: protocol.DIMSE_command_received(1, cmd, None), cmd, options.n),
+                                           per_call(lambda cmd: registered.DIMSE_command_received(1, cmd, None), cmd, options.n))
+
+    receiver = PDUReceiver()
+    registered = PDUReceiver()
+    for pdu_class in sockhandler.PDU_handler_names:
+        registered.register_PDU_handler(pdu_class, noop)
+    for pdu_class in sockhandler.PDU_handler_names:
+        print "%-20s %7.0f ns %7.0f ns" % (pdu_class.__name__, 
+                                           per_call(receiver.pdu_received, pdu_class(), options.n),
+                                           per_call(registered.pdu_received, pdu_class(), options.n))
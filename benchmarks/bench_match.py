@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Benchmark for matching C-FIND identifiers against data sets.
+
+Matches a study level query with wildcard, range and universal keys
+against a list of data sets, once with utils.match_dataset for every data
+set and once with a query compiled by utils.compile_query, and prints data
+sets per second for each.
+"""
+
+import os
+import sys
+import time
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dicom
+from twisteddicom import utils
+
+def make_dataset(i):
+    ds = dicom.dataset.Dataset()
+    ds.PatientID = "P%06i" % (i,)
+    ds.PatientName = "Doe^John%i" % (i % 100,)
+    ds.StudyInstanceUID = "1.2.3.%i" % (i,)
+    ds.StudyDate = "2012%02i%02i" % (i % 12 + 1, i % 28 + 1)
+    ds.StudyTime = "1200%02i" % (i % 60,)
+    ds.AccessionNumber = "A%i" % (i,)
+    ds.ModalitiesInStudy = ["CT", "MR"][i % 2]
+    return ds
+
+def make_query():
+    query = dicom.dataset.Dataset()
+    query.QueryRetrieveLevel = "STUDY"
+    query.PatientName = "Doe^John1*"
+    query.PatientID = ""
+    query.StudyInstanceUID = ""
+    query.StudyDate = "20120301-20120630"
+    query.StudyTime = ""
+    query.AccessionNumber = "*"
+    query.ModalitiesInStudy = "CT"
+    return query
+
+def rate(func, datasets):
+    start = time.time()
+    n = 0
+    for ds in datasets:
+        if func(ds)[0]:
+            n += 1
+    return len(datasets) / (time.time() - start), n
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-n", type = "int", default = 50000,
+                      help = "data sets to match [%default]")
+    options, args = parser.parse_args()
+
+    datasets = [make_dataset(i) for i in xrange(options.n)]
+    query = make_query()
+    slow, slow_matches = rate(lambda ds: utils.match_dataset(query, ds), datasets)
+    fast, fast_matches = rate(utils.compile_query(query).match, datasets)
+    assert slow_matches == fast_matches
+    print "%i data sets, %i matches" % (options.n, fast_matches)
+    print "match_dataset: %9.0f data sets/s" % (slow,)
+    print "compile_query: %9.0f data sets/s, %5.1fx" % (fast, fast / slow)
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark for sockhandler.PDUFramer.
+
+Feeds P-DATA-TF PDUs of increasing size to DICOMUpperLayerServiceProtocol
+in small reads and prints the throughput for each size. With linear
+framing the time per MB stays flat as the PDU grows.
+"""
+
+import os
+import sys
+import time
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from twisteddicom import sockhandler, pdu
+
+class Receiver(sockhandler.DICOMUpperLayerServiceProtocol):
+    def __init__(self):
+        super(Receiver, self).__init__()
+        self.n_received = 0
+    def pdu_received(self, data):
+        self.n_received += 1
+
+def make_pdu(size):
+    return pdu.P_DATA_TF([(1, '\x02' + 'x' * size)]).pack()
+
+def feed(data, chunk_size):
+    receiver = Receiver()
+    start = time.time()
+    for i in xrange(0, len(data), chunk_size):
+        receiver.dataReceived(data[i:i + chunk_size])
+    elapsed = time.time() - start
+    assert receiver.n_received == 1
+    return elapsed
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--chunk-size", type = "int", default = 64 * 1024,
+                      help = "bytes per simulated TCP read [%default]")
+    parser.add_option("--max-size", type = "int", default = 100,
+                      help = "largest PDU in MB [%default]")
+    options, args = parser.parse_args()
+
+    for fraction in (8, 4, 2, 1):
+        size = options.max_size / float(fraction)
+        data = make_pdu(int(size * 1024 * 1024))
+        elapsed = feed(data, options.chunk_size)
+        print "%6.1f MB PDU in %6i byte reads: %7.3f s, %8.1f MB/s, %6.2f ms/MB" % (
+            size, options.chunk_size, elapsed, size / elapsed, 1000 * elapsed / size)
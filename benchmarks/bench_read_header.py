@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Benchmark for header-only reads of DICOM files.
+
+Writes a folder of single frame CT images and multi-frame objects and
+reads every file the way the query SCPs match them, with a full
+dicom.read_file and with utils.read_header, printing files per second and
+the number of bytes parsed for each.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dicom
+from twisteddicom import utils
+
+def write_object(fn, i, frames):
+    ds = dicom.dataset.Dataset()
+    ds.PatientID = "P%i" % (i % 10,)
+    ds.PatientName = "Doe^John"
+    ds.StudyInstanceUID = "1.2.3.%i" % (i % 10,)
+    ds.SeriesInstanceUID = "1.2.3.%i.1" % (i % 10,)
+    ds.SOPClassUID = utils.get_uid("CT Image Storage")
+    ds.SOPInstanceUID = "1.2.3.%i.1.%i" % (i % 10, i)
+    ds.Modality = "CT"
+    ds.Rows = 512
+    ds.Columns = 512
+    ds.BitsAllocated = 16
+    ds.NumberOfFrames = str(frames)
+    ds.PixelData = "\0" * (512 * 512 * 2 * frames)
+    file_meta = dicom.dataset.Dataset()
+    file_meta.TransferSyntaxUID = dicom.UID.ImplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    file_meta.ImplementationClassUID = utils.implementation_class_uid
+    fds = dicom.dataset.FileDataset(fn, ds, file_meta = file_meta, preamble = "\0" * 128)
+    fds.is_little_endian = True
+    fds.is_implicit_VR = True
+    fds.save_as(fn)
+
+def header_size(fn):
+    f = open(fn, "rb")
+    dicom.read_file(f, stop_before_pixels = True)
+    size = f.tell()
+    f.close()
+    return size
+
+def measure(read, files, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        for fn in files:
+            read(fn)
+    return len(files) * rounds / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--images", type = "int", default = 100,
+                      help = "single frame 512x512 CT images [%default]")
+    parser.add_option("--multiframe", type = "int", default = 4,
+                      help = "multi-frame objects [%default]")
+    parser.add_option("--frames", type = "int", default = 100,
+                      help = "frames per multi-frame object [%default]")
+    parser.add_option("--rounds", type = "int", default = 3,
+                      help = "reads of the folder per measurement [%default]")
+    options, args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(options.images + options.multiframe):
+            fn = os.path.join(folder, "%i.dcm" % (i,))
+            write_object(fn, i, 1 if i < options.images else options.frames)
+            files.append(fn)
+        full_bytes = sum(os.path.getsize(fn) for fn in files)
+        header_bytes = sum(header_size(fn) for fn in files)
+        full = measure(dicom.read_file, files, options.rounds)
+        header = measure(utils.read_header, files, options.rounds)
+        print "%i files, %.1f MB" % (len(files), full_bytes / 1e6)
+        print "dicom.read_file:   %8.1f files/s, %12i bytes parsed" % (full, full_bytes)
+        print "utils.read_header: %8.1f files/s, %12i bytes parsed, %5.1fx" % (header, header_bytes, header / full)
+    finally:
+        shutil.rmtree(folder)
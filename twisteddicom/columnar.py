@@ -0,0 +1,215 @@
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import bisect
+import dicom
+from utils import compile_query, compile_attribute, date_time_ordinal, DateRange, get_level_identifier
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _find(categories, value):
+    """Index of value in the sorted list categories, or None."""
+    i = bisect.bisect_left(categories, value)
+    if i < len(categories) and categories[i] == value:
+        return i
+    return None
+
+def _prefix_end(prefix):
+    """The smallest string greater than every string starting with prefix,
+    or None."""
+    prefix = prefix.rstrip("\xff")
+    if prefix == "":
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class ColumnStore(object):
+    """
+    The query attributes of many data sets, kept as NumPy columns for
+    matching C-FIND identifiers a whole column at a time.
+
+    Dates and times are stored as the integer ordinals of
+    utils.date_time_ordinal(), so range matching is a pair of comparisons. Other attributes are stored as indexes into a
+    sorted list of their distinct values: single value matching compares
+    one integer, wildcard prefixes select a range of indexes and any other
+    pattern is only evaluated once per distinct value. Keys that are not
+    in a column, such as sequences, are matched by the compiled query on
+    the data sets that the columns select.
+
+    Needs numpy.
+    """
+    keywords = ["PatientID", "PatientName", "PatientBirthDate", "PatientSex",
+                "StudyInstanceUID", "StudyDate", "StudyTime", "AccessionNumber", "StudyID", "ModalitiesInStudy",
+                "SeriesInstanceUID", "Modality", "SeriesNumber",
+                "SOPInstanceUID", "SOPClassUID", "InstanceNumber"]
+
+    def __init__(self, keywords = None):
+        if numpy == None:
+            raise ImportError("twisteddicom.columnar needs numpy")
+        if keywords != None:
+            self.keywords = keywords
+        self.datasets = []
+        self._values = dict((keyword, []) for keyword in self.keywords)
+        self._columns = None
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def add(self, ds):
+        """Add the data set ds, which is kept and returned by find()."""
+        self.datasets.append(ds)
+        for keyword, values in self._values.iteritems():
+            value = ds.get(keyword) if keyword in ds else None
+            if isinstance(value, list):
+                value = "\\".join(str(x) for x in value)
+            elif value != None:
+                value = str(value)
+            values.append(value)
+        self._columns = None
+
+    def columns(self):
+        """Return keyword -> (VR, column), building the columns if data sets
+        have been added since they were last built.
+
+        Date and time columns are int64 arrays of ordinals. Other columns
+        are (codes, sorted distinct values, multi-valued), codes being an
+        int32 array of indexes into the distinct values with -1 for absent
+        values. Absent and invalid dates and times are the smallest integer
+        of the column type."""
+        if self._columns == None:
+            self._columns = {}
+            for keyword, values in self._values.iteritems():
+                vr = dicom.datadict.dictionaryVR(dicom.datadict.tag_for_name(keyword))
+                if vr in ("DA", "TM", "DT"):
+                    # Dates fit in 32 bits, which halves the memory scanned
+                    ordinals = numpy.empty(len(values), numpy.int32 if vr == "DA" else numpy.int64)
+                    missing = numpy.iinfo(ordinals.dtype).min
+                    for i, value in enumerate(values):
+                        try:
+                            ordinals[i] = date_time_ordinal(value, vr) if value != None else missing
+                        except ValueError:
+                            ordinals[i] = missing
+                    self._columns[keyword] = (vr, ordinals)
+                else:
+                    categories = sorted(set(values) - set([None]))
+                    lookup = dict((value, i) for i, value in enumerate(categories))
+                    lookup[None] = -1
+                    codes = numpy.fromiter((lookup[value] for value in values), numpy.int32, len(values))
+                    multi = any(value.find("\\") != -1 for value in categories)
+                    self._columns[keyword] = (vr, (codes, categories, multi))
+        return self._columns
+
+    def _range_mask(self, ordinals, pattern, vr):
+        date_range = DateRange(pattern, vr)
+        if date_range.min == None:
+            # Absent values are smaller than any minimum
+            mask = ordinals != numpy.iinfo(ordinals.dtype).min
+        else:
+            mask = ordinals >= date_range.min
+        if date_range.max != None:
+            mask &= ordinals <= date_range.max
+        return mask
+
+    def _mask(self, column, pattern, vr):
+        codes, categories, multi = column
+        wildcard = pattern.find("*") != -1 or pattern.find("?") != -1
+        if vr == "UI" and pattern.find("\\") != -1 and not multi:
+            return numpy.in1d(codes, [i for i in (_find(categories, uid) for uid in pattern.split("\\")) if i != None])
+        if not wildcard and not multi:
+            i = _find(categories, pattern)
+            if i == None:
+                return numpy.zeros(len(codes), bool)
+            return codes == i
+        prefix = pattern[:-1]
+        if (not multi and pattern.endswith("*") and prefix.find("*") == -1 and prefix.find("?") == -1
+            and _prefix_end(prefix) != None):
+            start = bisect.bisect_left(categories, prefix)
+            end = bisect.bisect_left(categories, _prefix_end(prefix))
+            return (codes >= start) & (codes < end)
+        value_match = compile_attribute(pattern, vr)
+        table = numpy.zeros(len(categories) + 1, bool) # the last entry is for absent values
+        for i, value in enumerate(categories):
+            table[i] = any(value_match(x) for x in value.split("\\")) if multi else value_match(value)
+        return table[codes]
+
+    def select(self, query):
+        """Return the indexes of the data sets that the columns select for the
+        C-FIND identifier query, and whether the compiled query needs to
+        check them."""
+        columns = self.columns()
+        mask = None
+        exact = True
+        for key, elem, value_match, sub_matcher in compile_query(query).keys:
+            keyword = dicom.datadict.keyword_for_tag(key)
+            if elem.VR == "SQ" or not keyword in columns:
+                exact = False
+                continue
+            if value_match == None:
+                continue
+            vr, column = columns[keyword]
+            pattern = elem.value
+            if isinstance(pattern, list):
+                pattern = "\\".join(str(x) for x in pattern)
+            if vr in ("DA", "TM", "DT"):
+                key_mask = self._range_mask(column, str(pattern), vr)
+            else:
+                key_mask = self._mask(column, str(pattern), elem.VR)
+            if mask is None:
+                mask = key_mask
+            else:
+                mask &= key_mask
+        if mask is None:
+            return numpy.arange(len(self.datasets)), exact
+        return numpy.flatnonzero(mask), exact
+
+    def find(self, query):
+        """Yield a result data set for every match of the C-FIND identifier
+        query, once per entity on the query/retrieve level if it has one."""
+        hits, exact = self.select(query)
+        level = getattr(query, "QueryRetrieveLevel", None)
+        columns = self.columns()
+        if level != None and exact:
+            # Keep the first hit of every entity before building any results
+            level_key = {"PATIENT": "PatientID", "STUDY": "StudyInstanceUID",
+                         "SERIES": "SeriesInstanceUID", "IMAGE": "SOPInstanceUID"}[level]
+            if level_key in columns:
+                codes = columns[level_key][1][0][hits]
+                unique, first = numpy.unique(codes, return_index = True)
+                hits = hits[numpy.sort(first)]
+                level = None
+        matcher = compile_query(query)
+        level_ids_done = set()
+        for i in hits:
+            ds = self.datasets[i]
+            if level != None:
+                level_id = get_level_identifier(ds, level)
+                if level_id in level_ids_done:
+                    continue
+            is_match, result_ds = matcher.match(ds)
+            if not is_match:
+                continue
+            if level != None:
+                level_ids_done.add(level_id)
+            yield result_ds
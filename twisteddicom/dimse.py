@@ -21,9 +21,13 @@
 # SOFTWARE.
 
 import struct
+import dicom
+from collections import namedtuple, deque
 from functools import wraps
 from twisteddicom import upper_layer, dimsemessages, pdu
+from twisted.internet import defer, error, interfaces, threads
 from twisted.python import log
+from zope.interface import implementer
 
 do_log = False
 
@@ -34,70 +38,563 @@ def debugindicate(func):
         return func(*args, **kwds)
     return wrapper    
 
+PresentationContext = namedtuple('PresentationContext', 
+                                 ['presentation_context_id', 'accepted', 'abstract_syntax', 
+                                  'transfer_syntax', 'is_implicit_VR', 'is_little_endian'])
+
+def build_presentation_context_table(presentation_contexts_requested, presentation_contexts_accepted):
+    """Return a dict mapping presentation context ID to PresentationContext,
+    from the presentation context items of an A-ASSOCIATE-RQ and the
+    A-ASSOCIATE-AC answering it. The transfer syntax is the one chosen
+    by the acceptor, see DICOM PS3.8-2011 9.3.3.2."""
+    abstract_syntaxes = dict((pci.presentation_context_id, pci.abstract_syntax.abstract_syntax_name.rstrip('\0'))
+                             for pci in presentation_contexts_requested or [])
+    table = {}
+    for pci in presentation_contexts_accepted or []:
+        accepted = pci.result_reason == 0
+        if accepted:
+            ts = pci.transfer_syntax.transfer_syntax_name.rstrip('\0')
+        else:
+            ts = None
+        table[pci.presentation_context_id] = PresentationContext(
+            presentation_context_id = pci.presentation_context_id,
+            accepted = accepted,
+            abstract_syntax = abstract_syntaxes.get(pci.presentation_context_id),
+            transfer_syntax = ts,
+            is_implicit_VR = dimsemessages.is_implicit_VR(ts),
+            is_little_endian = dimsemessages.is_little_endian(ts))
+    return table
+
+def is_final_response(cmd):
+    """True if cmd is a response that completes an operation, i.e. one
+    without a Pending status, see DICOM PS3.7-2011 C.1.2."""
+    return (hasattr(cmd, 'message_id_being_responded_to') and hasattr(cmd, 'status') 
+            and cmd.status not in (0xFF00, 0xFF01))
+
+
+# DIMSE message class -> name of its handler method, e.g. C_STORE_RQ ->
+# "C_STORE_RQ_received"
+DIMSE_handler_names = dict((dimse_class, dimse_class.__name__ + "_received") 
+                           for dimse_class in dimsemessages.commands)
+
+class DIMSETimeoutError(RuntimeError):
+    pass
+
+class _Request(object):
+    """An operation started with DIMSEProtocol.send_request()."""
+    def __init__(self, presentation_context_id, rq, data, pending_callback, timeout):
+        self.presentation_context_id = presentation_context_id
+        self.rq = rq
+        self.data = data
+        self.pending_callback = pending_callback
+        self.timeout = timeout
+        self.timeout_call = None
+        self.deferred = defer.Deferred()
+
+
+@implementer(interfaces.IPushProducer)
+class _TransportProducer(object):
+    """Registered with the transport of a DIMSEProtocol, so that it
+    stops sending P-DATA-TF PDUs, and its responders stop producing
+    responses, while the transport write buffer is full."""
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def pauseProducing(self):
+        self.protocol.transport_paused = True
+
+    def resumeProducing(self):
+        self.protocol.transport_paused = False
+        self.protocol.send_outbound()
+        for responder in self.protocol.responders.values():
+            responder.resume()
+
+    def stopProducing(self):
+        pass
+
+class _OutboundMessage(object):
+    """The command set and data set of a DIMSE message being sent, cut
+    into presentation data values as room is made for them in P-DATA-TF
+    PDUs, see DICOM PS3.8-2011 E.2."""
+    def __init__(self, presentation_context_id, dimse_command_pack, dimse_data_pack):
+        self.presentation_context_id = presentation_context_id
+        # (encoded, message control header of the last fragment, of the others)
+        self.parts = deque([(dimse_command_pack, '\x03', '\x01')])
+        if dimse_data_pack != None:
+            self.parts.append((dimse_data_pack, '\x02', '\x00'))
+        self.offset = 0
+
+    def remaining(self):
+        """Number of bytes left of the command or data set being sent, or
+        None when the whole message has been sent."""
+        if len(self.parts) == 0:
+            return None
+        return len(self.parts[0][0]) - self.offset
+
+    def next_pdv(self, length):
+        """Return the next presentation data value, with at most length
+        bytes of the command or data set. The value is the message control
+        header and the fragment, which are written as they are, see
+        pdu.P_DATA_TF.pack_sequence(). A command or data set string that
+        fits whole is not copied."""
+        encoded, last_header, header = self.parts[0]
+        start = self.offset
+        end = start + length
+        if end >= len(encoded):
+            self.parts.popleft()
+            self.offset = 0
+            if start == 0 and isinstance(encoded, str):
+                return (self.presentation_context_id, (last_header, encoded))
+            return (self.presentation_context_id, (last_header, encoded[start:]))
+        self.offset = end
+        return (self.presentation_context_id, (header, encoded[start:end]))
+
+class FindResponder(object):
+    """
+    Send the responses to a C-FIND-RQ, see DICOM PS3.4-2011 C.4.1.
+
+    Matches are pulled from results, an iterator of data sets, and sent
+    as Pending responses batch_size at a time. Matching may read any number
+    of files before the next match is found, so with threaded set each
+    batch is pulled in a thread of the reactor thread pool, one batch at a
+    time. Between batches control goes back to the reactor, and no batches
+    are pulled while the transport is paused. A C-CANCEL-RQ for the request
+    ends it with a Cancel response right away. deferred fires with the
+    status of the final response, or fails with ConnectionLost.
+    """
+    batch_size = 16
+
+    def __init__(self, protocol, presentation_context_id, find_rq, results, reactor = None, threaded = True):
+        if reactor == None:
+            from twisted.internet import reactor
+        self.protocol = protocol
+        self.presentation_context_id = presentation_context_id
+        self.find_rq = find_rq
+        self.results = iter(results)
+        self.reactor = reactor
+        self.threaded = threaded
+        self.call = None
+        # Deferred of the batch being pulled
+        self.pulling = None
+        self.done = False
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        self.protocol.add_responder(self.find_rq.message_id, self)
+        self.resume()
+
+    def resume(self):
+        if self.call == None and self.pulling == None and not self.done and not self.protocol.transport_paused:
+            self.call = self.reactor.callLater(0, self.send_batch)
+
+    def send_batch(self):
+        self.call = None
+        if self.threaded:
+            d = threads.deferToThread(self.pull_batch)
+        else:
+            d = defer.maybeDeferred(self.pull_batch)
+        # Cleared by pulled() or failed(), right away if not threaded
+        self.pulling = d
+        d.addCallbacks(self.pulled, self.failed)
+        d.addErrback(log.err)
+
+    def pull_batch(self):
+        """Return a list of up to batch_size results, and True if there are
+        no more. Called in a thread when threaded."""
+        batch = []
+        while len(batch) < self.batch_size and not self.done:
+            try:
+                batch.append(self.results.next())
+            except StopIteration:
+                return batch, True
+        return batch, False
+
+    def pulled(self, (batch, exhausted)):
+        self.pulling = None
+        if self.done:
+            self.close_results()
+            return
+        # Pack the responses of a batch into as few P-DATA-TF PDUs as possible
+        self.protocol.cork()
+        try:
+            for result in batch:
+                self.protocol.send_DIMSE_command(self.presentation_context_id, 
+                                                 dimsemessages.C_FIND_RSP(status = 0xFF00,
+                                                                          message_id_being_responded_to = self.find_rq.message_id,
+                                                                          affected_sop_class_uid = self.find_rq.affected_sop_class_uid,
+                                                                          data_set_present = True),
+                                                 result)
+            if exhausted:
+                self.finish(0x0000)
+        finally:
+            self.protocol.uncork()
+        self.resume()
+
+    def failed(self, reason):
+        self.pulling = None
+        if self.done:
+            self.close_results()
+            return
+        log.err(reason, "Error matching %s" % (self.find_rq,))
+        # Unable to process
+        self.finish(0xC000)
+
+    def cancel(self):
+        """Called on C-CANCEL-RQ."""
+        if not self.done:
+            self.finish(0xFE00)
+
+    def finish(self, status):
+        self.stop()
+        self.protocol.send_DIMSE_command(self.presentation_context_id, 
+                                         dimsemessages.C_FIND_RSP(status = status, 
+                                                                  message_id_being_responded_to = self.find_rq.message_id,
+                                                                  affected_sop_class_uid = self.find_rq.affected_sop_class_uid))
+        self.deferred.callback(status)
+
+    def stop(self):
+        """Stop without sending a final response."""
+        self.done = True
+        if self.call != None:
+            self.call.cancel()
+            self.call = None
+        self.protocol.remove_responder(self.find_rq.message_id, self)
+        # Not while a thread is pulling from results
+        if self.pulling == None:
+            self.close_results()
+
+    def close_results(self):
+        if hasattr(self.results, 'close'):
+            self.results.close()
+
+    def connection_lost(self):
+        self.stop()
+        self.deferred.errback(error.ConnectionLost("Connection closed before final response to %s" % (self.find_rq,)))
+
 
 class DIMSEProtocol(upper_layer.DICOMUpperLayerServiceProvider):
+    # Handle presentation data values as they arrive instead of waiting for
+    # whole P-DATA-TF PDUs, which may be up to 4 GB long.
+    stream_p_data = True
+
     def __init__(self, 
                  supported_abstract_syntaxes = None, 
                  supported_transfer_syntaxes = None):
         super(DIMSEProtocol, self).__init__(supported_abstract_syntaxes = supported_abstract_syntaxes, 
                                             supported_transfer_syntaxes = supported_transfer_syntaxes)
-        self.dimse_is_reading_command = True
-        self.dimse_command_buffer = ""
-        self.dimse_data_buffer = ""
-        self.dimse_presentation_context_id = None
         self.maximum_length_sent = None
         self.presentation_contexts_requested = None
         self.presentation_contexts_accepted = None
+        # Presentation context ID -> PresentationContext, built once the
+        # association is negotiated.
+        self.presentation_contexts = {}
         self.user_information_item_accepted = None
-        self.dimse_command_buffer = ""
+        self.dimse_command_buffer = []
         self.dimse_command = None
-        self.dimse_data_buffer = ""
+        self.dimse_data_sink = None
         self.dimse_is_reading_command = True
         self.dimse_presentation_context_id = None
+        # Negotiated asynchronous operations window, from our point of
+        # view. 0 means unlimited.
+        self.operations_invoked_limit = 1
+        self.operations_performed_limit = 1
+        # Message ID -> request, for operations without a final response yet
+        self.operations_invoked = {}
+        self.operations_performed = {}
+        # Message ID -> _Request, for send_request() operations
+        self.requests = {}
+        # Requests waiting for room in the operations window
+        self.queued_requests = deque()
+        self.next_message_id = 1
+        # Message ID -> responder (e.g. FindResponder) still sending
+        # responses to a received request
+        self.responders = {}
+        self.transport_producer = None
+        self.transport_paused = False
+        # _OutboundMessage of the DIMSE messages being sent, see
+        # send_DIMSE_command()
+        self.outbound = deque()
+        # Messages are only queued while > 0, see cork()
+        self.outbound_corked = 0
+        self.release_requested = False
+        # DIMSE message class -> handler set with register_DIMSE_handler()
+        self.DIMSE_handlers = {}
 
     called_ae_title = "CALLED"
     calling_ae_title = "CALLING"
 
+    # Asynchronous operations window to negotiate, see DICOM PS3.7-2011
+    # D.3.3.3. The number of operations we want to have outstanding and the
+    # number we are prepared to perform concurrently. 0 means unlimited.
+    maximum_number_operations_invoked = 1
+    maximum_number_operations_performed = 1
+
+    # Received data sets larger than this are spooled to a temporary file.
+    dataset_spool_threshold = 16 * 1024 * 1024
+
+    # No more P-DATA-TF PDUs are written while the transport buffers more
+    # than send_buffer_size bytes, and PDUs are at most
+    # default_maximum_length_sent long when the peer does not limit their
+    # length. So the memory used for sending does not grow with the size
+    # of the data sets.
+    send_buffer_size = 256 * 1024
+    default_maximum_length_sent = 256 * 1024
+    # Commands and data sets shorter than this are not split across
+    # P-DATA-TF PDUs, unless they are longer than a whole PDU.
+    minimum_fragment_length = 256
+    # A smaller maximum length received by the peer is raised to this, the
+    # 6 bytes of a presentation data value item and a fragment of 2 bytes,
+    # as no data could be sent otherwise.
+    smallest_maximum_length_sent = 8
+
+    # DIMSE message classes (e.g. dimsemessages.C_STORE_RQ) whose data sets
+    # are not decoded. The *_received handler gets the
+    # dimsemessages.DatasetSink instead of a Dataset, with transfer_syntax
+    # set, and is responsible for closing it.
+    raw_dataset_commands = ()
+
+    def create_dataset_sink(self, presentation_context_id, dimse_command, transfer_syntax):
+        """Return the dimsemessages.DatasetSink that will receive the data
+        set following dimse_command (a dimsemessages.CommandSet). Override to
+        tune spooling per command."""
+        return dimsemessages.DatasetSink(spool_threshold = self.dataset_spool_threshold, 
+                                         transfer_syntax = transfer_syntax)
+
+    def get_application_association_information(self):
+        items = super(DIMSEProtocol, self).get_application_association_information()
+        if (self.is_association_requestor and 
+            (self.maximum_number_operations_invoked, self.maximum_number_operations_performed) != (1, 1)):
+            items.append(pdu.AsynchronousOperationsWindowSubitem(self.maximum_number_operations_invoked,
+                                                                 self.maximum_number_operations_performed))
+        return items
+
+    def negotiate_asynchronous_operations_window(self, user_information_item):
+        """Set the operations window from an A-ASSOCIATE-RQ (when accepting)
+        or A-ASSOCIATE-AC (when requesting) user information item.
+
+        Returns the AsynchronousOperationsWindowSubitem to put in the
+        A-ASSOCIATE-AC, or None if the request did not have one."""
+        window = None
+        if user_information_item != None:
+            for user_data in user_information_item.user_data_subitems:
+                if isinstance(user_data, pdu.AsynchronousOperationsWindowSubitem):
+                    window = user_data
+        if window == None:
+            # Default is synchronous operation, PS3.7-2011 D.3.3.3
+            self.operations_invoked_limit = 1
+            self.operations_performed_limit = 1
+            return None
+        if self.is_association_requestor:
+            self.operations_invoked_limit = window.maximum_number_operations_invoked
+            self.operations_performed_limit = window.maximum_number_operations_performed
+            return None
+
+        def limit(a, b):
+            if a == 0 or b == 0:
+                return max(a, b)
+            return min(a, b)
+        # The values in the A-ASSOCIATE-AC are those of the requestor.
+        self.operations_performed_limit = limit(window.maximum_number_operations_invoked, 
+                                                self.maximum_number_operations_performed)
+        self.operations_invoked_limit = limit(window.maximum_number_operations_performed, 
+                                              self.maximum_number_operations_invoked)
+        return pdu.AsynchronousOperationsWindowSubitem(self.operations_performed_limit, self.operations_invoked_limit)
+
+    def can_invoke_operation(self):
+        """True if another request can be sent without exceeding the
+        negotiated asynchronous operations window."""
+        return self.operations_invoked_limit == 0 or len(self.operations_invoked) < self.operations_invoked_limit
+
+    def new_message_id(self):
+        """Return a message ID that is not used by any outstanding request."""
+        while True:
+            message_id = self.next_message_id
+            self.next_message_id = message_id % 0xFFFF + 1
+            if message_id not in self.operations_invoked and message_id not in self.requests:
+                return message_id
+
+    def send_request(self, presentation_context_id, rq, data = None, pending_callback = None, timeout = None):
+        """Send the request rq, with a new message ID, and return a Deferred
+        that fires with (rsp, data) when the final response arrives.
+
+        pending_callback(rsp, data) is called for each response with a
+        Pending status. If timeout is given, the Deferred fails with
+        DIMSETimeoutError when there is no final response within timeout
+        seconds after sending rq, and with ConnectionLost if the connection
+        is closed first. A timeout aborts the association, as the remote
+        system may still be performing the operation and would hold its
+        place in the asynchronous operations window for good. The other
+        requests then fail with ConnectionLost. While the window is full,
+        requests are queued.
+        Responses to these requests are not passed on to the *_RSP_received
+        methods."""
+        rq.message_id = self.new_message_id()
+        request = _Request(presentation_context_id, rq, data, pending_callback, timeout)
+        self.requests[rq.message_id] = request
+        if len(self.queued_requests) == 0 and self.can_invoke_operation():
+            self._send_request(request)
+        else:
+            self.queued_requests.append(request)
+        return request.deferred
+
+    def _send_request(self, request):
+        if request.timeout != None:
+            request.timeout_call = self.timer_wheel.callLater(request.timeout, self._request_timed_out, request)
+        data, request.data = request.data, None
+        self.send_DIMSE_command(request.presentation_context_id, request.rq, data)
+
+    def _send_queued_requests(self):
+        while len(self.queued_requests) > 0 and self.can_invoke_operation():
+            self._send_request(self.queued_requests.popleft())
+
+    def _request_timed_out(self, request):
+        del self.requests[request.rq.message_id]
+        request.timeout_call = None
+        log.msg("No response to %s within %s seconds, aborting the association" % (request.rq, request.timeout))
+        self.A_ABORT_request_received(None)
+        request.deferred.errback(DIMSETimeoutError("No response to %s within %s seconds" % (request.rq, request.timeout)))
+
+    def register_transport_producer(self):
+        if self.transport_producer == None and self.transport != None and not getattr(self.transport, 'disconnecting', False):
+            self.transport_producer = _TransportProducer(self)
+            if hasattr(self.transport, 'bufferSize'):
+                self.transport.bufferSize = self.send_buffer_size
+            self.transport.registerProducer(self.transport_producer, True)
+
+    def unregister_transport_producer(self):
+        if self.transport_producer != None:
+            self.transport_producer = None
+            self.transport_paused = False
+            if self.transport != None:
+                self.transport.unregisterProducer()
+
+    def close_transport(self):
+        # The transport is not closed while a registered producer is paused
+        self.unregister_transport_producer()
+        super(DIMSEProtocol, self).close_transport()
+
+    def add_responder(self, message_id, responder):
+        """Have responder.cancel() called on a C-CANCEL-RQ for message_id,
+        and responder.resume() when the transport can take more data."""
+        self.register_transport_producer()
+        self.responders[message_id] = responder
+
+    def remove_responder(self, message_id, responder):
+        if self.responders.get(message_id) is responder:
+            del self.responders[message_id]
+
+    def respond_to_find(self, presentation_context_id, find_rq, results, threaded = True):
+        """Send the responses to find_rq, one Pending response for each
+        data set from the iterator results, followed by the final response.
+        Unless threaded is False, results is iterated in threads. Returns
+        the Deferred of the FindResponder."""
+        responder = FindResponder(self, presentation_context_id, find_rq, results, 
+                                  reactor = self.timer_wheel.reactor, threaded = threaded)
+        responder.start()
+        return responder.deferred
+
+    def conn_closed_received(self):
+        super(DIMSEProtocol, self).conn_closed_received()
+        self.unregister_transport_producer()
+        self.outbound.clear()
+        self.release_requested = False
+        for responder in self.responders.values():
+            responder.connection_lost()
+        self.responders = {}
+        requests = self.requests.values()
+        self.requests = {}
+        self.queued_requests.clear()
+        for request in requests:
+            if request.timeout_call != None:
+                request.timeout_call.cancel()
+            request.deferred.errback(error.ConnectionLost("Connection closed before response to %s" % (request.rq,)))
+
     def send_DIMSE_command(self, presentation_context_id, dimse_command, dimse_data = None):
+        """Send dimse_command, followed by dimse_data if not None.
+
+        dimse_data is a Dataset, which is encoded in the transfer syntax of
+        the presentation context, or a data set already encoded in that
+        transfer syntax, as a str or buffer (e.g. of a file mapped into
+        memory). An encoded data set is sent as it is, a slice at a time.
+
+        The message is queued behind those not sent yet. PDUs are sent
+        right away, until the transport asks to pause, and the rest when it
+        resumes."""
         if do_log: log.msg("sending DIMSE command %s on context %s" % (dimse_command, presentation_context_id))
+        if hasattr(dimse_command, 'message_id'):
+            self.operations_invoked[dimse_command.message_id] = dimse_command
+        elif is_final_response(dimse_command):
+            self.operations_performed.pop(dimse_command.message_id_being_responded_to, None)
         dimse_command_pack = dimse_command.pack()
-        dimse_command_len = 6 + len(dimse_command_pack) 
-        if dimse_data != None:
-            ts = [pci.transfer_syntaxes[0].transfer_syntax_name 
-                  for pci in self.presentation_contexts_requested 
-                  if pci.presentation_context_id == presentation_context_id][0]
-            
-            dimse_data_pack = dimsemessages.pack_dataset(dimse_data, dimsemessages.is_implicit_VR(ts), 
-                                                         dimsemessages.is_little_endian(ts))
-            dimse_data_len = 6 + len(dimse_data_pack)
+        if dimse_data == None:
+            dimse_data_pack = None
+        elif isinstance(dimse_data, dicom.dataset.Dataset):
+            context = self.presentation_contexts[presentation_context_id]
+            dimse_data_pack = dimsemessages.pack_dataset(dimse_data, context.is_implicit_VR, context.is_little_endian)
         else:
-            dimse_data_pack = ''
-            dimse_data_len = 0
-
-        if do_log: log.msg("maximum_length_sent = %s" % (self.maximum_length_sent,))
-        if self.maximum_length_sent == None or self.maximum_length_sent >= dimse_command_len + dimse_data_len:
-            messages = [(presentation_context_id, '\x03' + dimse_command_pack)]
-            if dimse_data != None:
-                messages.append((presentation_context_id, '\x02' + dimse_data_pack))
-            self.P_DATA_request_received(messages)
+            dimse_data_pack = dimse_data
+        self.register_transport_producer()
+        self.outbound.append(_OutboundMessage(presentation_context_id, dimse_command_pack, dimse_data_pack))
+        self.send_outbound()
+
+    def cork(self):
+        """Only queue the DIMSE messages sent until uncork() is called, so
+        that a burst of small messages is packed into few P-DATA-TF PDUs.
+        Calls may be nested."""
+        self.outbound_corked += 1
+
+    def uncork(self):
+        self.outbound_corked -= 1
+        self.send_outbound()
+
+    def send_outbound(self):
+        """Send the queued DIMSE messages until the transport is paused.
+
+        Each P-DATA-TF PDU is filled with presentation data values up to
+        the maximum length, see DICOM PS3.8-2011 9.3.5, so a command goes
+        together with the start of its data set, and consecutive small
+        messages share a PDU."""
+        if self.outbound_corked > 0:
+            return
+        maximum_length = self.maximum_length_sent or self.default_maximum_length_sent
+        data_values = []
+        room = maximum_length
+        while len(self.outbound) > 0 and not self.transport_paused:
+            message = self.outbound[0]
+            remaining = message.remaining()
+            if remaining == None:
+                self.outbound.popleft()
+                continue
+            # A presentation data value item takes 6 bytes besides the
+            # fragment. Fragments are kept even, and small commands and
+            # data sets are not split just to fill up a PDU.
+            fits = room - 6 & ~1
+            if fits < min(remaining, self.minimum_fragment_length) and len(data_values) > 0:
+                self.P_DATA_request_received(data_values)
+                data_values = []
+                room = maximum_length
+                continue
+            data_value = message.next_pdv(fits)
+            data_values.append(data_value)
+            context_id, (message_control_header, fragment) = data_value
+            room -= 6 + len(fragment)
+        if len(data_values) > 0:
+            self.P_DATA_request_received(data_values)
+        if len(self.outbound) == 0 and self.release_requested:
+            self.release_requested = False
+            super(DIMSEProtocol, self).A_RELEASE_request_received()
+
+    def A_RELEASE_request_received(self):
+        """Request release once the queued DIMSE messages have been sent."""
+        if len(self.outbound) > 0:
+            self.release_requested = True
         else:
-            while dimse_command_pack != '':
-                fits = dimse_command_pack[:self.maximum_length_sent - 6 & ~1]
-                dimse_command_pack = dimse_command_pack[self.maximum_length_sent - 6 & ~1:]
-                if dimse_command_pack == '':
-                    messages = [(presentation_context_id, '\x03' + fits)]
-                else:
-                    messages = [(presentation_context_id, '\x01' + fits)]
-                self.P_DATA_request_received(messages)
-
-            while dimse_data_pack != '':
-                fits = dimse_data_pack[:self.maximum_length_sent - 6 & ~1]
-                dimse_data_pack = dimse_data_pack[self.maximum_length_sent - 6 & ~1:]
-                if dimse_data_pack == '':
-                    messages = [(presentation_context_id, '\x02' + fits)]
-                else:
-                    messages = [(presentation_context_id, '\x00' + fits)]
-                self.P_DATA_request_received(messages)
+            super(DIMSEProtocol, self).A_RELEASE_request_received()
+
+    def A_ABORT_request_received(self, data, reason = 0):
+        self.outbound.clear()
+        self.release_requested = False
+        super(DIMSEProtocol, self).A_ABORT_request_received(data, reason)
 
     def is_acceptable(self, a_associate_rq):
         # At least one presentation context has to be requested.
@@ -110,14 +607,28 @@ class DIMSEProtocol(upper_layer.DICOMUpperLayerServiceProvider):
     def A_ASSOCIATE_confirmation_accept_indicated(self, a_associate_ac):
         """Called from upper_layer.do_AE_3 when a remote system has sent A_ASSOCIATE_AC."""
         self.presentation_contexts_accepted = a_associate_ac.presentation_context_items
+        self.presentation_contexts = build_presentation_context_table(self.presentation_contexts_requested, 
+                                                                      self.presentation_contexts_accepted)
         self.user_information_item_accepted = a_associate_ac.user_information_item
-        if a_associate_ac.user_information_item != None:
-            for user_data in a_associate_ac.user_information_item.user_data_subitems:
+        self.negotiate_asynchronous_operations_window(a_associate_ac.user_information_item)
+        self.set_maximum_length_sent(a_associate_ac.user_information_item)
+
+    def set_maximum_length_sent(self, user_information_item):
+        """Set the maximum length of the P-DATA-TF PDUs we send from the
+        maximum length the remote system receives, in its A-ASSOCIATE-RQ
+        or A-ASSOCIATE-AC user information item. 0 means unlimited, see
+        DICOM PS3.8-2011 D.1. A length too small to send anything in is
+        raised to smallest_maximum_length_sent."""
+        self.maximum_length_sent = None
+        if user_information_item != None:
+            for user_data in user_information_item.user_data_subitems:
                 if isinstance(user_data, pdu.MaximumLengthSubitem):
                     if user_data.maximum_length_received != 0:
                         self.maximum_length_sent = user_data.maximum_length_received
-                    else:
-                        self.maximum_length_sent = None
+                        if self.maximum_length_sent < self.smallest_maximum_length_sent:
+                            log.msg("Maximum length %i received by the peer is too small, sending PDUs of %i bytes" % (
+                                    self.maximum_length_sent, self.smallest_maximum_length_sent))
+                            self.maximum_length_sent = self.smallest_maximum_length_sent
 
     @debugindicate
     def A_ASSOCIATE_confirmation_reject_indicated(self):
@@ -146,110 +657,123 @@ class DIMSEProtocol(upper_layer.DICOMUpperLayerServiceProvider):
 
         self.presentation_contexts_requested = a_associate_rq.presentation_context_items
         self.presentation_contexts_accepted = self.validate_presentation_contexts(a_associate_rq)
-        self.user_information_item_accepted = pdu.UserInformationItem(self.get_application_association_information())
+        self.presentation_contexts = build_presentation_context_table(self.presentation_contexts_requested, 
+                                                                      self.presentation_contexts_accepted)
+        user_data_subitems = self.get_application_association_information()
+        window = self.negotiate_asynchronous_operations_window(a_associate_rq.user_information_item)
+        self.set_maximum_length_sent(a_associate_rq.user_information_item)
+        if window != None:
+            user_data_subitems.append(window)
+        self.user_information_item_accepted = pdu.UserInformationItem(user_data_subitems)
         
         self.A_ASSOCIATE_response_accept_received()
 
     @debugindicate
     def P_DATA_indicated(self, data_values):
-        for val in data_values:
-            msg_ctrl_hdr, = struct.unpack("B", val[1][0])
-            if self.dimse_presentation_context_id != None:
-                if val[0] != self.dimse_presentation_context_id:
-                    log.err("Got unexpected interleaved presentation contexts in data stream")
-                    self.A_ABORT_request_received(None, reason = 6)
-                    return
-
-            accepted = [pci.result_reason == 0 
-                        for pci in self.presentation_contexts_accepted 
-                        if pci.presentation_context_id == val[0]]
-
-            if accepted != [True]:
-                self.A_ABORT_request_received(None, reason = 6)
+        for presentation_context_id, value in data_values:
+            msg_ctrl_hdr, = struct.unpack_from("B", value)
+            if not self.PDV_received(presentation_context_id, msg_ctrl_hdr, value[1:], True):
                 return
-                
-            self.dimse_presentation_context_id = val[0]
-            
-            ts = [pci.transfer_syntaxes[0].transfer_syntax_name 
-                  for pci in self.presentation_contexts_requested 
-                  if pci.presentation_context_id == self.dimse_presentation_context_id][0]
-            if self.dimse_is_reading_command:
-                assert msg_ctrl_hdr & 1, "Got data type pdv while reading command!"
-                self.dimse_command_buffer += val[1][1:]
-                if msg_ctrl_hdr & 2: # End of command
-                    self.dimse_command = dimsemessages.unpack_dataset(self.dimse_command_buffer)
-                    if do_log: log.msg("revcommand: %s" % (dimsemessages.revcommands[self.dimse_command.CommandField],))
-                    if getattr(self.dimse_command, 'CommandDataSetType', 0) == 0x101:
-                        self.dimse_is_reading_command = True
-                        cmd = dimsemessages.unpack_dimse_command(self.dimse_command)
-                        self.DIMSE_command_received(self.dimse_presentation_context_id, cmd, None)
-                        self.dimse_command_buffer = ""
-                        self.dimse_command = None
-                        self.dimse_presentation_context_id = None
-                    else:
-                        self.dimse_is_reading_command = False
-            else:
-                assert not msg_ctrl_hdr & 1, "Got command type pdv while reading data!"
-                self.dimse_data_buffer += val[1][1:]
-                if msg_ctrl_hdr & 2: # End of data
-                    dimse_data = dimsemessages.unpack_dataset(self.dimse_data_buffer, ts)
+
+    def P_DATA_fragment_indicated(self, fragment):
+        """Called from upper_layer for each PDV fragment when P-DATA-TF PDUs
+        are streamed (see sockhandler.PDUFramer)."""
+        self.PDV_received(fragment.presentation_context_id, fragment.message_control_header, 
+                          fragment.data, fragment.pdv_end)
+
+    def PDV_received(self, presentation_context_id, msg_ctrl_hdr, data, pdv_end):
+        """Add (a fragment of) a presentation data value to the DIMSE message
+        being received. A message is complete at the end of a PDV that has
+        the last-fragment bit set in its message control header.
+
+        Returns False if the association was aborted."""
+        if self.dimse_presentation_context_id != None:
+            if presentation_context_id != self.dimse_presentation_context_id:
+                log.err("Got unexpected interleaved presentation contexts in data stream")
+                self.A_ABORT_request_received(None, reason = 6)
+                return False
+
+        context = self.presentation_contexts.get(presentation_context_id)
+        if context == None or not context.accepted:
+            self.A_ABORT_request_received(None, reason = 6)
+            return False
+
+        self.dimse_presentation_context_id = presentation_context_id
+
+        ts = context.transfer_syntax
+        if self.dimse_is_reading_command:
+            assert msg_ctrl_hdr & 1, "Got data type pdv while reading command!"
+            self.dimse_command_buffer.append(data)
+            if pdv_end and msg_ctrl_hdr & 2: # End of command
+                self.dimse_command = dimsemessages.unpack_command_set("".join(self.dimse_command_buffer))
+                self.dimse_command_buffer = []
+                if do_log: log.msg("revcommand: %s" % (dimsemessages.revcommands[self.dimse_command.CommandField],))
+                if getattr(self.dimse_command, 'CommandDataSetType', 0) == 0x101:
+                    self.dimse_is_reading_command = True
                     cmd = dimsemessages.unpack_dimse_command(self.dimse_command)
-                    self.DIMSE_command_received(self.dimse_presentation_context_id, cmd, dimse_data)
-                    self.dimse_command_buffer = ""
+                    if not self._operation_received(cmd, None):
+                        self.DIMSE_command_received(self.dimse_presentation_context_id, cmd, None)
                     self.dimse_command = None
-                    self.dimse_data_buffer = ""
-                    self.dimse_is_reading_command = True
                     self.dimse_presentation_context_id = None
+                else:
+                    self.dimse_is_reading_command = False
+                    self.dimse_data_sink = self.create_dataset_sink(self.dimse_presentation_context_id, self.dimse_command, ts)
+        else:
+            assert not msg_ctrl_hdr & 1, "Got command type pdv while reading data!"
+            self.dimse_data_sink.write(data)
+            if pdv_end and msg_ctrl_hdr & 2: # End of data
+                cmd = dimsemessages.unpack_dimse_command(self.dimse_command)
+                if cmd.__class__ in self.raw_dataset_commands:
+                    dimse_data = self.dimse_data_sink
+                else:
+                    dimse_data = dimsemessages.unpack_dataset(self.dimse_data_sink, ts)
+                    self.dimse_data_sink.close()
+                self.dimse_data_sink = None
+                if not self._operation_received(cmd, dimse_data):
+                    self.DIMSE_command_received(self.dimse_presentation_context_id, cmd, dimse_data)
+                self.dimse_command = None
+                self.dimse_is_reading_command = True
+                self.dimse_presentation_context_id = None
+        return True
+
+    def _operation_received(self, cmd, data):
+        """Keep track of outstanding operations. Returns True if cmd is a
+        response to a send_request() and has been handled."""
+        if hasattr(cmd, 'message_id'):
+            self.operations_performed[cmd.message_id] = cmd
+            return False
+        if not hasattr(cmd, 'status'): # C-CANCEL-RQ
+            return False
+        message_id = cmd.message_id_being_responded_to
+        request = self.requests.get(message_id)
+        if not is_final_response(cmd):
+            if request != None and request.pending_callback != None:
+                request.pending_callback(cmd, data)
+            return request != None
+        self.operations_invoked.pop(message_id, None)
+        if request == None:
+            self._send_queued_requests()
+            return False
+        del self.requests[message_id]
+        if request.timeout_call != None:
+            request.timeout_call.cancel()
+            request.timeout_call = None
+        self._send_queued_requests()
+        request.deferred.callback((cmd, data))
+        return True
+
+    def register_DIMSE_handler(self, dimse_class, handler):
+        """Have handler(presentation_context_id, cmd, data) called for
+        received messages of dimse_class instead of the *_received method."""
+        self.DIMSE_handlers[dimse_class] = handler
 
     def DIMSE_command_received(self, presentation_context_id, cmd, data):
-        if cmd.__class__ == dimsemessages.C_STORE_RQ:
-            self.C_STORE_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_STORE_RSP:
-            self.C_STORE_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_GET_RQ:
-            self.C_GET_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_GET_RSP:
-            self.C_GET_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_FIND_RQ:
-            self.C_FIND_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_FIND_RSP:
-            self.C_FIND_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_MOVE_RQ:
-            self.C_MOVE_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_MOVE_RSP:
-            self.C_MOVE_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_ECHO_RQ:
-            self.C_ECHO_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_ECHO_RSP:
-            self.C_ECHO_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_EVENT_REPORT_RQ:
-            self.N_EVENT_REPORT_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_EVENT_REPORT_RSP:
-            self.N_EVENT_REPORT_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_GET_RQ:
-            self.N_GET_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_GET_RSP:
-            self.N_GET_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_SET_RQ:
-            self.N_SET_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_SET_RSP:
-            self.N_SET_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_ACTION_RQ:
-            self.N_ACTION_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_ACTION_RSP:
-            self.N_ACTION_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_CREATE_RSP:
-            self.N_CREATE_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_DELETE_RQ:
-            self.N_DELETE_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_DELETE_RSP:
-            self.N_DELETE_RSP_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.N_CREATE_RQ:
-            self.N_CREATE_RQ_received(presentation_context_id, cmd, data)
-        elif cmd.__class__ == dimsemessages.C_CANCEL_RQ:
-            self.C_CANCEL_RQ_received(presentation_context_id, cmd, data)
-        else:            
-            self.unrecognized_or_invalid_DIMSE_received(presentation_context_id, cmd, data)
+        handler = self.DIMSE_handlers.get(cmd.__class__)
+        if handler == None:
+            # Looked up on every message, so that *_received methods can
+            # also be replaced on the instance
+            handler = getattr(self, DIMSE_handler_names.get(cmd.__class__, "unrecognized_or_invalid_DIMSE_received"))
+        handler(presentation_context_id, cmd, data)
 
     def C_STORE_RQ_received(self, presentation_context_id, cmd, data):
         raise NotImplementedError
@@ -296,6 +820,8 @@ class DIMSEProtocol(upper_layer.DICOMUpperLayerServiceProvider):
     def N_CREATE_RQ_received(self, presentation_context_id, cmd, data):
         raise NotImplementedError
     def C_CANCEL_RQ_received(self, presentation_context_id, cmd, data):
-        raise NotImplementedError
+        responder = self.responders.get(cmd.message_id_being_responded_to)
+        if responder != None:
+            responder.cancel()
     def unrecognized_or_invalid_DIMSE_received(self, presentation_context_id, cmd, data):
         raise NotImplementedError
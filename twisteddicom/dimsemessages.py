@@ -20,11 +20,13 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import shutil
+import struct
 import tempfile
 import dicom
 from io import BytesIO
 from twisted.python import log
-from twisteddicom.utils import get_uid
+from twisteddicom import uids
 
 # See DICOM PS3.7-2011, Table E.1-1
 DimseDicomDictionary = {
@@ -91,9 +93,50 @@ def pack_dataset(dicomDataset, is_implicit_VR = True, is_little_endian = True):
     dicom.filewriter.write_dataset(fp, dicomDataset)
     return fp.parent.getvalue()
 
+class DatasetSink(object):
+    """Collects the bytes of a received data set.
+
+    Data is kept in memory until spool_threshold bytes have been written
+    and is then spooled to a temporary file, so that large objects do not
+    have to be held as Python strings. unpack_dataset() reads directly from
+    the sink.
+
+    transfer_syntax is the transfer syntax the data set is encoded in."""
+    def __init__(self, spool_threshold = 16 * 1024 * 1024, transfer_syntax = None):
+        self.file = tempfile.SpooledTemporaryFile(max_size = spool_threshold)
+        self.length = 0
+        self.transfer_syntax = transfer_syntax
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def spooled(self):
+        """True if the data has been moved to a file on disk."""
+        return self.file._rolled
+
+    def write(self, data):
+        self.file.write(data)
+        self.length += len(data)
+
+    def open(self):
+        """Return a file object positioned at the start of the data."""
+        self.file.seek(0)
+        return self.file
+
+    def getvalue(self):
+        return self.open().read()
+
+    def close(self):
+        self.file.close()
+
 def unpack_dataset(buf, ts = dicom.UID.ImplicitVRLittleEndian):
+    """Decode a data set from a string or a DatasetSink."""
     try:
-        fp = BytesIO(buf)
+        if isinstance(buf, DatasetSink):
+            fp = buf.open()
+        else:
+            fp = BytesIO(buf)
         ds = dicom.filereader.read_dataset(fp, is_implicit_VR(ts), is_little_endian(ts), bytelength = len(buf))
         assert ds != None
         return ds
@@ -101,7 +144,10 @@ def unpack_dataset(buf, ts = dicom.UID.ImplicitVRLittleEndian):
         log.err(e)
         tf = tempfile.NamedTemporaryFile(delete = False)
         log.err("Error decoding dataset with ts %s. Writing to file %s." % (ts, tf.name))
-        tf.write(buf)
+        if isinstance(buf, DatasetSink):
+            shutil.copyfileobj(buf.open(), tf)
+        else:
+            tf.write(buf)
         tf.close()
         return None
 
@@ -112,6 +158,101 @@ def pack_dataset_with_commandgrouplength(dicomDataset, *args, **kwargs):
     s = pack_dataset(ds2, *args, **kwargs) + s
     return s
 
+# Keyword -> tag for the command elements in DimseDicomDictionary
+_command_tags = {keyword: tag for tag, (vr, vm, name, retired, keyword) in DimseDicomDictionary.iteritems()}
+
+class CommandSet(dict):
+    """A command set, see DICOM PS3.7-2011 6.3.1.
+
+    Maps tags to values and, like dicom.dataset.Dataset, allows access to the
+    elements of DimseDicomDictionary by keyword, e.g. cs.MessageID. Elements
+    with tags not in DimseDicomDictionary hold their encoded value."""
+    def __getattr__(self, keyword):
+        try:
+            return self[_command_tags[keyword]]
+        except KeyError:
+            raise AttributeError(keyword)
+
+    def __setattr__(self, keyword, value):
+        try:
+            self[_command_tags[keyword]] = value
+        except KeyError:
+            raise AttributeError(keyword)
+
+    def __delattr__(self, keyword):
+        try:
+            del self[_command_tags[keyword]]
+        except KeyError:
+            raise AttributeError(keyword)
+
+def _pad(value, padding):
+    value = str(value)
+    if len(value) & 1:
+        value += padding
+    return value
+
+def _pack_AT(value):
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return "".join(struct.pack("<HH", tag >> 16, tag & 0xffff) for tag in value)
+
+def _unpack_AT(s):
+    tags = [group << 16 | element 
+            for group, element in (struct.unpack_from("<HH", s, i) for i in range(0, len(s), 4))]
+    return tags[0] if len(tags) == 1 else tags
+
+_command_value_packers = {
+    'UL': lambda value: struct.pack("<I", value),
+    'US': lambda value: struct.pack("<H", value),
+    'UI': lambda value: _pad(value, '\0'),
+    'AE': lambda value: _pad(value, ' '),
+    'LO': lambda value: _pad(value, ' '),
+    'AT': _pack_AT,
+}
+
+_command_value_unpackers = {
+    'UL': lambda s: struct.unpack("<I", s)[0],
+    'US': lambda s: struct.unpack("<H", s)[0],
+    'UI': lambda s: s.rstrip('\0 '),
+    'AE': lambda s: s.strip(' '),
+    'LO': lambda s: s.rstrip(' '),
+    'AT': _unpack_AT,
+}
+
+def pack_command_set(command_set):
+    """Encode a CommandSet in Implicit VR Little Endian, preceded by the
+    Command Group Length element, see DICOM PS3.7-2011 6.3.1.
+
+    Gives the same result as pack_dataset_with_commandgrouplength() for
+    the same elements, without going through dicom.filewriter."""
+    elements = []
+    for tag in sorted(command_set):
+        if tag == 0x00000000: # Command Group Length
+            continue
+        value = command_set[tag]
+        if tag in DimseDicomDictionary:
+            value = _command_value_packers[DimseDicomDictionary[tag][0]](value)
+        elements.append(struct.pack("<HHI", tag >> 16, tag & 0xffff, len(value)))
+        elements.append(value)
+    s = "".join(elements)
+    return struct.pack("<HHII", 0x0000, 0x0000, 4, len(s)) + s
+
+def unpack_command_set(s):
+    """Decode a command set encoded in Implicit VR Little Endian into a
+    CommandSet."""
+    command_set = CommandSet()
+    i = 0
+    while i < len(s):
+        group, element, length = struct.unpack_from("<HHI", s, i)
+        i += 8
+        tag = group << 16 | element
+        value = s[i:i + length]
+        i += length
+        if tag in DimseDicomDictionary and length != 0:
+            value = _command_value_unpackers[DimseDicomDictionary[tag][0]](value)
+        command_set[tag] = value
+    return command_set
+
 def unpack_dimse_command(dataset):
     obj = revcommands[dataset.CommandField]()
     obj.unpack(dataset)
@@ -143,7 +284,7 @@ class C_STORE_RQ(DIMSEMessage):
         self.affected_sop_instance_uid = affected_sop_instance_uid
 
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.CommandField = commands[C_STORE_RQ]
         ds.MessageID = self.message_id
@@ -154,7 +295,7 @@ class C_STORE_RQ(DIMSEMessage):
             ds.MoveOriginatorMessageID = self.move_originator_message_id
         if self.move_originator_application_entity_title != None:
             ds.MoveOriginatorApplicationEntityTitle = self.move_originator_application_entity_title
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         #assert ds.AffectedSOPClassUID == self.data.SOPClassUID
@@ -178,14 +319,14 @@ class C_STORE_RSP(DIMSEMessage):
         self.status = status
         
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.CommandField = commands[C_STORE_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
         ds.CommandDataSetType = 0x0101
         ds.Status = self.status # Annex C
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
         
     def unpack(self, ds):
         assert ds.CommandField == commands[C_STORE_RSP]
@@ -203,13 +344,13 @@ class C_GET_RQ(DIMSEMessage):
         self.priority = priority
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.CommandField = commands[C_GET_RQ]
         ds.MessageID = self.message_id
         ds.Priority = self.priority
         ds.CommandDataSetType = 0x01
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -234,7 +375,7 @@ class C_GET_RSP(DIMSEMessage):
         self.number_of_warning_sub_operations = number_of_warning_sub_operations
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.CommandField = commands[C_GET_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
@@ -248,7 +389,7 @@ class C_GET_RSP(DIMSEMessage):
             ds.NumberofFailedSuboperations = self.number_of_failed_sub_operations
         if self.number_of_warning_sub_operations != None:
             ds.NumberofWarningSuboperations = self.number_of_warning_sub_operations
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -269,13 +410,13 @@ class C_FIND_RQ(DIMSEMessage):
         self.affected_sop_class_uid = affected_sop_class_uid
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.CommandField = commands[C_FIND_RQ]
         ds.MessageID = self.message_id
         ds.Priority = self.priority
         ds.CommandDataSetType = 0x01
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.message_id = ds.MessageID
@@ -294,13 +435,13 @@ class C_FIND_RSP(DIMSEMessage):
         self.status = status
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.CommandField = commands[C_FIND_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.Status = self.status
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -318,14 +459,14 @@ class C_MOVE_RQ(DIMSEMessage):
         self.move_destination = move_destination
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.CommandField = commands[C_MOVE_RQ]
         ds.MessageID = self.message_id
         ds.Priority = self.priority
         ds.CommandDataSetType = 0x01
         ds.MoveDestination = self.move_destination
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.message_id = ds.MessageID
@@ -351,7 +492,7 @@ class C_MOVE_RSP(DIMSEMessage):
         self.number_of_warning_sub_operations = number_of_warning_sub_operations
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.CommandField = commands[C_MOVE_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
@@ -361,7 +502,7 @@ class C_MOVE_RSP(DIMSEMessage):
         ds.NumberofCompletedSuboperations = self.number_of_completed_sub_operations
         ds.NumberofFailedSuboperations = self.number_of_failed_sub_operations
         ds.NumberofWarningSuboperations = self.number_of_warning_sub_operations
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -380,18 +521,18 @@ class C_ECHO_RQ(DIMSEMessage):
         self.message_id = message_id
 
     def pack(self):
-        ds = dicom.dataset.Dataset()
-        sop_class_uid = get_uid("Verification SOP Class")
+        ds = CommandSet()
+        sop_class_uid = uids.VerificationSOPClass
         ds.AffectedSOPClassUID = sop_class_uid
         ds.CommandField = commands[C_ECHO_RQ]
         ds.MessageID = self.message_id
         ds.CommandDataSetType = 0x0101
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         assert ds.CommandField == commands[C_ECHO_RQ]
         assert ds.CommandDataSetType == 0x0101
-        assert ds.AffectedSOPClassUID == get_uid("Verification SOP Class")
+        assert ds.AffectedSOPClassUID == uids.VerificationSOPClass
         self.message_id = ds.MessageID
 
 class C_ECHO_RSP(DIMSEMessage):
@@ -401,19 +542,19 @@ class C_ECHO_RSP(DIMSEMessage):
         self.status = status
 
     def pack(self):
-        ds = dicom.dataset.Dataset()
-        sop_class_uid = get_uid("Verification SOP Class")
+        ds = CommandSet()
+        sop_class_uid = uids.VerificationSOPClass
         ds.AffectedSOPClassUID = sop_class_uid
         ds.CommandField = commands[C_ECHO_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
         ds.CommandDataSetType = 0x0101
         ds.Status = self.status
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         assert ds.CommandField == commands[C_ECHO_RSP]
         assert ds.CommandDataSetType == 0x0101
-        assert ds.AffectedSOPClassUID == get_uid("Verification SOP Class")
+        assert ds.AffectedSOPClassUID == uids.VerificationSOPClass
         self.status = ds.Status
         self.message_id_being_responded_to = ds.MessageIDBeingRespondedTo
 
@@ -429,14 +570,14 @@ class N_EVENT_REPORT_RQ(DIMSEMessage):
         self.event_type_id = event_type_id
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.CommandField = commands[N_EVENT_REPORT_RQ]
         ds.MessageID = self.message_id
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
         ds.EventTypeID = self.event_type_id
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.message_id = ds.MessageID
@@ -458,7 +599,7 @@ class N_EVENT_REPORT_RSP(DIMSEMessage):
         self.event_type_id = event_type_id
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
         ds.CommandField = commands[N_EVENT_REPORT_RSP]
@@ -466,7 +607,7 @@ class N_EVENT_REPORT_RSP(DIMSEMessage):
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.Status = self.status
         ds.EventTypeID = self.event_type_id
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -485,13 +626,13 @@ class N_GET_RQ(DIMSEMessage):
         self.message_id = message_id
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.CommandField = commands[N_GET_RQ]
         ds.MessageID = self.message_id
         ds.CommandDataSetType = 0x0101
         ds.RequestedSOPClassUID = self.requested_sop_class_uid
         ds.RequestedSOPInstanceUID = self.requested_sop_instance_uid
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.message_id = ds.MessageID
@@ -511,14 +652,14 @@ class N_GET_RSP(DIMSEMessage):
         self.status = status
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
         ds.CommandField = commands[N_GET_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.Status = self.status
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -536,13 +677,13 @@ class N_SET_RQ(DIMSEMessage):
         self.message_id = message_id
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.CommandField = commands[N_SET_RQ]
         ds.MessageID = self.message_id
         ds.CommandDataSetType = 0x01
         ds.RequestedSOPClassUID = self.requested_sop_class_uid
         ds.RequestedSOPInstanceUID = self.requested_sop_instance_uid
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.message_id = ds.MessageID
@@ -562,14 +703,14 @@ class N_SET_RSP(DIMSEMessage):
         self.status = status
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
         ds.CommandField = commands[N_SET_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.Status = self.status
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -591,14 +732,14 @@ class N_ACTION_RQ(DIMSEMessage):
         self.action_type_id = action_type_id
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.CommandField = commands[N_ACTION_RQ]
         ds.MessageID = self.message_id
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.RequestedSOPClassUID = self.requested_sop_class_uid
         ds.RequestedSOPInstanceUID = self.requested_sop_instance_uid
         ds.ActionTypeID = self.action_type_id
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.message_id = ds.MessageID
@@ -620,7 +761,7 @@ class N_ACTION_RSP(DIMSEMessage):
         self.action_type_id = action_type_id
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
         ds.CommandField = commands[N_ACTION_RSP]
@@ -628,7 +769,7 @@ class N_ACTION_RSP(DIMSEMessage):
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.Status = self.status
         ds.ActionTypeID = self.action_type_id
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -649,13 +790,13 @@ class N_CREATE_RQ(DIMSEMessage):
         self.data_set_present = data_set_present
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.CommandField = commands[N_CREATE_RQ]
         ds.MessageID = self.message_id
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.message_id = ds.MessageID
@@ -675,14 +816,14 @@ class N_CREATE_RSP(DIMSEMessage):
         self.status = status
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
         ds.CommandField = commands[N_CREATE_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
         ds.CommandDataSetType = 0x01 if self.data_set_present else 0x0101
         ds.Status = self.status
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -700,13 +841,13 @@ class N_DELETE_RQ(DIMSEMessage):
         self.message_id = message_id
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.CommandField = commands[N_DELETE_RQ]
         ds.MessageID = self.message_id
         ds.CommandDataSetType = 0x0101
         ds.RequestedSOPClassUID = self.requested_sop_class_uid
         ds.RequestedSOPInstanceUID = self.requested_sop_instance_uid
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.message_id = ds.MessageID
@@ -725,14 +866,14 @@ class N_DELETE_RSP(DIMSEMessage):
         self.status = status
     
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.AffectedSOPClassUID = self.affected_sop_class_uid
         ds.AffectedSOPInstanceUID = self.affected_sop_instance_uid
         ds.CommandField = commands[N_DELETE_RSP]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
         ds.CommandDataSetType = 0x0101
         ds.Status = self.status
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         self.affected_sop_class_uid = ds.AffectedSOPClassUID
@@ -748,11 +889,11 @@ class C_CANCEL_RQ(DIMSEMessage):
         self.message_id_being_responded_to = message_id_being_responded_to
 
     def pack(self):
-        ds = dicom.dataset.Dataset()
+        ds = CommandSet()
         ds.CommandField = commands[C_CANCEL_RQ]
         ds.MessageIDBeingRespondedTo = self.message_id_being_responded_to
         ds.CommandDataSetType = 0x0101
-        return pack_dataset_with_commandgrouplength(ds)
+        return pack_command_set(ds)
 
     def unpack(self, ds):
         assert ds.CommandField == commands[C_CANCEL_RQ]
@@ -21,8 +21,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from twisteddicom import pdu, dimse, dimsemessages, sockhandler, upper_layer
-from twisteddicom.utils import get_uid
+from twisteddicom import pdu, dimse, dimsemessages, sockhandler, upper_layer, uids
 from twisted.python import log
 
 sockhandler.do_log = True
@@ -32,7 +31,7 @@ dimse.do_log = True
 
 class EchoSCU(dimse.DIMSEProtocol):
     def __init__(self):
-        super(EchoSCU, self).__init__(supported_abstract_syntaxes = [get_uid("Verification SOP Class")])
+        super(EchoSCU, self).__init__(supported_abstract_syntaxes = [uids.VerificationSOPClass])
         self.received_c_echo_rsp = False
 
     def A_ASSOCIATE_confirmation_accept_indicated(self, a_associate_ac):
@@ -22,68 +22,71 @@
 # SOFTWARE.
 
 import dicom
-from twisteddicom import dimse, dimsemessages
-from twisteddicom.utils import get_uid, match_dataset
+from twisteddicom import dimse, dimsemessages, uids
+from twisteddicom.index import Index
+from twisteddicom.indexer import Indexer
+from twisteddicom.utils import compile_query, read_header
 from twisted.python import log
 import os
 import glob
 
 class FindSCP(dimse.DIMSEProtocol):
-    def __init__(self, folder):
+    def __init__(self, folder, index = None):
         super(FindSCP, self).__init__(supported_abstract_syntaxes = [
-                                        get_uid("Patient Root Query/Retrieve Information Model - FIND"),
-                                        get_uid("Study Root Query/Retrieve Information Model - FIND"),
-                                        get_uid("Patient/Study Only Query/Retrieve Information Model  - FIND"),
-                                        get_uid("Modality Worklist Information Model - FIND"),
-                                        get_uid("Verification SOP Class"),
+                                        uids.PatientRootQueryRetrieveInformationModelFIND,
+                                        uids.StudyRootQueryRetrieveInformationModelFIND,
+                                        uids.PatientStudyOnlyQueryRetrieveInformationModelFIND,
+                                        uids.ModalityWorklistInformationModelFIND,
+                                        uids.VerificationSOPClass,
                                       ])
         self.folder = folder
+        self.index = index
 
-    def C_ECHO_RQ_received(self, presentation_context_id, echo_rq, dimse_data):
-        log.msg("received DIMSE command %s on presentation context %i" % (echo_rq, presentation_context_id))
-        assert echo_rq.__class__ == dimsemessages.C_ECHO_RQ
-        log.msg("replying")
-        self.send_DIMSE_command(presentation_context_id, dimsemessages.C_ECHO_RSP(echo_rq.message_id))
-
-    def C_FIND_RQ_received(self, presentation_context_id, find_rq, query):
-        log.msg("received %s on presentation context %i" % (find_rq, presentation_context_id))
-
-        log.msg("%s" % query)
+    def find(self, query):
+        """Yield the result data sets matching the C-FIND identifier query.
+        Files are read, so respond_to_find() iterates it in threads."""
+        if self.index != None:
+            for result_ds in self.index.find(query):
+                yield result_ds
+            return
 
+        matcher = compile_query(query)
         for f in glob.glob(os.path.join(self.folder, "*.dcm*")):
             try:
-                ds = dicom.read_file(f)
+                ds = read_header(f)
             except dicom.filereader.InvalidDicomError, e:
                 log.err(e)
                 continue
             
-            is_match, result_ds = match_dataset(query, ds)
+            is_match, result_ds = matcher.match(ds)
             if not is_match:
                 continue
-            self.send_DIMSE_command(presentation_context_id,
-                                    dimsemessages.C_FIND_RSP(status = 0xff00,
-                                                             message_id_being_responded_to = find_rq.message_id,
-                                                             affected_sop_class_uid = find_rq.affected_sop_class_uid,
-                                                             data_set_present = True),
-                                    result_ds)
-            
+            yield result_ds
 
+    def C_ECHO_RQ_received(self, presentation_context_id, echo_rq, dimse_data):
+        log.msg("received DIMSE command %s on presentation context %i" % (echo_rq, presentation_context_id))
+        assert echo_rq.__class__ == dimsemessages.C_ECHO_RQ
+        log.msg("replying")
+        self.send_DIMSE_command(presentation_context_id, dimsemessages.C_ECHO_RSP(echo_rq.message_id))
+
+    def C_FIND_RQ_received(self, presentation_context_id, find_rq, query):
+        log.msg("received %s on presentation context %i" % (find_rq, presentation_context_id))
+
+        log.msg("%s" % query)
 
-        self.send_DIMSE_command(presentation_context_id, 
-                                dimsemessages.C_FIND_RSP(status = 0, 
-                                                         message_id_being_responded_to = find_rq.message_id,
-                                                         affected_sop_class_uid = find_rq.affected_sop_class_uid))
+        self.respond_to_find(presentation_context_id, find_rq, self.find(query))
 
 from twisted.internet import reactor
 from twisted.internet.protocol import Factory
 from twisted.internet.endpoints import TCP4ServerEndpoint
 
 class FindSCPFactory(Factory, object):
-    def __init__(self, folder):
+    def __init__(self, folder, index = None):
         super(FindSCPFactory, self).__init__()
         self.folder = folder
+        self.index = index
     def buildProtocol(self, addr):
-        protocol = FindSCP(folder = self.folder)
+        protocol = FindSCP(folder = self.folder, index = self.index)
         return protocol
 
 def gotProtocol(p):
@@ -93,10 +96,14 @@ def gotProtocol(p):
 if __name__== '__main__':
     import sys
     log.startLogging(sys.stdout)
-    if len(sys.argv) != 3:
-        log.msg("Syntax: %s <port> <folder>" % sys.argv[0])
+    if len(sys.argv) not in (3, 4):
+        log.msg("Syntax: %s <port> <folder> [<index database>]" % sys.argv[0])
         sys.exit(1)
+    index = None
+    if len(sys.argv) == 4:
+        index = Index(sys.argv[3])
+        Indexer(index, sys.argv[2]).start()
     endpoint = TCP4ServerEndpoint(reactor, port = int(sys.argv[1]))
-    endpoint.listen(FindSCPFactory(folder = sys.argv[2]))
+    endpoint.listen(FindSCPFactory(folder = sys.argv[2], index = index))
     reactor.run()
     log.msg("reactor.run() exited")
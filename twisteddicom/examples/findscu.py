@@ -22,13 +22,12 @@
 # SOFTWARE.
 
 import dicom
-from twisteddicom import dimse, dimsemessages
-from twisteddicom.utils import get_uid
+from twisteddicom import dimse, dimsemessages, uids
 from twisted.python import log
 
 class FindSCU(dimse.DIMSEProtocol):
     def __init__(self, tags):
-        super(FindSCU, self).__init__(supported_abstract_syntaxes = [get_uid("Patient Root Query/Retrieve Information Model - FIND")])
+        super(FindSCU, self).__init__(supported_abstract_syntaxes = [uids.PatientRootQueryRetrieveInformationModelFIND])
         self.query = dicom.dataset.Dataset()
         for key, value in tags.iteritems():
             setattr(self.query, key, value)
@@ -37,7 +36,7 @@ class FindSCU(dimse.DIMSEProtocol):
         super(FindSCU, self).A_ASSOCIATE_confirmation_accept_indicated(a_associate_ac)
         log.msg("indicate_A_ASSOCIATE_confirmation_accept")
         log.msg("responding with C-FIND-RQ %s." % self.query)
-        rq = dimsemessages.C_FIND_RQ(affected_sop_class_uid = get_uid("Patient Root Query/Retrieve Information Model - FIND"),
+        rq = dimsemessages.C_FIND_RQ(affected_sop_class_uid = uids.PatientRootQueryRetrieveInformationModelFIND,
                                       message_id = 1)
         self.send_DIMSE_command(1, rq, self.query)
 
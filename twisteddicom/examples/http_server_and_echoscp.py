@@ -21,8 +21,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from twisteddicom import dimse, dimsemessages
-from twisteddicom.utils import get_uid
+from twisteddicom import dimse, dimsemessages, uids
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet.protocol import Factory
@@ -30,7 +29,7 @@ from twisted.internet.endpoints import TCP4ServerEndpoint
 
 class EchoSCP(dimse.DIMSEProtocol):
     def __init__(self):
-        super(EchoSCP, self).__init__(supported_abstract_syntaxes = [get_uid("Verification SOP Class")])
+        super(EchoSCP, self).__init__(supported_abstract_syntaxes = [uids.VerificationSOPClass])
      
     def C_ECHO_RQ_received(self, presentation_context_id, echo_rq, dimse_data):
         log.msg("received DIMSE command %s on presentation context %i" % (echo_rq, presentation_context_id))
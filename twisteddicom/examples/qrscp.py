@@ -22,46 +22,48 @@
 # SOFTWARE.
 
 import dicom
-from twisteddicom import dimse, dimsemessages
-import storescu
-from twisteddicom.utils import get_uid, match_dataset, get_level_identifier
+from twisteddicom import dimse, dimsemessages, uids
+from twisteddicom.index import Index
+from twisteddicom.indexer import Indexer
+from twisteddicom import store
+from twisteddicom.utils import compile_query, get_level_identifier, read_header
 from twisted.python import log
 import os
 import glob
 import json
 
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 from twisted.internet.protocol import Factory
 from twisted.internet.endpoints import TCP4ServerEndpoint
 
 class QRSCP(dimse.DIMSEProtocol):
-    def __init__(self, folder, move_destinations):
+    def __init__(self, folder, move_destinations, index = None, limiter = None):
         super(QRSCP, self).__init__(supported_abstract_syntaxes = [
-                                        get_uid("Patient Root Query/Retrieve Information Model - FIND"),
-                                        get_uid("Patient Root Query/Retrieve Information Model - MOVE"),
-                                        get_uid("Study Root Query/Retrieve Information Model - FIND"),
-                                        get_uid("Study Root Query/Retrieve Information Model - MOVE"),
-                                        get_uid("Verification SOP Class")])
+                                        uids.PatientRootQueryRetrieveInformationModelFIND,
+                                        uids.PatientRootQueryRetrieveInformationModelMOVE,
+                                        uids.StudyRootQueryRetrieveInformationModelFIND,
+                                        uids.StudyRootQueryRetrieveInformationModelMOVE,
+                                        uids.VerificationSOPClass])
         self.folder = folder
         self.move_destinations = move_destinations
-
-    def C_ECHO_RQ_received(self, presentation_context_id, echo_rq, dimse_data):
-        log.msg("received DIMSE command %s on presentation context %i" % (echo_rq, presentation_context_id))
-        assert echo_rq.__class__ == dimsemessages.C_ECHO_RQ
-        log.msg("replying")
-        self.send_DIMSE_command(presentation_context_id, dimsemessages.C_ECHO_RSP(echo_rq.message_id))
-
-    def C_FIND_RQ_received(self, presentation_context_id, find_rq, query):
-        log.msg("received %s on presentation context %i" % (find_rq, presentation_context_id))
-
-        log.msg("%s" % query)
+        self.index = index
+        self.limiter = limiter
+
+    def find(self, query):
+        """Yield the result data sets matching the C-FIND identifier query.
+        Files are read, so respond_to_find() iterates it in threads."""
+        if self.index != None:
+            for result_ds in self.index.find(query):
+                yield result_ds
+            return
 
         level = getattr(query, "QueryRetrieveLevel", "IMAGE")
         level_ids_done = set()
         
+        matcher = compile_query(query)
         for f in glob.glob(os.path.join(self.folder, "*.dcm*")):
             try:
-                ds = dicom.read_file(f)
+                ds = read_header(f)
             except dicom.filereader.InvalidDicomError, e:
                 log.err(e)
                 continue
@@ -71,22 +73,47 @@ class QRSCP(dimse.DIMSEProtocol):
                 continue
             level_ids_done.add(level_id)
 
-            is_match, result_ds = match_dataset(query, ds)
+            is_match, result_ds = matcher.match(ds)
             if not is_match:
                 continue
-            self.send_DIMSE_command(presentation_context_id,
-                                    dimsemessages.C_FIND_RSP(status = 0xff00,
-                                                             message_id_being_responded_to = find_rq.message_id,
-                                                             affected_sop_class_uid = find_rq.affected_sop_class_uid,
-                                                             data_set_present = True),
-                                    result_ds)
-            
+            yield result_ds
 
+    def files_to_move(self, query):
+        """Return the paths of the files matching the C-MOVE identifier
+        query. Called in a thread, as it reads the folder or the index;
+        the files themselves are read when they are sent."""
+        if self.index != None:
+            return self.index.files(query)
 
-        self.send_DIMSE_command(presentation_context_id, 
-                                dimsemessages.C_FIND_RSP(status = 0, 
-                                                         message_id_being_responded_to = find_rq.message_id,
-                                                         affected_sop_class_uid = find_rq.affected_sop_class_uid))
+        paths = []
+        
+        matcher = compile_query(query)
+        for f in glob.glob(os.path.join(self.folder, "*.dcm*")):
+            try:
+                ds = read_header(f)
+            except dicom.filereader.InvalidDicomError, e:
+                log.err(e)
+                continue
+
+            is_match, result_ds = matcher.match(ds)
+            if not is_match:
+                continue
+
+            paths.append(f)
+        return paths
+
+    def C_ECHO_RQ_received(self, presentation_context_id, echo_rq, dimse_data):
+        log.msg("received DIMSE command %s on presentation context %i" % (echo_rq, presentation_context_id))
+        assert echo_rq.__class__ == dimsemessages.C_ECHO_RQ
+        log.msg("replying")
+        self.send_DIMSE_command(presentation_context_id, dimsemessages.C_ECHO_RSP(echo_rq.message_id))
+
+    def C_FIND_RQ_received(self, presentation_context_id, find_rq, query):
+        log.msg("received %s on presentation context %i" % (find_rq, presentation_context_id))
+
+        log.msg("%s" % query)
+
+        self.respond_to_find(presentation_context_id, find_rq, self.find(query))
 
     def C_MOVE_RQ_received(self, presentation_context_id, move_rq, query):
         log.msg("received %s on presentation context %i" % (move_rq, presentation_context_id))
@@ -107,56 +134,10 @@ class QRSCP(dimse.DIMSEProtocol):
         move_rq.n_complete_suboperations = 0
         move_rq.n_failed_suboperations = 0
 
-        ds_to_send = []
-        
-        for f in glob.glob(os.path.join(self.folder, "*.dcm*")):
-            #print f
-            try:
-                ds = dicom.read_file(f)
-            except dicom.filereader.InvalidDicomError, e:
-                log.err(e)
-                continue
-
-            is_match, result_ds = match_dataset(query, ds)
-            if not is_match:
-                continue
-
-            move_rq.n_total_suboperations += 1
-            ds_to_send.append(ds)
-
-        def progress_callback(store_rsp):
-            move_rq.n_complete_suboperations += 1
-            if store_rsp.status != 0:
-                move_rq.n_failed_suboperations += 1
-            if move_rq.n_total_suboperations != move_rq.n_complete_suboperations:
-                self.send_DIMSE_command(presentation_context_id,
-                                        dimsemessages.C_MOVE_RSP(
-                                            status = 0xff00,
-                                            message_id_being_responded_to = move_rq.message_id,
-                                            affected_sop_class_uid = move_rq.affected_sop_class_uid,
-                                            number_of_remaining_sub_operations = (
-                                                move_rq.n_total_suboperations - move_rq.n_complete_suboperations - move_rq.n_failed_suboperations),
-                                            number_of_completed_sub_operations = move_rq.n_complete_suboperations,
-                                            number_of_failed_sub_operations = move_rq.n_failed_suboperations,
-                                            number_of_warning_sub_operations = 0))
-        def final_callback(status):
-            self.send_DIMSE_command(
-                presentation_context_id, 
-                dimsemessages.C_MOVE_RSP(
-                    status = 0, 
-                    message_id_being_responded_to = move_rq.message_id,
-                    affected_sop_class_uid = move_rq.affected_sop_class_uid,
-                    number_of_remaining_sub_operations = (
-                        move_rq.n_total_suboperations - move_rq.n_complete_suboperations - move_rq.n_failed_suboperations),
-                        number_of_completed_sub_operations = move_rq.n_complete_suboperations,
-                        number_of_failed_sub_operations = move_rq.n_failed_suboperations,
-                        number_of_warning_sub_operations = 0))
-            
-        def errback(status):
-            move_rq.n_failed_suboperations += 1
+        def send_move_rsp(status):
             self.send_DIMSE_command(presentation_context_id,
                                     dimsemessages.C_MOVE_RSP(
-                                        status = 0xff00,
+                                        status = status,
                                         message_id_being_responded_to = move_rq.message_id,
                                         affected_sop_class_uid = move_rq.affected_sop_class_uid,
                                         number_of_remaining_sub_operations = (
@@ -164,29 +145,76 @@ class QRSCP(dimse.DIMSEProtocol):
                                         number_of_completed_sub_operations = move_rq.n_complete_suboperations,
                                         number_of_failed_sub_operations = move_rq.n_failed_suboperations,
                                         number_of_warning_sub_operations = 0))
-                
-
-        # send dataset to movedest
-        d = storescu.store(datasets = ds_to_send, 
-                           host = movedest['host'], 
-                           port = movedest['port'], 
-                           calling_ae_title = movedest['calling_ae_title'], 
-                           called_ae_title = movedest['called_ae_title'],
-                           priority = move_rq.priority,
-                           move_originator_application_entity_title = self.calling_ae_title,
-                           move_originator_message_id = move_rq.message_id,
-                           progress_callback = progress_callback)
-
-        d.addCallback(final_callback)
-        d.addErrback(errback)
+
+        # The sub-operations of all associations are reported in one
+        # stream of C-MOVE-RSPs.
+        def progress_callback(store_rsp):
+            # store_rsp is None if the file could not be read or stored
+            if store_rsp != None and store_rsp.status == 0:
+                move_rq.n_complete_suboperations += 1
+            else:
+                move_rq.n_failed_suboperations += 1
+            if move_rq.n_total_suboperations != move_rq.n_complete_suboperations + move_rq.n_failed_suboperations:
+                send_move_rsp(0xff00)
+
+        def final_callback(status):
+            if move_rq.n_failed_suboperations == 0:
+                send_move_rsp(0)
+            else:
+                # Sub-operations complete - One or more Failures
+                send_move_rsp(0xB000)
+            
+        def errback(failure):
+            log.err(failure, "Could not associate with %s" % (move_rq.move_destination,))
+            move_rq.n_failed_suboperations = move_rq.n_total_suboperations - move_rq.n_complete_suboperations
+            # Unable to perform sub-operations
+            send_move_rsp(0xA702)
+
+        def read_matches():
+            paths = self.files_to_move(query)
+            return paths, store.read_instances(paths)
+
+        def move(result):
+            paths, instances = result
+            move_rq.n_total_suboperations = len(paths)
+            # Files whose File Meta Information could not be read
+            move_rq.n_failed_suboperations += len(paths) - len(instances)
+            if len(instances) == 0:
+                final_callback(None)
+                return
+            for instance in instances:
+                instance.deferred.addCallbacks(progress_callback, lambda failure: progress_callback(None))
+            d = store.store(instances,
+                            host = movedest['host'], 
+                            port = movedest['port'], 
+                            calling_ae_title = movedest['calling_ae_title'], 
+                            called_ae_title = movedest['called_ae_title'],
+                            priority = move_rq.priority,
+                            move_originator_application_entity_title = self.calling_ae_title,
+                            move_originator_message_id = move_rq.message_id,
+                            parallelism = movedest.get('max_associations', 1),
+                            limiter = self.limiter)
+            d.addCallbacks(final_callback, errback)
+
+        # The matching and the File Meta Information reads are done
+        # in a thread
+        d = threads.deferToThread(read_matches)
+        d.addCallback(move)
+        d.addErrback(log.err)
         
 class QRSCPFactory(Factory, object):
-    def __init__(self, folder, move_destinations):
+    def __init__(self, folder, move_destinations, index = None):
         super(QRSCPFactory, self).__init__()
         self.folder = folder
         self.move_destinations = move_destinations
+        self.index = index
+        # At most max_associations (default 1) associations at a time to
+        # each move destination, over all C-MOVEs
+        self.limiter = store.AssociationLimiter(limits = dict(((movedest['host'], movedest['port']), movedest.get('max_associations', 1))
+                                                        for movedest in move_destinations.itervalues()))
     def buildProtocol(self, addr):
-        protocol = QRSCP(folder = self.folder, move_destinations = self.move_destinations)
+        protocol = QRSCP(folder = self.folder, move_destinations = self.move_destinations, index = self.index,
+                         limiter = self.limiter)
         return protocol
 
 def gotProtocol(p):
@@ -196,10 +224,14 @@ def gotProtocol(p):
 if __name__== '__main__':
     import sys
     log.startLogging(sys.stdout)
-    if len(sys.argv) != 3:
-        log.msg("Syntax: %s <port> <folder>" % sys.argv[0])
+    if len(sys.argv) not in (3, 4):
+        log.msg("Syntax: %s <port> <folder> [<index database>]" % sys.argv[0])
         sys.exit(1)
+    index = None
+    if len(sys.argv) == 4:
+        index = Index(sys.argv[3])
+        Indexer(index, sys.argv[2]).start()
     endpoint = TCP4ServerEndpoint(reactor, port = int(sys.argv[1]))
-    endpoint.listen(QRSCPFactory(folder = sys.argv[2], move_destinations = json.load(file("move_destinations.json"))))
+    endpoint.listen(QRSCPFactory(folder = sys.argv[2], move_destinations = json.load(file("move_destinations.json")), index = index))
     reactor.run()
     log.msg("reactor.run() exited")
@@ -23,8 +23,9 @@
 
 import dicom
 from twisteddicom import dimse, dimsemessages
-from twisted.python import log
-from twisteddicom.utils import generate_uid
+from twisted.python import log, failure
+from twisted.internet import threads
+from twisteddicom.utils import write_part10
 
 supported_abstract_syntaxes = [
     '1.2.840.10008.1.1', # Verification SOP Class
@@ -109,7 +110,29 @@ supported_abstract_syntaxes = [
     '1.2.840.10008.5.1.4.38.1', # Hanging Protocol Storage
     ]
 
+def _stop_after_modality(tag, VR, length):
+    return tag > 0x00080060
+
+def write_received(store_rq, dimse_data):
+    """Write a received data set as <Modality>_<SOPInstanceUID>.dcm. Only
+    the start of the data set is decoded, to find the Modality. Runs in a
+    thread."""
+    try:
+        ts = dimse_data.transfer_syntax
+        ds = dicom.filereader.read_dataset(dimse_data.open(), dimsemessages.is_implicit_VR(ts), 
+                                           dimsemessages.is_little_endian(ts), stop_when = _stop_after_modality)
+        write_part10("%s_%s.dcm" % (getattr(ds, 'Modality', 'XX'), store_rq.affected_sop_instance_uid), dimse_data, 
+                     store_rq.affected_sop_class_uid, store_rq.affected_sop_instance_uid)
+    finally:
+        dimse_data.close()
+
 class StoreSCP(dimse.DIMSEProtocol):
+    # Write received data sets to disk as they are, without decoding them.
+    raw_dataset_commands = (dimsemessages.C_STORE_RQ,)
+    # Each C-STORE-RQ is answered as soon as its file is written, so any
+    # number of them may be outstanding.
+    maximum_number_operations_performed = 0
+
     def __init__(self):
         super(StoreSCP, self).__init__(supported_abstract_syntaxes = supported_abstract_syntaxes)
 
@@ -122,25 +145,21 @@ class StoreSCP(dimse.DIMSEProtocol):
     def C_STORE_RQ_received(self, presentation_context_id, store_rq, dimse_data):
         log.msg("received DIMSE command %s" % store_rq)
         assert store_rq.__class__ == dimsemessages.C_STORE_RQ
-        log.msg("replying to %s" % store_rq)
-        status = 0
-        try:
-            dimse_data.file_meta = dicom.dataset.Dataset()
-            dimse_data.file_meta.TransferSyntaxUID = dicom.UID.ImplicitVRLittleEndian
-            dimse_data.file_meta.MediaStorageSOPClassUID = dimse_data.SOPClassUID
-            dimse_data.file_meta.MediaStorageSOPInstanceUID = generate_uid()
-            dimse_data.is_little_endian = True
-            dimse_data.is_implicit_VR = True
-            dimse_data.file_meta.ImplementationClassUID = '2.25.4282708245307149051252828097685724107'
-            dicom.write_file("%s_%s.dcm" % (getattr(dimse_data, 'Modality', 'XX'), dimse_data.SOPInstanceUID), dimse_data, WriteLikeOriginal=False)
-        except Exception, e:
-            log.err(e)
-            status = 1
-        rsp = dimsemessages.C_STORE_RSP(message_id_being_responded_to = store_rq.message_id,
-                                        affected_sop_class_uid = store_rq.affected_sop_class_uid,
-                                        affected_sop_instance_uid = store_rq.affected_sop_instance_uid, 
-                                        status=status)
-        self.send_DIMSE_command(presentation_context_id, rsp)
+        def written(result):
+            status = 0
+            if isinstance(result, failure.Failure):
+                log.err(result)
+                status = 1
+            log.msg("replying to %s" % store_rq)
+            rsp = dimsemessages.C_STORE_RSP(message_id_being_responded_to = store_rq.message_id,
+                                            affected_sop_class_uid = store_rq.affected_sop_class_uid,
+                                            affected_sop_instance_uid = store_rq.affected_sop_instance_uid, 
+                                            status=status)
+            if self.state == 6:
+                self.send_DIMSE_command(presentation_context_id, rsp)
+        d = threads.deferToThread(write_received, store_rq, dimse_data)
+        d.addBoth(written)
+        d.addErrback(log.err)
 
 
 from twisted.internet import reactor
@@ -20,66 +20,83 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-
-import dicom
-from twisteddicom import dimse, dimsemessages
+import twisteddicom.store
+from twisteddicom import uids
+from twisteddicom.store import Instance, InstanceLoader, read_instance
 from twisteddicom.dimsemessages import Priority
 from twisted.python import log
-from twisted.internet import reactor, defer
+from twisted.internet import reactor
 from twisted.internet.protocol import Factory
-from twisted.internet.endpoints import TCP4ClientEndpoint
 
-class StoreSCU(dimse.DIMSEProtocol):
-    def __init__(self, datasets, callback, progress_callback, priority = Priority.LOW, move_originator_application_entity_title = None, move_originator_message_id = None):
-        super(StoreSCU, self).__init__(supported_abstract_syntaxes = list(set(ds.SOPClassUID for ds in datasets)),
-                                       supported_transfer_syntaxes = list(set(ds.file_meta.TransferSyntaxUID for ds in datasets)))
-        self.datasets = datasets
-        self.callback = callback
+# StoreSCU, StoreSCUFactory and store() are kept for code written against
+# earlier versions of this example. They are thin wrappers of
+# twisteddicom.store, which new code should use directly.
+
+class _DatasetLoader(InstanceLoader):
+    """Hands out the data sets of Instances made from data sets in memory."""
+    def load(self, instance):
+        return instance, instance.dataset
+
+def _instances(datasets, sop_classes, progress_callback):
+    """Return the Instances, and their InstanceLoader, of datasets, a list
+    of data sets, or with sop_classes a list of file names."""
+    instances = []
+    if sop_classes != None:
+        for path in datasets:
+            try:
+                instances.append(read_instance(path))
+            except Exception:
+                log.err(None, "Could not read %s" % (path,))
+                if progress_callback != None:
+                    progress_callback(None)
+        return instances, InstanceLoader(instances)
+    for ds in datasets:
+        file_meta = getattr(ds, 'file_meta', None)
+        instance = Instance(None, str.__str__(ds.SOPClassUID), str.__str__(ds.SOPInstanceUID),
+                            getattr(file_meta, 'TransferSyntaxUID', uids.ImplicitVRLittleEndian))
+        instance.dataset = ds
+        instances.append(instance)
+    return instances, _DatasetLoader(instances)
+
+class _Progress(object):
+    """Pass the C-STORE-RSP of each instance to progress_callback, or None
+    if it could not be read or stored, and keep the last status."""
+    def __init__(self, instances, progress_callback):
         self.progress_callback = progress_callback
         self.status = None
-        self.move_originator_message_id = move_originator_message_id
-        self.move_originator_application_entity_title = move_originator_application_entity_title
-        self.priority = priority
-        self.next_message_id = 1
-    
-    def A_ASSOCIATE_confirmation_accept_indicated(self, a_associate_ac):
-        super(StoreSCU, self).A_ASSOCIATE_confirmation_accept_indicated(a_associate_ac)
-        log.msg("indicate_A_ASSOCIATE_confirmation_accept")
-        log.msg("responding with C-STORE-RQ.")
-        self.store_one()
+        for instance in instances:
+            instance.deferred.addCallbacks(self.stored, self.failed, errbackArgs = (instance,))
 
-    def store_one(self):
-        if len(self.datasets) == 0:
-            log.msg("requesting release")
-            self.A_RELEASE_request_received()
-        else:
-            log.msg("storing one more dataset...")
-            ds = self.datasets.pop()
-            rq = dimsemessages.C_STORE_RQ(affected_sop_class_uid = ds.SOPClassUID,
-                                          affected_sop_instance_uid = ds.SOPInstanceUID, 
-                                          move_originator_application_entity_title = self.move_originator_application_entity_title,
-                                          move_originator_message_id = self.move_originator_message_id,
-                                          priority = self.priority,
-                                          message_id = self.next_message_id)
-            self.next_message_id += 1
-            self.send_DIMSE_command(1, rq, ds)
+    def stored(self, rsp):
+        log.msg("C_STORE_RSP: status %s" % rsp.status)
+        self.status = rsp.status
+        if self.progress_callback != None:
+            self.progress_callback(rsp)
 
-    def C_STORE_RSP_received(self, presentation_context_id, dimse_command, dimse_data):
-        log.msg("C_STORE_RSP: status %s" % dimse_command.status)
-        self.status = dimse_command.status
-        self.store_one()
+    def failed(self, failure, instance):
+        log.err(failure, "Could not store %s" % (instance,))
         if self.progress_callback != None:
-            self.progress_callback(dimse_command)
+            self.progress_callback(None)
 
-    def conn_closed_received(self):
-        super(StoreSCU, self).conn_closed_received()
-        self.callback(self.status)
+class StoreSCU(twisteddicom.store.StoreSCU):
+    def __init__(self, datasets, callback, progress_callback, priority = Priority.LOW, move_originator_application_entity_title = None, move_originator_message_id = None,
+                 sop_classes = None):
+        """datasets is a list of data sets, or with sop_classes a list of
+        file names. callback is called with the status of the last
+        C-STORE-RSP when the association is closed."""
+        instances, loader = _instances(datasets, sop_classes, progress_callback)
+        super(StoreSCU, self).__init__(instances, loader = loader, priority = priority, 
+                                       move_originator_application_entity_title = move_originator_application_entity_title,
+                                       move_originator_message_id = move_originator_message_id)
+        self.progress = _Progress(instances, progress_callback)
+        self.deferred.addCallback(lambda ignored: callback(self.progress.status))
 
 class StoreSCUFactory(Factory, object):
     def __init__(self, calling_ae_title, called_ae_title, datasets, callback, progress_callback,
                  priority = Priority.LOW, 
                  move_originator_message_id = None, 
-                 move_originator_application_entity_title = None):
+                 move_originator_application_entity_title = None,
+                 sop_classes = None):
         super(StoreSCUFactory, self).__init__()
         self.called_ae_title = called_ae_title
         self.calling_ae_title = calling_ae_title
@@ -89,26 +106,37 @@ class StoreSCUFactory(Factory, object):
         self.move_originator_message_id = move_originator_message_id
         self.callback = callback
         self.progress_callback = progress_callback
+        self.sop_classes = sop_classes
     def buildProtocol(self, addr):
         protocol = StoreSCU(datasets = self.datasets, 
                             priority = self.priority, 
                             move_originator_message_id = self.move_originator_message_id, 
                             move_originator_application_entity_title = self.move_originator_application_entity_title, 
                             callback = self.callback,
-                            progress_callback = self.progress_callback)
+                            progress_callback = self.progress_callback,
+                            sop_classes = self.sop_classes)
         protocol.calling_ae_title = self.calling_ae_title
         protocol.called_ae_title = self.called_ae_title
         protocol.A_ASSOCIATE_request_received()
         return protocol
 
-def store(datasets, host, port, calling_ae_title, called_ae_title, priority = Priority.LOW, move_originator_application_entity_title = None, move_originator_message_id = None, progress_callback = None):
-    d = defer.Deferred()
-    point = TCP4ClientEndpoint(reactor, host = host, port = port, timeout=5)
-    point.connect(StoreSCUFactory(calling_ae_title = calling_ae_title, called_ae_title = called_ae_title, 
-                                  datasets = datasets, callback = d.callback, progress_callback = progress_callback,
-                                  priority = priority, 
-                                  move_originator_message_id = move_originator_message_id, 
-                                  move_originator_application_entity_title = move_originator_application_entity_title))
+def store(datasets, host, port, calling_ae_title, called_ae_title, priority = Priority.LOW, move_originator_application_entity_title = None, move_originator_message_id = None, progress_callback = None,
+          sop_classes = None, parallelism = 1, limiter = None):
+    """Store datasets with twisteddicom.store.store().
+
+    datasets is a list of data sets, or with sop_classes a list of file
+    names. progress_callback is called with each C-STORE-RSP, or None for
+    data sets that could not be read or stored. Returns a Deferred that
+    fires with the status of the last C-STORE-RSP once all associations
+    are closed, or fails if none could be opened."""
+    instances, loader = _instances(datasets, sop_classes, progress_callback)
+    progress = _Progress(instances, progress_callback)
+    d = twisteddicom.store.store(instances, host, port, calling_ae_title, called_ae_title, 
+                                 parallelism = parallelism, limiter = limiter, priority = priority,
+                                 move_originator_application_entity_title = move_originator_application_entity_title,
+                                 move_originator_message_id = move_originator_message_id,
+                                 loader = loader)
+    d.addCallback(lambda ignored: progress.status)
     return d
 
 if __name__== '__main__':
@@ -117,7 +145,12 @@ if __name__== '__main__':
     if len(sys.argv) < 6:
         log.msg("Syntax: %s <host> <port> <calling_ae_title> <called_ae_title> <filename> [<filename> ...]" % (sys.argv[0],))
         sys.exit(1)
-    datasets = [dicom.read_file(fn, force=True) for fn in sys.argv[5:]]
-    d = store(datasets = datasets, host = sys.argv[1], port = int(sys.argv[2]), calling_ae_title = sys.argv[3], called_ae_title = sys.argv[4])
+    instances = twisteddicom.store.read_instances(sys.argv[5:])
+    for instance in instances:
+        instance.deferred.addCallbacks(
+            lambda rsp, instance = instance: log.msg("%s: status %s" % (instance.path, rsp.status)),
+            lambda failure, instance = instance: log.err(failure, "Could not store %s" % (instance.path,)))
+    d = twisteddicom.store.store(instances, host = sys.argv[1], port = int(sys.argv[2]), calling_ae_title = sys.argv[3], called_ae_title = sys.argv[4])
+    d.addErrback(log.err)
     d.addCallback(lambda x: reactor.stop())
     reactor.run()
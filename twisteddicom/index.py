@@ -0,0 +1,368 @@
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sqlite3
+import threading
+import dicom
+from twisted.python import log
+from utils import compile_query, read_header
+
+do_log = False
+
+# The attributes recorded for each query/retrieve level, see PS 3.4 C.6.1.1.
+# Each level is (level, table, unique key, attributes). The table of a level
+# also holds the unique key of the level above, linking it to its parent.
+levels = [
+    ("PATIENT", "patient", "PatientID", ["PatientName", "PatientBirthDate", "PatientSex"]),
+    ("STUDY", "study", "StudyInstanceUID", ["StudyDate", "StudyTime", "AccessionNumber", "StudyID",
+                                            "StudyDescription", "ReferringPhysicianName"]),
+    ("SERIES", "series", "SeriesInstanceUID", ["Modality", "SeriesNumber", "SeriesDescription",
+                                               "SeriesDate", "SeriesTime"]),
+    ("IMAGE", "instance", "SOPInstanceUID", ["SOPClassUID", "InstanceNumber"]),
+    ]
+
+level_depth = dict((level[0], depth) for depth, level in enumerate(levels))
+
+# Unique keys are single valued, see PS 3.4 C.2.2.1.1
+unique_keys = frozenset(level[2] for level in levels)
+
+def _to_text(value):
+    if isinstance(value, (list, tuple)):
+        return "\\".join(_to_text(x) for x in value)
+    if isinstance(value, str):
+        # Not str(), which gives the name of a dicom.UID.UID
+        return str.__str__(value)
+    return str(value)
+
+def check_dataset(ds, path):
+    """Raise ValueError if ds, read from the file path, lacks a unique key
+    needed to record it."""
+    for level, table, key, attributes in levels:
+        if level != "PATIENT" and not key in ds:
+            raise ValueError("%s has no %s" % (path, key))
+
+def _glob_escape(s):
+    return s.replace("[", "[[]")
+
+class Index(object):
+    """
+    Patient, study, series and instance attributes of a folder of DICOM
+    files, kept in SQLite.
+
+    find() answers C-FIND queries with the same results as running
+    utils.match_dataset() on every file, deduplicated on the query/retrieve
+    level. Keys held by the index are matched in SQL and checked with the
+    compiled query, any other keys are matched by reading one file of each
+    candidate. files() and instances() resolve the files to send for a
+    C-MOVE.
+
+    find(), files() and instances() query the database and may read a file
+    per candidate, so call them off the reactor thread. The results of
+    find() are read as they are iterated, which
+    DIMSEProtocol.respond_to_find() does in threads.
+
+    The index may be used from several threads. Every use of the
+    connection holds lock.
+    """
+    # Rows read by mtimes() at a time, holding lock
+    mtimes_chunk_size = 10000
+
+    def __init__(self, filename = ":memory:"):
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.db.text_factory = str
+        self.lock = threading.RLock()
+        for depth, (level, table, key, attributes) in enumerate(levels):
+            columns = ["%s TEXT PRIMARY KEY" % (key,)]
+            if depth > 0:
+                columns.append("%s TEXT" % (levels[depth - 1][2],))
+            columns.extend("%s TEXT" % (attribute,) for attribute in attributes)
+            if table == "instance":
+                columns.extend(["path TEXT UNIQUE", "mtime REAL"])
+            self.db.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table, ", ".join(columns)))
+            indexed = list(attributes)
+            if depth > 0:
+                indexed.append(levels[depth - 1][2])
+            for column in indexed:
+                self.db.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)" % (table, column, table, column))
+        self.db.execute("CREATE TABLE IF NOT EXISTS property (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def __len__(self):
+        """Number of indexed instances."""
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM instance").fetchone()[0]
+
+    def add(self, ds, path, mtime = None, commit = True):
+        """Record ds, read from the file path, replacing what was recorded for
+        the same instance or file before. With commit False, the change is
+        committed by a later commit()."""
+        check_dataset(ds, path)
+        with self.lock:
+            self.remove(path, commit = False)
+            parent = None
+            for level, table, key, attributes in levels:
+                columns = [key] + attributes
+                values = [_to_text(ds.get(key, ""))]
+                values.extend(_to_text(ds.get(attribute)) if attribute in ds else None for attribute in attributes)
+                if parent != None:
+                    columns.append(parent)
+                    values.append(_to_text(ds.get(parent, "")))
+                if table == "instance":
+                    columns.extend(["path", "mtime"])
+                    values.extend([path, mtime])
+                self.db.execute("INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), ", ".join("?" * len(columns))),
+                                values)
+                parent = key
+            if commit:
+                self.commit()
+
+    def add_file(self, path):
+        """Read the file path and record it. Return False if it is not a
+        DICOM file."""
+        try:
+            ds = read_header(path)
+            self.add(ds, path, mtime = os.path.getmtime(path))
+        except (dicom.filereader.InvalidDicomError, ValueError), e:
+            log.err(e)
+            return False
+        return True
+
+    def remove(self, path, commit = True):
+        """Forget the file path, and any series, study or patient left
+        without instances."""
+        with self.lock:
+            row = self.db.execute("SELECT SeriesInstanceUID FROM instance WHERE path = ?", (path,)).fetchone()
+            if row != None:
+                self.db.execute("DELETE FROM instance WHERE path = ?", (path,))
+                uid = row[0]
+                for depth in range(len(levels) - 2, -1, -1):
+                    level, table, key, attributes = levels[depth]
+                    child_table = levels[depth + 1][1]
+                    if self.db.execute("SELECT 1 FROM %s WHERE %s = ? LIMIT 1" % (child_table, key), (uid,)).fetchone() != None:
+                        break
+                    row = self.db.execute("SELECT %s FROM %s WHERE %s = ?" % (levels[depth - 1][2] if depth > 0 else key, table, key), (uid,)).fetchone()
+                    self.db.execute("DELETE FROM %s WHERE %s = ?" % (table, key), (uid,))
+                    if row == None:
+                        break
+                    uid = row[0]
+            if commit:
+                self.commit()
+
+    def commit(self):
+        """Commit the changes made with commit False."""
+        with self.lock:
+            self.db.commit()
+
+    def get_property(self, name, default = None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM property WHERE name = ?", (name,)).fetchone()
+        if row == None:
+            return default
+        return row[0]
+
+    def set_property(self, name, value):
+        """Store a string with the index, such as the state of an indexer."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO property (name, value) VALUES (?, ?)", (name, value))
+            self.db.commit()
+
+    def mtimes(self):
+        """Return a dict of the modification time of every indexed file.
+
+        The rows are read in chunks, so a call from another thread only
+        holds up changes to the index for one chunk at a time."""
+        mtimes = {}
+        rowid = 0
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT rowid, path, mtime FROM instance WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                       (rowid, self.mtimes_chunk_size)).fetchall()
+            for rowid, path, mtime in rows:
+                mtimes[path] = mtime
+            if len(rows) < self.mtimes_chunk_size:
+                return mtimes
+
+    def update_folder(self, folder, pattern = "*.dcm*"):
+        """Bring the index up to date with the files in folder, reading only
+        new and modified files."""
+        import glob
+        known = self.mtimes()
+        for path in glob.glob(os.path.join(folder, pattern)):
+            mtime = os.path.getmtime(path)
+            if known.pop(path, None) != mtime:
+                self.add_file(path)
+        for path in known:
+            self.remove(path)
+
+    def _join(self, depth):
+        """FROM clause joining the tables from the patient level down to depth."""
+        sql = levels[0][1]
+        for level, table, key, attributes in levels[1:depth + 1]:
+            parent_table, parent_key = levels[level_depth[level] - 1][1:3]
+            sql += " JOIN %s ON %s.%s = %s.%s" % (table, table, parent_key, parent_table, parent_key)
+        return sql
+
+    def _condition(self, column, pattern, vr, multi_valued = True):
+        """Return an SQL condition and its parameters selecting at least the
+        values matching pattern, or None.
+
+        The values of multi-valued attributes are stored separated by
+        backslashes, and match if any one of them does, like in
+        utils.QueryMatcher. Unless multi_valued is False, the condition
+        selects them too."""
+        if vr in ("LT", "ST", "UT"):
+            # Backslashes are part of the text, PS 3.5 6.2
+            multi_valued = False
+        if vr == "DA":
+            if pattern.count("-") == 1:
+                minvalue, maxvalue = pattern.split("-")
+                if minvalue == "":
+                    condition = "%s <= ?" % (column,), [maxvalue]
+                elif maxvalue == "":
+                    condition = "%s >= ?" % (column,), [minvalue]
+                else:
+                    condition = "%s BETWEEN ? AND ?" % (column,), [minvalue, maxvalue]
+            elif pattern.isdigit():
+                condition = "%s = ?" % (column,), [pattern]
+            else:
+                return None
+        elif vr in ("TM", "DT"):
+            return None
+        elif vr == "UI" and "\\" in pattern:
+            uids = pattern.split("\\")
+            condition = "%s IN (%s)" % (column, ", ".join("?" * len(uids))), uids
+        else:
+            # GLOB has the same wildcards as DICOM
+            glob = _glob_escape(pattern)
+            is_wildcard = "*" in pattern or "?" in pattern
+            if not multi_valued:
+                if is_wildcard:
+                    return "%s GLOB ?" % (column,), [glob]
+                return "%s = ?" % (column,), [pattern]
+            # The first, a middle or the last of several values
+            return ("(%s GLOB ? OR %s GLOB ? OR %s GLOB ? OR %s GLOB ?)" % ((column,) * 4),
+                    [glob, glob + "\\*", "*\\" + glob + "\\*", "*\\" + glob])
+        if multi_valued:
+            # Ranges and lists are not matched against each of several values
+            # in SQL, leave that to the compiled query
+            return "(%s OR %s GLOB ?)" % (condition[0], column), condition[1] + ["*\\*"]
+        return condition
+
+    def _matches(self, query):
+        """Yield (unique key, result data set) for every entity matching query."""
+        level = getattr(query, "QueryRetrieveLevel", "IMAGE")
+        depth = level_depth[level]
+        columns = {}
+        for level, table, key, attributes in levels[:depth + 1]:
+            for column in [key] + attributes:
+                columns[column] = "%s.%s" % (table, column)
+        level_key = levels[depth][2]
+        selected = [level_key]
+        # (column, tag, VR) of the selected attributes
+        elements = []
+        conditions = []
+        parameters = []
+        read_files = False
+        for key in query.iterkeys():
+            if key == 0x00080052: # Query/Retrieve Level
+                continue
+            if key & 0x0000ffff == 0: # Group Length
+                continue
+            if key == 0x00080005: # Specific Character set
+                continue
+            keyword = dicom.datadict.keyword_for_tag(key)
+            elem = query[key]
+            if elem.VR == "SQ" or not keyword in columns:
+                read_files = True
+                continue
+            selected.append(keyword)
+            elements.append((len(selected) - 1, key, elem.VR))
+            if elem.value == None or elem.value == "":
+                continue
+            condition = self._condition(columns[keyword], _to_text(elem.value), elem.VR, 
+                                        multi_valued = not keyword in unique_keys)
+            if condition != None:
+                conditions.append(condition[0])
+                parameters.extend(condition[1])
+        sql = "SELECT %s FROM %s" % (", ".join(columns[column] for column in selected), self._join(depth))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if do_log: log.msg("%s %s" % (sql, parameters))
+        matcher = compile_query(query)
+        with self.lock:
+            rows = self.db.execute(sql, parameters).fetchall()
+        for row in rows:
+            if read_files:
+                path = self._paths(depth, row[0], limit = 1)
+                if not path:
+                    continue
+                try:
+                    ds = read_header(path[0])
+                except (IOError, dicom.filereader.InvalidDicomError), e:
+                    log.err(e)
+                    continue
+            else:
+                ds = dicom.dataset.Dataset()
+                for column, key, vr in elements:
+                    if row[column] != None:
+                        ds.add_new(key, vr, row[column])
+            is_match, result_ds = matcher.match(ds)
+            if is_match:
+                yield row[0], result_ds
+
+    def _instances(self, depth, uid, limit = None):
+        """Return (path, SOP Class UID) of the instances below the entity
+        uid at depth."""
+        sql = "SELECT instance.path, instance.SOPClassUID FROM %s WHERE %s.%s = ?" % (
+            self._join(len(levels) - 1), levels[depth][1], levels[depth][2])
+        if limit != None:
+            sql += " LIMIT %i" % (limit,)
+        with self.lock:
+            return self.db.execute(sql, (uid,)).fetchall()
+
+    def _paths(self, depth, uid, limit = None):
+        """Return the paths of the instances below the entity uid at depth."""
+        return [path for path, sop_class_uid in self._instances(depth, uid, limit)]
+
+    def find(self, query):
+        """Yield a result data set for every entity matching the C-FIND
+        identifier query on its query/retrieve level. Files are read as
+        the results are iterated, not on the call."""
+        for uid, result_ds in self._matches(query):
+            yield result_ds
+
+    def instances(self, query):
+        """Return (path, SOP Class UID) of all instances below the entities
+        matching the C-MOVE identifier query. Nothing is read from the
+        files, so this is cheap enough to count the sub-operations of a
+        C-MOVE before any file is loaded."""
+        depth = level_depth[getattr(query, "QueryRetrieveLevel", "IMAGE")]
+        instances = []
+        for uid, result_ds in self._matches(query):
+            instances.extend(self._instances(depth, uid))
+        return instances
+
+    def files(self, query):
+        """Return the paths of all instances below the entities matching the
+        C-MOVE identifier query."""
+        return [path for path, sop_class_uid in self.instances(query)]
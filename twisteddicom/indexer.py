@@ -0,0 +1,275 @@
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import glob
+import fnmatch
+from index import check_dataset
+from utils import read_header
+from twisted.internet import defer, task, threads
+from twisted.python import failure, filepath, log, threadpool
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+do_log = False
+
+class Indexer(object):
+    """
+    Keep an index.Index up to date with the files in a folder.
+
+    Changes are picked up from inotify where it is available, and by
+    comparing the modification times of the files with the index on
+    start() and every reconcile_interval seconds. The folder is scanned
+    and only new and modified files are read in the reactor thread pool,
+    without pixel data.
+
+    Changes to the index are queued and handed in batches to a thread of
+    their own, writer, which makes and commits them: once no more files
+    are waiting to be indexed, and at least every commit_interval seconds
+    while files keep coming.
+    """
+    reconcile_interval = 60.0
+    commit_interval = 1.0
+    max_concurrent_reads = 4
+    pattern = "*.dcm*"
+
+    def __init__(self, index, folder):
+        from twisted.internet import reactor
+        self.reactor = reactor
+        self.index = index
+        self.folder = os.path.abspath(folder)
+        # path -> (time the change was seen, Deferred fired once indexed)
+        self.pending = {}
+        self.changed_again = set()
+        self.unreadable = {}
+        self.semaphore = defer.DeferredSemaphore(self.max_concurrent_reads)
+        self.notifier = None
+        self.reconcile_call = None
+        self.commit_call = None
+        self.last_lag = 0.0
+        # (Index method, arguments) of the changes not yet handed to writer,
+        # and the Deferreds to fire once they are committed
+        self.writes = []
+        self.written = []
+        # Thread pool of one thread, started on the first commit()
+        self.writer = None
+        self.writer_shutdown = None
+
+    def start(self):
+        self.notifier = self.start_notifier()
+        # Files may have been changed in place while we were not running,
+        # without changing the modification time of the folder.
+        self.reconcile_call = task.LoopingCall(self.reconcile)
+        self.reconcile_call.start(self.reconcile_interval, now = True)
+
+    def stop(self):
+        """Stop watching the folder. Returns a Deferred fired once the
+        queued changes are committed."""
+        if self.reconcile_call != None and self.reconcile_call.running:
+            self.reconcile_call.stop()
+        if self.notifier != None:
+            self.notifier.loseConnection()
+            self.notifier = None
+        d = self.commit()
+        d.addCallback(lambda ignored: self._stop_writer())
+        return d
+
+    def start_notifier(self):
+        """Watch the folder with inotify, if possible."""
+        if inotify == None:
+            return None
+        try:
+            notifier = inotify.INotify()
+        except Exception, e:
+            log.msg("inotify is not available (%s), indexing changes every %i seconds" % (e, self.reconcile_interval))
+            return None
+        notifier.startReading()
+        notifier.watch(filepath.FilePath(self.folder),
+                       mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_DELETE | inotify.IN_MOVED_FROM,
+                       callbacks = [self.notified])
+        return notifier
+
+    def notified(self, ignored, path, mask):
+        if mask & inotify.IN_Q_OVERFLOW:
+            self.reconcile()
+            return
+        if not fnmatch.fnmatch(path.basename(), self.pattern):
+            return
+        if do_log: log.msg("%s %s" % (path.path, inotify.humanReadableMask(mask)))
+        if mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+            self.changed(path.path)
+        elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.removed(path.path)
+
+    def lag(self):
+        """Seconds since the oldest change not yet in the index was seen."""
+        if not self.pending:
+            return 0.0
+        return self.reactor.seconds() - min(seen for seen, d in self.pending.itervalues())
+
+    def reconcile(self):
+        """Compare the modification times of the files in the folder with the
+        index and index what differs. Returns a Deferred fired when done."""
+        d = threads.deferToThread(self.scan)
+        d.addCallback(self._scanned)
+        return d
+
+    def scan(self):
+        """Return the (path, modification time) of the new and modified
+        files in the folder, and the paths of the removed files. Called in
+        a thread."""
+        known = self.index.mtimes()
+        changed = []
+        for path in glob.glob(os.path.join(self.folder, self.pattern)):
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if known.pop(path, None) != mtime:
+                changed.append((path, mtime))
+        return changed, known.keys()
+
+    def _scanned(self, (changed, removed)):
+        ds = [self.changed(path) for path, mtime in changed if self.unreadable.get(path) != mtime]
+        ds.extend(self.removed(path) for path in removed)
+        self.index_changed()
+        if self.pending:
+            log.msg("indexing %i files, lag %.1f s" % (len(self.pending), self.lag()))
+        return defer.DeferredList(ds)
+
+    def index_changed(self):
+        """Commit the queued changes now if no more files are waiting to be
+        indexed, otherwise in commit_interval seconds."""
+        if not self.pending:
+            if self.writes or self.written:
+                self.commit()
+        elif self.commit_call == None:
+            self.commit_call = self.reactor.callLater(self.commit_interval, self.commit)
+
+    def commit(self):
+        """Hand the queued changes to writer. Returns a Deferred fired once
+        they are committed."""
+        if self.commit_call != None and self.commit_call.active():
+            self.commit_call.cancel()
+        self.commit_call = None
+        writes, self.writes = self.writes, []
+        written, self.written = self.written, []
+        if self.writer == None:
+            self.writer = threadpool.ThreadPool(1, 1, "Indexer writer")
+            self.writer.start()
+            self.writer_shutdown = self.reactor.addSystemEventTrigger("during", "shutdown", self._shutdown_writer)
+        d = threads.deferToThreadPool(self.reactor, self.writer, self.write, writes)
+        d.addErrback(log.err, "Could not update the index")
+        def fire(ignored):
+            for w in written:
+                w.callback(None)
+        d.addCallback(fire)
+        return d
+
+    def write(self, writes):
+        """Make the changes to the index and commit them. Called in
+        writer."""
+        for method, args in writes:
+            try:
+                method(*args, commit = False)
+            except ValueError, e:
+                log.err(e)
+        self.index.commit()
+
+    def _stop_writer(self):
+        if self.writer_shutdown != None:
+            self.reactor.removeSystemEventTrigger(self.writer_shutdown)
+            self.writer_shutdown = None
+        if self.writer != None:
+            self.writer.stop()
+            self.writer = None
+
+    def _shutdown_writer(self):
+        self.writer_shutdown = None
+        self._stop_writer()
+
+    def changed(self, path):
+        """Index the file path. Returns a Deferred fired once it is
+        committed."""
+        if path in self.pending:
+            self.changed_again.add(path)
+            return self.pending[path][1]
+        d = defer.Deferred()
+        self.pending[path] = (self.reactor.seconds(), d)
+        self._read(path)
+        return d
+
+    def removed(self, path):
+        """Forget the file path. Returns a Deferred fired once that is
+        committed."""
+        self.unreadable.pop(path, None)
+        if path in self.pending:
+            self.changed_again.add(path)
+            return self.pending[path][1]
+        d = defer.Deferred()
+        self.writes.append((self.index.remove, (path,)))
+        self.written.append(d)
+        self.index_changed()
+        return d
+
+    def read(self, path):
+        """Read the file path. Returns the data set, or None if it can not
+        be indexed, and the modification time. Called in a thread."""
+        mtime = os.path.getmtime(path)
+        try:
+            ds = read_header(path)
+            check_dataset(ds, path)
+        except (OSError, IOError):
+            raise
+        except Exception:
+            log.err(None, "Could not index %s" % (path,))
+            return None, mtime
+        return ds, mtime
+
+    def _read(self, path):
+        d = self.semaphore.run(threads.deferToThread, self.read, path)
+        d.addBoth(self._read_done, path)
+        return d
+
+    def _read_done(self, result, path):
+        if path in self.changed_again:
+            self.changed_again.discard(path)
+            return self._read(path)
+        seen, d = self.pending.pop(path)
+        self.written.append(d)
+        if isinstance(result, failure.Failure):
+            if not result.check(OSError, IOError):
+                log.err(result, "Could not index %s" % (path,))
+            self.writes.append((self.index.remove, (path,)))
+        else:
+            ds, mtime = result
+            if ds == None:
+                # Not read again until it is modified
+                self.unreadable[path] = mtime
+                self.writes.append((self.index.remove, (path,)))
+            else:
+                self.writes.append((self.index.add, (ds, path, mtime)))
+        self.index_changed()
+        self.last_lag = self.reactor.seconds() - seen
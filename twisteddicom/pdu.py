@@ -25,6 +25,19 @@ from twisted.python import log
 
 do_log = False
 
+class InvalidPDUError(ValueError):
+    """Received data that can not be decoded as a PDU. The association is
+    aborted, see DICOM PS3.8-2011 9.2.3, event 19."""
+    pass
+
+def _value_parts(value):
+    """The strings making up a presentation data value, which is given
+    either as one string or as a sequence of strings, e.g. the message
+    control header and a fragment of a data set."""
+    if isinstance(value, (list, tuple)):
+        return value
+    return (value,)
+
 def _unpack_H_string(s, offset):
     l, = struct.unpack_from("!H", s, offset)
     return s[offset+2:offset+2+l], offset + 2 + l
@@ -37,13 +50,13 @@ class PDU(object):
     def unpack(cls, buffer, current_offset = 0):
         if len(buffer) < current_offset + 2:
             return current_offset, None
-        pdu_type, = struct.unpack("B", buffer[current_offset])
+        pdu_type, = struct.unpack_from("B", buffer, current_offset)
         pdu_header_length = pdus[pdu_type].header_size
         header_end = current_offset + pdu_header_length
         if len(buffer) < header_end:
             return current_offset, None
-        pdu_type, reserved, pdu_length = struct.unpack(pdus[pdu_type].header, 
-                                                       buffer[current_offset : header_end])
+        pdu_type, reserved, pdu_length = struct.unpack_from(pdus[pdu_type].header, 
+                                                            buffer, current_offset)
 
         pdu_end = header_end + pdu_length
         if len(buffer) < pdu_end:
@@ -810,30 +823,44 @@ class P_DATA_TF(PDU):
     header_size = struct.calcsize(header)
     
     def pack(self):
-        s = struct.pack("!BBI", self.pdu_type, 0, self.pdu_length)
+        return "".join(self.pack_sequence())
+
+    def pack_sequence(self):
+        """Return the encoded PDU as a list of strings, the headers and
+        the presentation data values as they are, to be written with
+        transport.writeSequence() without copying the values."""
+        seq = [struct.pack("!BBI", self.pdu_type, 0, self.pdu_length)]
         for presentation_context_id, presentation_data_value in self.data_values:
-            s += struct.pack("!IB", 1 + len(presentation_data_value), presentation_context_id) + presentation_data_value
-        return s
+            parts = _value_parts(presentation_data_value)
+            seq.append(struct.pack("!IB", 1 + sum(len(part) for part in parts), presentation_context_id))
+            seq.extend(parts)
+        return seq
 
     def unpack(self, s, offset = 0):
         i = offset
         pdu_type, reserved, pdu_length = struct.unpack_from(self.header, s, i)
         i += self.header_size
-        assert pdu_type == self.pdu_type
+        if pdu_type != self.pdu_type:
+            raise InvalidPDUError("PDU type %i is not a P-DATA-TF" % (pdu_type,))
+        end = i + pdu_length
+        if len(s) < end:
+            raise InvalidPDUError("P-DATA-TF PDU length %i exceeds the data received" % (pdu_length,))
         self.data_values = []
-        while i - 6 - offset < pdu_length:
+        while i < end:
+            if end - i < 6:
+                raise InvalidPDUError("Truncated presentation data value item")
             item_length, presentation_context_id = struct.unpack_from("!IB", s, i)
+            if not 2 <= item_length <= end - i - 4:
+                raise InvalidPDUError("Invalid presentation data value item length %i" % (item_length,))
             i += 5
             presentation_data_value = s[i:i+item_length-1]
             i += item_length-1
             self.data_values.append((presentation_context_id, presentation_data_value))
-        assert pdu_length == self.pdu_length
-        assert pdu_length == i - 6 - offset
         return i - offset
 
     @property
     def pdu_length(self):
-        return sum(5 + len(val) for cid,val in self.data_values)
+        return sum(5 + sum(len(part) for part in _value_parts(val)) for cid,val in self.data_values)
 
     def __init__(self, data_values = None):
         self.data_values = data_values
@@ -845,8 +872,29 @@ class P_DATA_TF(PDU):
             else:
                 data_rep = x[:20] + " ... " + x[-20:]
             return data_rep
-        data_reps = [(x, shorten(y)) for x,y in self.data_values]
+        data_reps = [(x, shorten("".join(_value_parts(y)))) for x,y in self.data_values]
         return "<P_DATA_TF data_values = %s, pdu_length = %s>" % (data_reps, self.pdu_length)
+
+class PDVFragment(object):
+    """Part of a presentation data value in a P-DATA-TF PDU that is still
+    being received. See sockhandler.PDUFramer.
+
+    data is the fragment payload without the message control header.
+    pdv_start/pdv_end mark the first and last fragment of a presentation
+    data value, pdu_start the first fragment of the P-DATA-TF PDU."""
+    __slots__ = ('presentation_context_id', 'message_control_header', 'data', 'pdv_start', 'pdv_end', 'pdu_start')
+
+    def __init__(self, presentation_context_id = None, message_control_header = None, data = "", 
+                 pdv_start = True, pdv_end = True, pdu_start = True):
+        self.presentation_context_id = presentation_context_id
+        self.message_control_header = message_control_header
+        self.data = data
+        self.pdv_start = pdv_start
+        self.pdv_end = pdv_end
+        self.pdu_start = pdu_start
+
+    def __repr__(self):
+        return "<PDVFragment presentation_context_id = %s, message_control_header = %s, len(data) = %s, pdv_start = %s, pdv_end = %s, pdu_start = %s>" % (self.presentation_context_id, self.message_control_header, len(self.data), self.pdv_start, self.pdv_end, self.pdu_start)
             
 class A_RELEASE_RQ(PDU):
     """A-RELEASE-RQ PDU Structure - See DICOM PS3.8-2011 9.3.6."""
@@ -26,12 +26,165 @@ from twisted.protocols import basic
 
 do_log = False
 
+import struct
 import pdu
 
+# PDU class -> name of its handler method
+PDU_handler_names = {
+    pdu.A_ASSOCIATE_AC: "A_ASSOCIATE_AC_PDU_received",
+    pdu.A_ASSOCIATE_RJ: "A_ASSOCIATE_RJ_PDU_received",
+    pdu.A_ASSOCIATE_RQ: "A_ASSOCIATE_RQ_PDU_received",
+    pdu.PDVFragment: "P_DATA_TF_fragment_received",
+    pdu.P_DATA_TF: "P_DATA_TF_PDU_received",
+    pdu.A_RELEASE_RQ: "A_RELEASE_RQ_PDU_received",
+    pdu.A_RELEASE_RP: "A_RELEASE_RP_PDU_received",
+    pdu.A_ABORT: "A_ABORT_PDU_received",
+    }
+
+def _slice(buf, start, end):
+    """Copy buf[start:end] out of a bytearray exactly once."""
+    return memoryview(buf)[start:end].tobytes()
+
+class PDUFramer(object):
+    """
+    Cut a byte stream into PDUs.
+
+    Incoming data is appended to one growable bytearray and consumed through
+    an offset into it, so bytes that are already buffered are never copied
+    again while the rest of a large PDU is arriving. The header of the PDU
+    being assembled is only decoded once, no matter how many reads it takes
+    to complete it.
+
+    With stream_p_data set, P-DATA-TF PDUs are not assembled at all.
+    Instead each presentation data value is handed out as pdu.PDVFragment
+    objects as soon as its bytes arrive, so the memory used per connection
+    does not depend on the PDU length.
+    """
+    def __init__(self, stream_p_data = False):
+        self.stream_p_data = stream_p_data
+        self._buffer = bytearray()
+        self._offset = 0
+        self._pdu_class = None
+        self._pdu_end = None
+        # State of a streamed P-DATA-TF PDU
+        self._pdu_remaining = None
+        self._pdv_remaining = None
+        self._pdv_context_id = None
+        self._pdv_message_control_header = None
+        self._pdv_start = False
+        self._pdu_start = False
+        # Set once the stream can no longer be framed
+        self._discarding = False
+
+    def __len__(self):
+        """Number of received bytes not yet handed out as PDUs."""
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        if not self._discarding:
+            self._buffer.extend(data)
+
+    def discard(self):
+        """Drop all buffered data and all data fed from now on, after an
+        invalid PDU has been received."""
+        self._discarding = True
+        del self._buffer[:]
+        self._offset = 0
+        self._pdu_class = None
+        self._pdu_end = None
+        self._pdu_remaining = None
+        self._pdv_remaining = None
+
+    def next_pdu(self):
+        """Return the next complete PDU (or PDV fragment when streaming),
+        or None if more data is needed. Raises pdu.InvalidPDUError for
+        data that can not be a PDU."""
+        if self._pdu_remaining != None:
+            return self._next_fragment()
+        buf = self._buffer
+        if self._pdu_class == None:
+            if len(buf) < self._offset + 2:
+                return None
+            pdu_type, = struct.unpack_from("B", buf, self._offset)
+            cls = pdu.pdus.get(pdu_type)
+            if cls == None:
+                raise pdu.InvalidPDUError("Unrecognized PDU type 0x%02x" % (pdu_type,))
+            if len(buf) < self._offset + cls.header_size:
+                return None
+            pdu_type, reserved, pdu_length = struct.unpack_from(cls.header, buf, self._offset)
+            if cls == pdu.P_DATA_TF and self.stream_p_data:
+                self._offset += cls.header_size
+                self._pdu_remaining = pdu_length
+                self._pdu_start = True
+                return self._next_fragment()
+            self._pdu_class = cls
+            self._pdu_end = self._offset + cls.header_size + pdu_length
+        if len(buf) < self._pdu_end:
+            return None
+        data = self._pdu_class()
+        try:
+            data.unpack(_slice(buf, self._offset, self._pdu_end))
+        except struct.error, e:
+            raise pdu.InvalidPDUError("Truncated %s: %s" % (self._pdu_class.__name__, e))
+        self._offset = self._pdu_end
+        self._pdu_class = None
+        self._pdu_end = None
+        return data
+
+    def _next_fragment(self):
+        buf = self._buffer
+        if self._pdu_remaining == 0:
+            # A P-DATA-TF without any presentation data values.
+            self._pdu_remaining = None
+            return self.next_pdu()
+        if self._pdv_remaining == None:
+            if len(buf) < self._offset + 6:
+                return None
+            item_length, self._pdv_context_id, self._pdv_message_control_header = struct.unpack_from("!IBB", buf, self._offset)
+            if not 2 <= item_length <= self._pdu_remaining - 4:
+                raise pdu.InvalidPDUError("Invalid presentation data value item length %i" % (item_length,))
+            self._offset += 6
+            self._pdu_remaining -= 6
+            self._pdv_remaining = item_length - 2
+            self._pdv_start = True
+        n = min(self._pdv_remaining, len(buf) - self._offset)
+        if n == 0 and self._pdv_remaining != 0:
+            return None
+        fragment = pdu.PDVFragment(presentation_context_id = self._pdv_context_id,
+                                   message_control_header = self._pdv_message_control_header,
+                                   data = _slice(buf, self._offset, self._offset + n),
+                                   pdv_start = self._pdv_start,
+                                   pdv_end = n == self._pdv_remaining,
+                                   pdu_start = self._pdu_start)
+        self._offset += n
+        self._pdu_remaining -= n
+        self._pdv_remaining -= n
+        self._pdv_start = False
+        self._pdu_start = False
+        if fragment.pdv_end:
+            self._pdv_remaining = None
+            if self._pdu_remaining == 0:
+                self._pdu_remaining = None
+        return fragment
+
+    def compact(self):
+        """Drop consumed bytes. Only the unconsumed tail is moved."""
+        if self._offset != 0:
+            del self._buffer[:self._offset]
+            if self._pdu_end != None:
+                self._pdu_end -= self._offset
+            self._offset = 0
+
 class DICOMUpperLayerServiceProtocol(protocol.Protocol, basic._PauseableMixin, object):
+    # Deliver P-DATA-TF PDUs as PDV fragments through
+    # P_DATA_TF_fragment_received() instead of whole PDUs.
+    stream_p_data = False
+
     def __init__(self):
         super(DICOMUpperLayerServiceProtocol, self).__init__()
-        self._unprocessed = b""
+        self._framer = PDUFramer(stream_p_data = self.stream_p_data)
+        # PDU class -> handler set with register_PDU_handler()
+        self.PDU_handlers = {}
 
     def Transport_Connection_Response_indicated(self):
         if do_log: log.msg("Transport_Connection_Response_indicated()")
@@ -43,27 +196,21 @@ class DICOMUpperLayerServiceProtocol(protocol.Protocol, basic._PauseableMixin, o
         """
         Receive a stream of data, tokenize it to PDU messages and call pdu_received().
         """
-        # Try to minimize string copying (via slices) by keeping one buffer
-        # containing all the data we have so far and a separate offset into that
-        # buffer.
-        # Mimics the state in twisted.protocols.basic. Can be optimized in the case 
-        # where short messages are often received. (remember pdu_type, pdu_length etc., 
-        # only unpack pdu_type once...)
         if do_log: log.msg("dataReceived(%i)" % len(data))
-        all_data = self._unprocessed + data
-        current_offset = 0
-        
-        self._unprocessed = all_data
-
-        while len(all_data) >= (current_offset + 1) and not self.paused:
-            current_offset, data = pdu.PDU.unpack(all_data, current_offset)
+        framer = self._framer
+        framer.feed(data)
+        while not self.paused:
+            try:
+                data = framer.next_pdu()
+            except pdu.InvalidPDUError, e:
+                log.msg("Invalid PDU received: %s" % (e,))
+                framer.discard()
+                self.unrecognized_or_invalid_PDU_received(None)
+                break
             if data == None:
                 break
-            else:
-                self.pdu_received(data)
-
-        if current_offset != 0:
-            self._unprocessed = all_data[current_offset : ]
+            self.pdu_received(data)
+        framer.compact()
 
     def connectionLost(self, reason):
         self.conn_closed_received()
@@ -72,24 +219,17 @@ class DICOMUpperLayerServiceProtocol(protocol.Protocol, basic._PauseableMixin, o
         """
         Dispatch PDU messages to the respective *_received handlers.
         """
-        if data.__class__ == pdu.A_ASSOCIATE_AC:
-            self.A_ASSOCIATE_AC_PDU_received(data)
-        elif data.__class__ == pdu.A_ASSOCIATE_RJ:
-            self.A_ASSOCIATE_RJ_PDU_received(data)
-        elif data.__class__ == pdu.A_ASSOCIATE_RQ:
-            self.A_ASSOCIATE_RQ_PDU_received(data)
-        elif data.__class__ == pdu.P_DATA_TF:
-            self.P_DATA_TF_PDU_received(data)
-        elif data.__class__ == pdu.A_RELEASE_RQ:
-            self.A_RELEASE_RQ_PDU_received(data)
-        elif data.__class__ == pdu.A_RELEASE_RP:
-            self.A_RELEASE_RP_PDU_received(data)
-        elif data.__class__ == pdu.A_RELEASE_RP:
-            self.A_RELEASE_RP_PDU_received(data)
-        elif data.__class__ == pdu.A_ABORT:
-            self.A_ABORT_PDU_received(data)
-        else:
-            self.unrecognized_or_invalid_PDU_received(data)
+        handler = self.PDU_handlers.get(data.__class__)
+        if handler == None:
+            # Looked up on every PDU, so that *_PDU_received methods can
+            # also be replaced on the instance
+            handler = getattr(self, PDU_handler_names.get(data.__class__, "unrecognized_or_invalid_PDU_received"))
+        handler(data)
+
+    def register_PDU_handler(self, pdu_class, handler):
+        """Have handler(data) called for received PDUs of pdu_class instead
+        of the *_PDU_received method."""
+        self.PDU_handlers[pdu_class] = handler
 
     def A_ASSOCIATE_AC_PDU_received(data):
         pass
@@ -99,6 +239,8 @@ class DICOMUpperLayerServiceProtocol(protocol.Protocol, basic._PauseableMixin, o
         pass
     def P_DATA_TF_PDU_received(data):
         pass
+    def P_DATA_TF_fragment_received(self, data):
+        pass
     def A_RELEASE_RQ_PDU_received(data):
         pass
     def A_RELEASE_RP_PDU_received(data):
@@ -0,0 +1,406 @@
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import mmap
+from collections import deque
+import dicom
+from twisteddicom import dimse, dimsemessages, pdu, uids
+from twisteddicom.dimsemessages import Priority
+from twisted.internet import defer, error, threads
+from twisted.internet.protocol import Factory
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.python import failure, log
+
+do_log = False
+
+# Transfer syntaxes data sets can be re-encoded between by pack_dataset()
+uncompressed_transfer_syntaxes = [uids.ImplicitVRLittleEndian,
+                                  uids.ExplicitVRLittleEndian,
+                                  uids.ExplicitVRBigEndian]
+
+# Data sets up to this size are read into memory by read_encoded(), larger
+# ones are mapped into memory.
+read_into_memory_size = 4 * 1024 * 1024
+
+class Prefetcher(object):
+    """
+    Load the data sets of a sequence of files just before they are sent.
+
+    At most size files are read ahead, in the reactor thread pool, so the
+    memory used does not depend on the number of files. get() hands out
+    the loaded data sets in the order of the files.
+    """
+    size = 4
+
+    def __init__(self, paths, size = None):
+        if size != None:
+            self.size = size
+        self.paths = iter(paths)
+        # Deferreds of the files being read ahead, in order
+        self.loading = deque()
+        self.fill()
+
+    def load(self, path):
+        """Return the data set to send for path. Runs in a thread."""
+        return dicom.read_file(path)
+
+    def fill(self):
+        while len(self.loading) < self.size:
+            try:
+                path = self.paths.next()
+            except StopIteration:
+                return
+            self.loading.append(threads.deferToThread(self.load, path))
+
+    def is_empty(self):
+        """True when get() has handed out everything."""
+        return len(self.loading) == 0
+
+    def get(self):
+        """Return a Deferred that fires with the next data set, or with None
+        when there are no more files. It fails if the file could not be
+        read."""
+        if len(self.loading) == 0:
+            return defer.succeed(None)
+        d = self.loading.popleft()
+        self.fill()
+        return d
+
+    def stop(self):
+        """Read no more files and drop those read ahead."""
+        self.paths = iter(())
+        while len(self.loading) > 0:
+            self.loading.popleft().addErrback(lambda failure: None)
+
+class AssociationLimiter(object):
+    """
+    Limit the number of associations open at the same time to each
+    destination, e.g. (host, port), over all the stores to it.
+
+    limits maps destinations to their limit, others get default_limit.
+    """
+    def __init__(self, default_limit = 4, limits = None):
+        self.default_limit = default_limit
+        self.limits = limits if limits != None else {}
+        # destination -> DeferredSemaphore
+        self.semaphores = {}
+
+    def run(self, destination, f, *args, **kwargs):
+        """Call f(*args, **kwargs), which returns a Deferred that fires when
+        the association is closed, once there is room for another
+        association to destination. Returns a Deferred with the result of
+        f."""
+        semaphore = self.semaphores.get(destination)
+        if semaphore == None:
+            semaphore = defer.DeferredSemaphore(self.limits.get(destination, self.default_limit))
+            self.semaphores[destination] = semaphore
+        d = semaphore.run(f, *args, **kwargs)
+        d.addBoth(self._done, destination, semaphore)
+        return d
+
+    def _done(self, result, destination, semaphore):
+        if semaphore.tokens == semaphore.limit and self.semaphores.get(destination) is semaphore:
+            del self.semaphores[destination]
+        return result
+
+# Shared by the stores that are not given a limiter of their own
+association_limiter = AssociationLimiter()
+
+class NoPresentationContextError(RuntimeError):
+    pass
+
+class Instance(object):
+    """
+    A DICOM file to store, as described by its File Meta Information.
+
+    data_offset is where the data set starts in the file, after the File
+    Meta Information. deferred fires with the C-STORE-RSP for the instance,
+    or fails if it could not be read or stored.
+    """
+    def __init__(self, path, sop_class_uid, sop_instance_uid, transfer_syntax, data_offset = None):
+        self.path = path
+        self.sop_class_uid = sop_class_uid
+        self.sop_instance_uid = sop_instance_uid
+        self.transfer_syntax = transfer_syntax
+        self.data_offset = data_offset
+        self.deferred = defer.Deferred()
+
+    def __repr__(self):
+        return "<Instance %s>" % (self.path if self.path != None else self.sop_instance_uid,)
+
+def read_instance(path):
+    """Return an Instance for the DICOM file path. Only the preamble and
+    File Meta Information are read, see DICOM PS3.10-2011 7.1."""
+    f = dicom.filebase.DicomFile(path, 'rb')
+    try:
+        dicom.filereader.read_preamble(f, False)
+        meta = dicom.filereader._read_file_meta_info(f)
+        data_offset = f.tell()
+    finally:
+        f.close()
+    return Instance(path, meta.MediaStorageSOPClassUID, meta.MediaStorageSOPInstanceUID, meta.TransferSyntaxUID,
+                    data_offset)
+
+def read_instances(paths):
+    """Return the Instances of the files in paths that can be read, see
+    read_instance()."""
+    instances = []
+    for path in paths:
+        try:
+            instances.append(read_instance(path))
+        except Exception:
+            log.err(None, "Could not read %s" % (path,))
+    return instances
+
+def read_encoded(instance):
+    """Return the data set of instance as it is encoded in the file,
+    without the preamble and File Meta Information, and without pydicom.
+
+    Data sets of up to read_into_memory_size bytes are read into memory.
+    Larger files are mapped into memory, after reading through them once
+    so that they are in the page cache. Either way the disk is read by the
+    thread calling this, not by the one sending the data set."""
+    f = open(instance.path, 'rb')
+    try:
+        f.seek(instance.data_offset)
+        if os.fstat(f.fileno()).st_size - instance.data_offset <= read_into_memory_size:
+            return f.read()
+        try:
+            m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (mmap.error, ValueError): # no mmap support
+            return f.read()
+        while f.read(1024 * 1024):
+            pass
+        return buffer(m, instance.data_offset)
+    finally:
+        f.close()
+
+class InstanceLoader(Prefetcher):
+    """A Prefetcher of Instances. get() fires with (instance, encoded data
+    set), see read_encoded(), or (instance, Failure) if the file could not
+    be read."""
+    def load(self, instance):
+        try:
+            return instance, read_encoded(instance)
+        except Exception:
+            return instance, failure.Failure()
+
+class StoreSCU(dimse.DIMSEProtocol):
+    """
+    Store instances over one association, see DICOM PS3.4-2011 B.
+
+    The presentation contexts are negotiated from the File Meta
+    Information of instances, a list of Instance. The files are read from
+    loader, an InstanceLoader that may be shared with other StoreSCUs, just
+    before they are sent, and each StoreSCU takes the next one whenever it
+    has room for another C-STORE-RQ. window is the number of C-STORE-RQs
+    to keep outstanding, if the SCP agrees.
+
+    When the presentation context has the transfer syntax of the file, the
+    data set is sent from the file as it is. Otherwise it is decoded, in
+    the reactor thread pool, and re-encoded. A loader may also hand out
+    Datasets, which are encoded in the transfer syntax of the presentation
+    context.
+
+    The result of each instance is reported through Instance.deferred.
+    deferred fires with None when the association is closed.
+    """
+    def __init__(self, instances, loader = None, window = 16, priority = Priority.LOW, 
+                 move_originator_application_entity_title = None, move_originator_message_id = None):
+        super(StoreSCU, self).__init__(supported_abstract_syntaxes = list(set(instance.sop_class_uid for instance in instances)))
+        if loader == None:
+            loader = InstanceLoader(instances)
+        self.instances = instances
+        self.loader = loader
+        self.maximum_number_operations_invoked = window
+        self.priority = priority
+        self.move_originator_application_entity_title = move_originator_application_entity_title
+        self.move_originator_message_id = move_originator_message_id
+        self.loading = None
+        self.exhausted = False
+        self.released = False
+        self.closed = False
+        self.deferred = defer.Deferred()
+
+    def get_presentation_contexts(self):
+        """Propose the transfer syntaxes of the files for each SOP class,
+        and the uncompressed transfer syntaxes for SOP classes that have
+        uncompressed files."""
+        transfer_syntaxes = {}
+        for instance in self.instances:
+            transfer_syntaxes.setdefault(instance.sop_class_uid, set()).add(instance.transfer_syntax)
+        items = []
+        for sop_class_uid in sorted(transfer_syntaxes):
+            proposed = sorted(transfer_syntaxes[sop_class_uid])
+            if len(set(proposed) & set(uncompressed_transfer_syntaxes)) > 0:
+                proposed.extend(ts for ts in uncompressed_transfer_syntaxes if ts not in proposed)
+            items.append(pdu.A_ASSOCIATE_RQ.PresentationContextItem(
+                    abstract_syntax = pdu.AbstractSyntaxSubitem(sop_class_uid),
+                    transfer_syntaxes = [pdu.TransferSyntaxSubitem(ts) for ts in proposed],
+                    presentation_context_id = 2 * len(items) + 1))
+        return items
+
+    def presentation_context_for(self, instance):
+        """Return the ID of the accepted presentation context to send
+        instance on, preferring the transfer syntax of the file, or None."""
+        found = None
+        for context in self.presentation_contexts.itervalues():
+            if not context.accepted or context.abstract_syntax != instance.sop_class_uid:
+                continue
+            if context.transfer_syntax == instance.transfer_syntax:
+                return context.presentation_context_id
+            if (context.transfer_syntax in uncompressed_transfer_syntaxes and 
+                instance.transfer_syntax in uncompressed_transfer_syntaxes):
+                found = context.presentation_context_id
+        return found
+
+    def A_ASSOCIATE_confirmation_accept_indicated(self, a_associate_ac):
+        super(StoreSCU, self).A_ASSOCIATE_confirmation_accept_indicated(a_associate_ac)
+        self.store_more()
+
+    def store_more(self):
+        """Send C-STORE-RQs until the asynchronous operations window is
+        full, and release the association when everything is stored."""
+        while self.loading == None and not self.exhausted and self.can_invoke_operation():
+            d = self.loader.get()
+            d.addCallback(self.loaded)
+            d.addErrback(log.err)
+            if not d.called or d.paused:
+                # Continue once the file has been read, or decoded
+                self.loading = d
+                d.addCallback(self.loading_done)
+                return
+        if self.exhausted and len(self.requests) == 0 and not self.released and not self.closed:
+            self.released = True
+            self.A_RELEASE_request_received()
+
+    def loading_done(self, ignored):
+        self.loading = None
+        if not self.closed:
+            self.store_more()
+
+    def loaded(self, item):
+        if item == None:
+            self.exhausted = True
+            return
+        instance, data = item
+        if isinstance(data, failure.Failure):
+            instance.deferred.errback(data)
+            return
+        if self.closed:
+            instance.deferred.errback(error.ConnectionLost("Association closed before storing %s" % (instance.path,)))
+            return
+        presentation_context_id = self.presentation_context_for(instance)
+        if presentation_context_id == None:
+            instance.deferred.errback(NoPresentationContextError(
+                    "No presentation context accepted for %s in %s" % (instance.sop_class_uid, instance.transfer_syntax)))
+            return
+        if (not isinstance(data, dicom.dataset.Dataset) and 
+            self.presentation_contexts[presentation_context_id].transfer_syntax != instance.transfer_syntax):
+            d = threads.deferToThread(dicom.read_file, instance.path)
+            d.addCallbacks(self.send_store, instance.deferred.errback, 
+                           callbackArgs = (presentation_context_id, instance))
+            return d
+        self.send_store(data, presentation_context_id, instance)
+
+    def send_store(self, data, presentation_context_id, instance):
+        if self.closed:
+            instance.deferred.errback(error.ConnectionLost("Association closed before storing %s" % (instance.path,)))
+            return
+        if do_log: log.msg("storing %s" % (instance.path,))
+        rq = dimsemessages.C_STORE_RQ(affected_sop_class_uid = instance.sop_class_uid,
+                                      affected_sop_instance_uid = instance.sop_instance_uid, 
+                                      move_originator_application_entity_title = self.move_originator_application_entity_title,
+                                      move_originator_message_id = self.move_originator_message_id,
+                                      priority = self.priority)
+        d = self.send_request(presentation_context_id, rq, data)
+        d.addCallback(lambda result: result[0])
+        d.addBoth(self.stored)
+        d.chainDeferred(instance.deferred)
+
+    def stored(self, result):
+        if not self.closed:
+            self.store_more()
+        return result
+
+    def conn_closed_received(self):
+        self.closed = True
+        super(StoreSCU, self).conn_closed_received()
+        self.deferred.callback(None)
+
+class _StoreSCUFactory(Factory, object):
+    def __init__(self, protocol):
+        super(_StoreSCUFactory, self).__init__()
+        self.protocol = protocol
+    def buildProtocol(self, addr):
+        return self.protocol
+
+def store(instances, host, port, calling_ae_title, called_ae_title, parallelism = 1, window = 16, limiter = None,
+          priority = Priority.LOW, move_originator_application_entity_title = None, move_originator_message_id = None,
+          loader = None):
+    """Store instances, a list of Instance, see read_instances(), over up
+    to parallelism associations at the same time, within the limit of
+    limiter (by default association_limiter) for (host, port). loader
+    is the InstanceLoader of instances, by default one reading the files.
+    See StoreSCU.
+
+    Returns a Deferred that fires once all associations are closed and
+    every Instance.deferred has fired. It fails if no association could be
+    opened."""
+    from twisted.internet import reactor
+    if limiter == None:
+        limiter = association_limiter
+    if loader == None:
+        loader = InstanceLoader(instances)
+
+    def associate():
+        if loader.is_empty():
+            # Everything was sent while waiting for the limiter
+            return defer.succeed(None)
+        scu = StoreSCU(instances, loader = loader, window = window, priority = priority, 
+                       move_originator_application_entity_title = move_originator_application_entity_title,
+                       move_originator_message_id = move_originator_message_id)
+        scu.calling_ae_title = calling_ae_title
+        scu.called_ae_title = called_ae_title
+        scu.A_ASSOCIATE_request_received()
+        point = TCP4ClientEndpoint(reactor, host = host, port = port, timeout = 5)
+        connecting = point.connect(_StoreSCUFactory(scu))
+        connecting.addErrback(scu.deferred.errback)
+        return scu.deferred
+
+    def done(results):
+        loader.stop()
+        failures = [result for success, result in results if not success]
+        for instance in instances:
+            if not instance.deferred.called:
+                instance.deferred.errback(failures[0] if len(failures) > 0 else 
+                                          error.ConnectionLost("No association to store %s" % (instance.path,)))
+        if len(failures) == len(results):
+            return failures[0]
+        return None
+
+    n_associations = max(1, min(parallelism, len(instances)))
+    d = defer.DeferredList([limiter.run((host, port), associate) for i in range(n_associations)], consumeErrors = True)
+    d.addCallback(done)
+    return d
@@ -0,0 +1,78 @@
+"""
+Test cases for twisteddicom.columnar
+"""
+
+import dicom
+from twisteddicom import columnar, utils
+from twisteddicom.test.test_index import make_dataset, make_query
+from twisted.trial import unittest
+
+class ColumnStoreTestCase(unittest.TestCase):
+    if columnar.numpy == None:
+        skip = "numpy is not available"
+
+    def setUp(self):
+        self.store = columnar.ColumnStore()
+        self.datasets = []
+        for patient, study in [(0, 0), (0, 1), (1, 2)]:
+            for series in range(2):
+                for instance in range(3):
+                    ds = make_dataset(patient, study, series, instance,
+                                      StudyTime = "%02i3000" % (8 + study + series,),
+                                      ModalitiesInStudy = ["CT", "MR"] if study != 1 else "CT")
+                    if study == 2 and instance == 0:
+                        ds.StudyDate = "garbage"
+                    self.store.add(ds)
+                    self.datasets.append(ds)
+
+    def scan(self, query):
+        results = []
+        level_ids_done = set()
+        matcher = utils.compile_query(query)
+        for ds in self.datasets:
+            level_id = utils.get_level_identifier(ds, query.QueryRetrieveLevel)
+            if level_id in level_ids_done:
+                continue
+            is_match, result_ds = matcher.match(ds)
+            if is_match:
+                level_ids_done.add(level_id)
+                results.append(result_ds)
+        return results
+
+    def assertFindEqual(self, query):
+        expected = [str(ds) for ds in self.scan(query)]
+        self.assertNotEqual(expected, [])
+        self.assertEqual([str(ds) for ds in self.store.find(query)], expected)
+
+    def test_find(self):
+        """
+        Test that the column masks give the same results as the compiled
+        query for range, single value, wildcard and UID list matching.
+        """
+        self.assertFindEqual(make_query("PATIENT", PatientID = "", PatientName = "Doe^J*"))
+        self.assertFindEqual(make_query("PATIENT", PatientID = "P1", PatientName = ""))
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "", StudyDate = "20120102-20120103"))
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "", StudyDate = "-20120102", StudyTime = "083000-"))
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "1.2.3.0\\1.2.3.2\\1.2.9", StudyDescription = "*"))
+        self.assertFindEqual(make_query("SERIES", SeriesInstanceUID = "*.1", Modality = "MR"))
+        self.assertFindEqual(make_query("IMAGE", SOPInstanceUID = "", InstanceNumber = "2", Modality = "C?"))
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "", ModalitiesInStudy = "MR"))
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "", StudyDescription = "Study 2"))
+        self.assertEqual(list(self.store.find(make_query("PATIENT", PatientID = "P2"))), [])
+        self.assertEqual(list(self.store.find(make_query("PATIENT", PatientID = "P*", PatientSex = "M"))), [])
+
+    def test_select(self):
+        """
+        Test that select() needs no checks when all keys are in columns, and
+        that data sets added later are found.
+        """
+        hits, exact = self.store.select(make_query("IMAGE", StudyDate = "20120103", Modality = "CT"))
+        self.assertTrue(exact)
+        self.assertEqual(list(hits), [13, 14])
+        hits, exact = self.store.select(make_query("IMAGE", StudyDescription = "Study 2"))
+        self.assertFalse(exact)
+        self.assertEqual(len(hits), 18)
+
+        self.store.add(make_dataset(1, 3, 0, 0))
+        hits, exact = self.store.select(make_query("IMAGE", StudyDate = "20120104"))
+        self.assertEqual(list(hits), [18])
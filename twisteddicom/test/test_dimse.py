@@ -3,24 +3,38 @@ Test cases for twisteddicom.sockhandler
 """
 
 import struct
+import threading
+import dicom
 
-from twisteddicom import sockhandler, pdu, upper_layer, dimsemessages, dimse, utils
+from twisteddicom import sockhandler, pdu, upper_layer, dimsemessages, dimse, utils, timerwheel
 from twisteddicom.test import test_factory as tf
 
 from twisted.trial import unittest
 from twisted.test import proto_helpers
-from twisted.internet import protocol, error, task
+from twisted.internet import protocol, error, task, defer, reactor
+from twisted.python import threadable
 
 class DIMSETester(dimse.DIMSEProtocol):
     def __init__(self):
-        super(DIMSETester, self).__init__()
+        super(DIMSETester, self).__init__(supported_abstract_syntaxes = [utils.get_uid("Verification SOP Class")])
         self.transport = proto_helpers.StringTransport()
         self.called_ae_title = "hej"
         self.calling_ae_title = "bla"
         self._sent = []
 
+        self._received = []
+        self.presentation_contexts_requested = self.get_presentation_contexts()
+        self.presentation_contexts_accepted = self.validate_presentation_contexts(
+            pdu.A_ASSOCIATE_RQ(presentation_context_items = self.presentation_contexts_requested))
+        self.presentation_contexts = dimse.build_presentation_context_table(self.presentation_contexts_requested,
+                                                                            self.presentation_contexts_accepted)
+
     def P_DATA_request_received(self, data):
-        self._sent.append(data)
+        # Values given as sequences of strings are recorded joined
+        self._sent.append([(context_id, "".join(pdu._value_parts(value))) for context_id, value in data])
+
+    def DIMSE_command_received(self, presentation_context_id, cmd, data):
+        self._received.append((presentation_context_id, cmd, data))
 
 class DIMSETestCase(unittest.SynchronousTestCase):
     def test_send(self):
@@ -36,5 +50,432 @@ class DIMSETestCase(unittest.SynchronousTestCase):
         """
         """
         pass
+
+    def test_recv_streamed(self):
+        """
+        Test that a DIMSE message split over several PDVs and delivered in
+        small reads is reassembled.
+        """
+        command = dimsemessages.C_ECHO_RQ(message_id = 7).pack()
+        pdu_data = (pdu.P_DATA_TF([(1, "\x01" + command[:10])]).pack() +
+                    pdu.P_DATA_TF([(1, "\x03" + command[10:])]).pack())
+        for packet_size in (1, 7, len(pdu_data)):
+            uls = DIMSETester()
+            uls.state = 6
+            for i in range(0, len(pdu_data), packet_size):
+                uls.dataReceived(pdu_data[i:i + packet_size])
+            self.assertEqual(len(uls._received), 1)
+            presentation_context_id, cmd, data = uls._received[0]
+            self.assertEqual(presentation_context_id, 1)
+            self.assertEqual(cmd.__class__, dimsemessages.C_ECHO_RQ)
+            self.assertEqual(cmd.message_id, 7)
+            self.assertEqual(data, None)
+
+    def test_invalid_pdu(self):
+        """
+        Test that a malformed P-DATA-TF PDU aborts the association.
+        """
+        uls = DIMSETester()
+        uls.state = 6
+        clock = task.Clock()
+        uls.timer_wheel = timerwheel.TimerWheel(reactor = clock)
+        data = pdu.P_DATA_TF([(1, "\x03" + dimsemessages.C_ECHO_RQ().pack())]).pack()
+        uls.dataReceived(data[:6] + struct.pack("!I", 1000) + data[10:])
+        self.assertEqual(uls.state, 13)
+        self.assertEqual(uls._received, [])
+        self.assertEqual(uls.transport.value(), pdu.A_ABORT(reason_diag = 0, source = 2).pack())
+        uls.dataReceived(data)
+        self.assertEqual(uls._received, [])
+        self.assertEqual(uls.transport.value(), pdu.A_ABORT(reason_diag = 0, source = 2).pack())
+        uls.stop_ARTIM()
+
+    def test_close_while_paused(self):
+        """
+        Test that the transport producer is unregistered before the
+        transport is closed on an abort or release, as the transport stays
+        open while a registered producer is paused.
+        """
+        def lose_connection(transport, producers):
+            producers.append(transport.producer)
+            transport.disconnecting = True
+
+        for state, data in [(6, pdu.A_ABORT(reason_diag = 0, source = 0).pack()),
+                            (7, pdu.A_RELEASE_RP().pack())]:
+            uls = DIMSETester()
+            uls.state = state
+            uls.timer_wheel = timerwheel.TimerWheel(reactor = task.Clock())
+            uls.send_DIMSE_command(1, dimsemessages.C_ECHO_RQ(message_id = 1))
+            uls.transport_producer.pauseProducing()
+            producers = []
+            uls.transport.loseConnection = lambda: lose_connection(uls.transport, producers)
+            uls.dataReceived(data)
+            self.assertEqual(uls.state, 1)
+            self.assertEqual(producers, [None])
+            self.assertEqual(uls.transport_producer, None)
+            self.assertFalse(uls.transport_paused)
+            # Not registered again on the closing transport
+            uls.send_DIMSE_command(1, dimsemessages.C_ECHO_RQ(message_id = 2))
+            self.assertEqual(uls.transport.producer, None)
+
+        uls = DIMSETester()
+        uls.state = 6
+        uls.send_DIMSE_command(1, dimsemessages.C_ECHO_RQ(message_id = 1))
+        uls.transport_producer.pauseProducing()
+        uls.connectionLost(error.ConnectionLost())
+        self.assertEqual(uls.transport.producer, None)
+        self.assertEqual(uls.transport_producer, None)
+
+    def test_presentation_context_table(self):
+        """
+        Test that the transfer syntax is taken from the A-ASSOCIATE-AC and
+        that PDVs on rejected presentation contexts abort the association.
+        """
+        ts = pdu.TransferSyntaxSubitem
+        requested = [pdu.A_ASSOCIATE_RQ.PresentationContextItem(abstract_syntax = pdu.AbstractSyntaxSubitem(utils.get_uid("Verification SOP Class")),
+                                                                transfer_syntaxes = [ts(dicom.UID.ImplicitVRLittleEndian), ts(dicom.UID.ExplicitVRBigEndian)],
+                                                                presentation_context_id = 1),
+                     pdu.A_ASSOCIATE_RQ.PresentationContextItem(abstract_syntax = pdu.AbstractSyntaxSubitem(utils.get_uid("CT Image Storage")),
+                                                                transfer_syntaxes = [ts(dicom.UID.ImplicitVRLittleEndian)],
+                                                                presentation_context_id = 3)]
+        accepted = [pdu.A_ASSOCIATE_AC.PresentationContextItem(presentation_context_id = 1, result_reason = 0,
+                                                               transfer_syntax = ts(dicom.UID.ExplicitVRBigEndian + "\0")),
+                    pdu.A_ASSOCIATE_AC.PresentationContextItem(presentation_context_id = 3, result_reason = 3,
+                                                               transfer_syntax = ts(dicom.UID.ImplicitVRLittleEndian))]
+        table = dimse.build_presentation_context_table(requested, accepted)
+        self.assertEqual(sorted(table.keys()), [1, 3])
+        self.assertEqual(table[1], dimse.PresentationContext(presentation_context_id = 1, accepted = True,
+                                                             abstract_syntax = utils.get_uid("Verification SOP Class"),
+                                                             transfer_syntax = dicom.UID.ExplicitVRBigEndian,
+                                                             is_implicit_VR = False, is_little_endian = False))
+        self.assertFalse(table[3].accepted)
+
+        uls = DIMSETester()
+        uls.presentation_contexts = table
+        aborts = []
+        uls.A_ABORT_request_received = lambda *args, **kwargs: aborts.append(kwargs)
+        self.assertFalse(uls.PDV_received(3, 3, dimsemessages.C_ECHO_RQ().pack(), True))
+        self.assertEqual(aborts, [{'reason': 6}])
+
+    def test_asynchronous_operations_window(self):
+        """
+        Test negotiation of the asynchronous operations window and tracking
+        of outstanding operations by message ID.
+        """
+        requestor = DIMSETester()
+        requestor.maximum_number_operations_invoked = 3
+        items = requestor.get_application_association_information()
+        windows = [item for item in items if isinstance(item, pdu.AsynchronousOperationsWindowSubitem)]
+        self.assertEqual([(w.maximum_number_operations_invoked, w.maximum_number_operations_performed) for w in windows], 
+                         [(3, 1)])
+
+        acceptor = DIMSETester()
+        acceptor.is_association_requestor = False
+        self.assertEqual(acceptor.negotiate_asynchronous_operations_window(pdu.UserInformationItem(items)).pack(), 
+                         pdu.AsynchronousOperationsWindowSubitem(1, 1).pack())
+        acceptor.maximum_number_operations_performed = 0
+        reply = acceptor.negotiate_asynchronous_operations_window(pdu.UserInformationItem(items))
+        self.assertEqual(reply.pack(), pdu.AsynchronousOperationsWindowSubitem(3, 1).pack())
+        self.assertEqual((acceptor.operations_invoked_limit, acceptor.operations_performed_limit), (1, 3))
+        self.assertEqual(acceptor.negotiate_asynchronous_operations_window(pdu.UserInformationItem([])), None)
+        self.assertEqual((acceptor.operations_invoked_limit, acceptor.operations_performed_limit), (1, 1))
+
+        requestor.negotiate_asynchronous_operations_window(pdu.UserInformationItem([reply]))
+        self.assertEqual((requestor.operations_invoked_limit, requestor.operations_performed_limit), (3, 1))
+        for message_id in (1, 2, 3):
+            self.assertTrue(requestor.can_invoke_operation())
+            requestor.send_DIMSE_command(1, dimsemessages.C_ECHO_RQ(message_id = message_id))
+        self.assertFalse(requestor.can_invoke_operation())
+        self.assertEqual(sorted(requestor.operations_invoked.keys()), [1, 2, 3])
+        requestor.state = 6
+        requestor.dataReceived(pdu.P_DATA_TF([(1, "\x03" + dimsemessages.C_ECHO_RSP(message_id_being_responded_to = 2).pack())]).pack())
+        self.assertEqual(sorted(requestor.operations_invoked.keys()), [1, 3])
+        self.assertTrue(requestor.can_invoke_operation())
+
+    def test_send_request(self):
+        """
+        Test that send_request() correlates responses by message ID, queues
+        requests while the operations window is full, aborts the
+        association on timeout and fails requests on connection loss.
+        """
+        def respond(uls, rsp):
+            uls.dataReceived(pdu.P_DATA_TF([(1, "\x03" + rsp.pack())]).pack())
+
+        uls = DIMSETester()
+        uls.state = 6
+        clock = task.Clock()
+        uls.timer_wheel = timerwheel.TimerWheel(reactor = clock)
+        uls.operations_invoked_limit = 2
+        results = []
+        pending = []
+        deferreds = [uls.send_request(1, dimsemessages.C_FIND_RQ(), pending_callback = lambda rsp, data: pending.append(rsp), 
+                                      timeout = 10)
+                     for i in range(4)]
+        for d in deferreds:
+            d.addBoth(results.append)
+        self.assertEqual(sorted(uls.operations_invoked.keys()), [1, 2])
+        self.assertEqual(len(uls._sent), 2)
+
+        clock.advance(5)
+        respond(uls, dimsemessages.C_FIND_RSP(message_id_being_responded_to = 2, status = 0xFF00))
+        self.assertEqual([rsp.message_id_being_responded_to for rsp in pending], [2])
+        respond(uls, dimsemessages.C_FIND_RSP(message_id_being_responded_to = 2, status = 0))
+        self.assertEqual([rsp.message_id_being_responded_to for rsp, data in results], [2])
+        self.assertEqual(sorted(uls.operations_invoked.keys()), [1, 3])
+        respond(uls, dimsemessages.C_FIND_RSP(message_id_being_responded_to = 99, status = 0))
+        self.assertEqual(len(uls._received), 1)
+        self.assertEqual(uls._received[0][1].message_id_being_responded_to, 99)
+
+        clock.advance(5)
+        self.assertTrue(results[1].check(dimse.DIMSETimeoutError))
+        # The association is aborted and late responses are ignored
+        self.assertEqual(uls.state, 13)
+        self.assertTrue(uls.transport.value().endswith(pdu.A_ABORT(reason_diag = 0, source = 0).pack()))
+        respond(uls, dimsemessages.C_FIND_RSP(message_id_being_responded_to = 1, status = 0xFF00))
+        respond(uls, dimsemessages.C_FIND_RSP(message_id_being_responded_to = 1, status = 0))
+        self.assertEqual(len(uls._received), 1)
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(len(results), 2)
+        uls.conn_closed_received()
+        self.assertEqual(len(results), 4)
+        self.assertTrue(results[2].check(error.ConnectionLost))
+        self.assertTrue(results[3].check(error.ConnectionLost))
+        self.assertEqual(uls.requests, {})
+        self.assertEqual(len(uls.timer_wheel), 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_send_paused(self):
+        """
+        Test that DIMSE messages are sent in PDUs of at most
+        maximum_length_sent, that no PDUs are sent while the transport is
+        paused, and that release waits for the queued messages.
+        """
+        uls = DIMSETester()
+        uls.state = 6
+        uls.maximum_length_sent = 100
+        data = "".join(chr(i % 256) for i in range(1000))
+        def P_DATA_request_received(data_values):
+            DIMSETester.P_DATA_request_received(uls, data_values)
+            if len(uls._sent) == 3:
+                uls.transport_producer.pauseProducing()
+        uls.P_DATA_request_received = P_DATA_request_received
+        uls.send_DIMSE_command(1, dimsemessages.C_STORE_RQ(), data)
+        uls.send_DIMSE_command(1, dimsemessages.C_ECHO_RQ())
+        self.assertEqual(len(uls._sent), 3)
+        uls.A_RELEASE_request_received()
+        self.assertEqual(uls.state, 6)
+        uls.transport_producer.resumeProducing()
+        self.assertEqual(uls.state, 7)
+        self.assertTrue(all(sum(5 + len(value) for context_id, value in data_values) <= 100
+                            for data_values in uls._sent))
+        values = [value for data_values in uls._sent for context_id, value in data_values]
+        control_headers = [value[0] for value in values]
+        self.assertEqual(control_headers.count("\x02"), 1)
+        self.assertEqual(control_headers.count("\x03"), 2)
+        self.assertEqual("".join(value[1:] for value in values if value[0] in "\x00\x02"), data)
+        self.assertEqual(control_headers[-1], "\x03")
+
+    def test_send_tiny_maximum_length(self):
+        """
+        Test that a maximum length received by the peer that leaves no room
+        for data is raised to smallest_maximum_length_sent, so that messages
+        are still sent.
+        """
+        uls = DIMSETester()
+        uls.set_maximum_length_sent(pdu.UserInformationItem([pdu.MaximumLengthSubitem(maximum_length_received = 4)]))
+        self.assertEqual(uls.maximum_length_sent, dimse.DIMSEProtocol.smallest_maximum_length_sent)
+        uls.send_DIMSE_command(1, dimsemessages.C_ECHO_RQ())
+        self.assertTrue(all(sum(5 + len(value) for context_id, value in data_values) <= 8
+                            for data_values in uls._sent))
+        values = [value for data_values in uls._sent for context_id, value in data_values]
+        self.assertEqual("".join(value[1:] for value in values), dimsemessages.C_ECHO_RQ().pack())
+        self.assertEqual([value[0] for value in values].count("\x03"), 1)
+
+    def test_send_packed(self):
+        """
+        Test that P-DATA-TF PDUs are filled up to maximum_length_sent, with
+        a command and the start of its data set, and with several small
+        messages sent while corked.
+        """
+        uls = DIMSETester()
+        uls.maximum_length_sent = 1000
+        data = "".join(chr(i % 256) for i in range(5000))
+        uls.send_DIMSE_command(1, dimsemessages.C_STORE_RQ(), data)
+        self.assertEqual(len(uls._sent), 6)
+        self.assertEqual([value[0] for context_id, value in uls._sent[0]], ["\x03", "\x00"])
+        for data_values in uls._sent[:-1]:
+            self.assertEqual(sum(5 + len(value) for context_id, value in data_values), 1000)
+        self.assertEqual("".join(data_values[-1][1][1:] for data_values in uls._sent[1:]), data[len(uls._sent[0][1][1]) - 1:])
+
+        uls = DIMSETester()
+        uls.cork()
+        for i in range(5):
+            uls.send_DIMSE_command(1, dimsemessages.C_ECHO_RQ(message_id = i + 1))
+        self.assertEqual(uls._sent, [])
+        uls.uncork()
+        self.assertEqual(len(uls._sent), 1)
+        self.assertEqual([dimsemessages.unpack_command_set(value[1:]).MessageID for context_id, value in uls._sent[0]], 
+                         [1, 2, 3, 4, 5])
+
+        # A data set that fits in the PDU is passed on without copying it
+        uls = DIMSETester()
+        sent = []
+        uls.P_DATA_request_received = sent.append
+        uls.send_DIMSE_command(1, dimsemessages.C_STORE_RQ(), data)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0][1][1][0], "\x02")
+        self.assertTrue(sent[0][1][1][1] is data)
+
+    def test_find_responder(self):
+        """
+        Test that FindResponder sends pending responses in batches between
+        reactor iterations, waits while the transport is paused, and stops
+        on C-CANCEL-RQ.
+        """
+        def statuses(uls):
+            return [dimsemessages.unpack_command_set(value[1:]).Status 
+                    for data_values in uls._sent for context_id, value in data_values if value[0] == "\x03"]
+
+        def run_next_call(clock):
+            # Clock.advance() would also run the calls scheduled meanwhile
+            call = clock.calls.pop(0)
+            call.func(*call.args, **call.kw)
+
+        uls = DIMSETester()
+        clock = task.Clock()
+        uls.timer_wheel = timerwheel.TimerWheel(reactor = clock)
+        find_rq = dimsemessages.C_FIND_RQ(message_id = 3)
+        results = []
+        d = uls.respond_to_find(1, find_rq, (dicom.dataset.Dataset() for i in range(40)), threaded = False)
+        d.addBoth(results.append)
+        self.assertEqual(uls._sent, [])
+        run_next_call(clock)
+        # A batch is packed into one PDU
+        self.assertEqual(len(uls._sent), 1)
+        self.assertEqual(statuses(uls), [0xFF00] * dimse.FindResponder.batch_size)
+        uls.transport_producer.pauseProducing()
+        clock.advance(0)
+        self.assertEqual(len(uls._sent), 1)
+        uls.transport_producer.resumeProducing()
+        clock.advance(0)
+        self.assertEqual(statuses(uls), [0xFF00] * 40 + [0])
+        self.assertEqual(results, [0])
+        self.assertEqual(uls.responders, {})
+
+        uls = DIMSETester()
+        uls.timer_wheel = timerwheel.TimerWheel(reactor = clock)
+        d = uls.respond_to_find(1, find_rq, (dicom.dataset.Dataset() for i in range(40)), threaded = False)
+        d.addBoth(results.append)
+        run_next_call(clock)
+        uls.C_CANCEL_RQ_received(1, dimsemessages.C_CANCEL_RQ(message_id_being_responded_to = 3), None)
+        clock.advance(0)
+        self.assertEqual(statuses(uls), [0xFF00] * dimse.FindResponder.batch_size + [0xFE00])
+        self.assertEqual(results, [0, 0xFE00])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_dispatch(self):
+        """
+        Test that every DIMSE message class is dispatched to its *_received
+        method, also when replaced on the instance, and that
+        register_DIMSE_handler overrides it.
+        """
+        uls = dimse.DIMSEProtocol()
+        received = []
+        for dimse_class in dimsemessages.commands:
+            setattr(uls, dimse_class.__name__ + "_received", lambda *args: received.append(args))
+            cmd = dimse_class()
+            uls.DIMSE_command_received(1, cmd, None)
+            self.assertEqual(received.pop(), (1, cmd, None))
+            delattr(uls, dimse_class.__name__ + "_received")
+        uls.register_DIMSE_handler(dimsemessages.C_ECHO_RQ, lambda *args: received.append(args))
+        cmd = dimsemessages.C_ECHO_RQ()
+        uls.DIMSE_command_received(1, cmd, None)
+        self.assertEqual(received, [(1, cmd, None)])
+        self.assertRaises(NotImplementedError, uls.DIMSE_command_received, 1, dimsemessages.C_STORE_RQ(), None)
+        uls.unrecognized_or_invalid_DIMSE_received = lambda *args: received.append(args)
+        uls.DIMSE_command_received(1, "unknown", None)
+        self.assertEqual(received[-1], (1, "unknown", None))
+
+    def test_recv_raw(self):
+        """
+        Test that data sets of raw_dataset_commands are passed on
+        undecoded, and can be written to a DICOM file as they are.
+        """
+        ds = dicom.dataset.Dataset()
+        ds.SOPClassUID = utils.get_uid("CT Image Storage")
+        ds.SOPInstanceUID = "1.2.3.4"
+        ds.PatientName = "Doe^John"
+        data = dimsemessages.pack_dataset(ds)
+        command = dimsemessages.C_STORE_RQ(message_id = 3, 
+                                           affected_sop_class_uid = ds.SOPClassUID,
+                                           affected_sop_instance_uid = ds.SOPInstanceUID).pack()
+        uls = DIMSETester()
+        uls.raw_dataset_commands = (dimsemessages.C_STORE_RQ,)
+        uls.state = 6
+        uls.dataReceived(pdu.P_DATA_TF([(1, "\x03" + command)]).pack() +
+                         pdu.P_DATA_TF([(1, "\x00" + data[:9])]).pack() +
+                         pdu.P_DATA_TF([(1, "\x02" + data[9:])]).pack())
+        self.assertEqual(len(uls._received), 1)
+        presentation_context_id, cmd, sink = uls._received[0]
+        self.assertEqual(cmd.__class__, dimsemessages.C_STORE_RQ)
+        self.assertTrue(isinstance(sink, dimsemessages.DatasetSink))
+        self.assertEqual(sink.transfer_syntax, dicom.UID.ImplicitVRLittleEndian)
+        self.assertEqual(sink.getvalue(), data)
+
+        fn = self.mktemp()
+        utils.write_part10(fn, sink, cmd.affected_sop_class_uid, cmd.affected_sop_instance_uid)
+        sink.close()
+        f = open(fn, 'rb')
+        self.assertEqual(f.read()[-len(data):], data)
+        f.close()
+        ds2 = dicom.read_file(fn)
+        self.assertEqual(ds2.file_meta.TransferSyntaxUID, dicom.UID.ImplicitVRLittleEndian)
+        self.assertEqual(ds2.file_meta.MediaStorageSOPInstanceUID, ds.SOPInstanceUID)
+        self.assertEqual(ds2.PatientName, ds.PatientName)
+        self.assertEqual(ds2.SOPInstanceUID, ds.SOPInstanceUID)
+        # A data set given as a string needs its transfer syntax
+        self.assertRaises(ValueError, utils.write_part10, self.mktemp(), data, 
+                          cmd.affected_sop_class_uid, cmd.affected_sop_instance_uid)
         
 
+class FindResponderTestCase(unittest.TestCase):
+    timeout = 30
+
+    @defer.inlineCallbacks
+    def test_threaded(self):
+        """
+        Test that FindResponder pulls results in threads, one batch at a
+        time, and that a C-CANCEL-RQ is answered while a batch is being
+        pulled.
+        """
+        def statuses(uls):
+            return [dimsemessages.unpack_command_set(value[1:]).Status 
+                    for data_values in uls._sent for context_id, value in data_values if value[0] == "\x03"]
+
+        in_io_thread = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+        def matches():
+            for i in range(40):
+                if i == dimse.FindResponder.batch_size:
+                    # Matching the next batch takes a while
+                    release.wait()
+                in_io_thread.append(threadable.isInIOThread())
+                yield dicom.dataset.Dataset()
+        results = matches()
+
+        uls = DIMSETester()
+        find_rq = dimsemessages.C_FIND_RQ(message_id = 3)
+        d = uls.respond_to_find(1, find_rq, results)
+        # The next batch is pulled in a call scheduled after the first one
+        # is sent
+        while len(statuses(uls)) < dimse.FindResponder.batch_size or uls.responders[3].pulling == None:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        uls.C_CANCEL_RQ_received(1, dimsemessages.C_CANCEL_RQ(message_id_being_responded_to = 3), None)
+        self.assertEqual(statuses(uls), [0xFF00] * dimse.FindResponder.batch_size + [0xFE00])
+        status = yield d
+        self.assertEqual(status, 0xFE00)
+        release.set()
+        while results.gi_frame != None:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(in_io_thread, [False] * (dimse.FindResponder.batch_size + 1))
+        self.assertEqual(statuses(uls), [0xFF00] * dimse.FindResponder.batch_size + [0xFE00])
@@ -55,7 +55,10 @@ from twisteddicom.dimsemessages import C_FIND_RQ, C_FIND_RSP, C_MOVE_RQ, C_MOVE_
 from twisteddicom.dimsemessages import N_EVENT_REPORT_RQ, N_EVENT_REPORT_RSP, N_GET_RQ, N_GET_RSP
 from twisteddicom.dimsemessages import N_SET_RQ, N_SET_RSP, N_ACTION_RQ, N_ACTION_RSP
 from twisteddicom.dimsemessages import N_DELETE_RQ, N_DELETE_RSP, N_CREATE_RQ, N_CREATE_RSP, C_CANCEL_RQ
-from twisteddicom.dimsemessages import unpack_dataset, commands
+from twisteddicom.dimsemessages import unpack_dataset, pack_dataset, commands, DatasetSink
+from twisteddicom.dimsemessages import CommandSet, pack_command_set, unpack_command_set
+from twisteddicom.dimsemessages import pack_dataset_with_commandgrouplength
+import dicom
 
 class DIMSEMessagesTestCase(unittest.SynchronousTestCase):
     def test_roundtrip(self):
@@ -77,3 +80,59 @@ class DIMSEMessagesTestCase(unittest.SynchronousTestCase):
                 self.assertEqual(obj.__dict__, rp.__dict__)
                 self.assertEqual(p, prp)
 
+    def test_command_set_codec(self):
+        """
+        Test that pack_command_set and unpack_command_set agree with
+        encoding and decoding command sets through pydicom.
+        """
+        for cls in [C_STORE_RQ, C_STORE_RSP, C_GET_RQ, C_GET_RSP, 
+                    C_FIND_RQ, C_FIND_RSP, C_MOVE_RQ, C_MOVE_RSP, C_ECHO_RQ, C_ECHO_RSP, 
+                    N_EVENT_REPORT_RQ, N_EVENT_REPORT_RSP, N_GET_RQ, N_GET_RSP, 
+                    N_SET_RQ, N_SET_RSP, N_ACTION_RQ, N_ACTION_RSP, 
+                    N_DELETE_RQ, N_DELETE_RSP, N_CREATE_RQ, N_CREATE_RSP, C_CANCEL_RQ]:
+            for obj in tf_DIMSE(cls):
+                p = obj.pack()
+                cs = unpack_command_set(p)
+                pd = unpack_dataset(p)
+                self.assertEqual(sorted(cs.keys()), sorted(pd.keys()))
+                ds = dicom.dataset.Dataset()
+                for tag in cs:
+                    self.assertEqual(cs[tag], pd[tag].value)
+                    if tag != 0x00000000:
+                        ds[tag] = pd[tag]
+                self.assertEqual(pack_dataset_with_commandgrouplength(ds), p)
+                self.assertEqual(pack_command_set(cs), p)
+                rp = cls()
+                rp.unpack(cs)
+                self.assertEqual(obj.__dict__, rp.__dict__)
+
+        cs = CommandSet()
+        cs.MoveDestination = "ODD"
+        cs.OffendingElement = [0x00100010, 0x00100020]
+        cs[0x00004000] = "kept"
+        self.assertEqual(cs.MoveDestination, "ODD")
+        self.assertRaises(AttributeError, getattr, cs, 'Status')
+        rcs = unpack_command_set(pack_command_set(cs))
+        self.assertEqual(rcs.CommandGroupLength, len(pack_command_set(cs)) - 12)
+        del rcs.CommandGroupLength
+        self.assertEqual(rcs, cs)
+
+    def test_dataset_sink(self):
+        """
+        Test that a data set written in pieces to a DatasetSink is spooled to
+        disk above the threshold and decodes like the string it was made from.
+        """
+        ds = dicom.dataset.Dataset()
+        ds.PatientID = "12345678"
+        ds.PatientName = "Doe^John"
+        ds.StudyDescription = "x" * 100
+        buf = pack_dataset(ds)
+        for threshold, spooled in ((len(buf) + 1, False), (len(buf) // 2, True)):
+            sink = DatasetSink(spool_threshold = threshold)
+            for i in range(0, len(buf), 7):
+                sink.write(buf[i:i + 7])
+            self.assertEqual(len(sink), len(buf))
+            self.assertEqual(sink.spooled, spooled)
+            self.assertEqual(sink.getvalue(), buf)
+            self.assertEqual(unpack_dataset(sink), unpack_dataset(buf))
+            sink.close()
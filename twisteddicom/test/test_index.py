@@ -0,0 +1,187 @@
+"""
+Test cases for twisteddicom.index
+"""
+
+import os
+import dicom
+from twisteddicom import index, utils, dimsemessages
+from twisteddicom.test.test_dimse import DIMSETester
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import threadable
+
+def make_dataset(patient, study, series, instance, **kw):
+    ds = dicom.dataset.Dataset()
+    ds.PatientID = "P%i" % (patient,)
+    ds.PatientName = "Doe^%s" % ("John", "Jane")[patient]
+    ds.StudyInstanceUID = "1.2.3.%i" % (study,)
+    ds.StudyDate = "2012010%i" % (study + 1,)
+    ds.StudyDescription = "Study %i" % (study,)
+    ds.SeriesInstanceUID = "1.2.3.%i.%i" % (study, series)
+    ds.Modality = ("CT", "MR")[series % 2]
+    ds.SeriesNumber = str(series + 1)
+    ds.SOPClassUID = utils.get_uid("CT Image Storage")
+    ds.SOPInstanceUID = "1.2.3.%i.%i.%i" % (study, series, instance)
+    ds.InstanceNumber = str(instance + 1)
+    for keyword, value in kw.iteritems():
+        setattr(ds, keyword, value)
+    return ds
+
+def write_dataset(ds, fn):
+    file_meta = dicom.dataset.Dataset()
+    file_meta.TransferSyntaxUID = dicom.UID.ImplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    file_meta.ImplementationClassUID = utils.implementation_class_uid
+    fds = dicom.dataset.FileDataset(fn, ds, file_meta = file_meta, preamble = "\0" * 128)
+    fds.is_little_endian = True
+    fds.is_implicit_VR = True
+    fds.save_as(fn)
+
+def make_query(level, **kw):
+    query = dicom.dataset.Dataset()
+    query.QueryRetrieveLevel = level
+    for keyword, value in kw.iteritems():
+        setattr(query, keyword, value)
+    return query
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = self.mktemp()
+        os.makedirs(self.folder)
+        self.datasets = []
+        for patient, study in [(0, 0), (0, 1), (1, 2)]:
+            for series in range(2):
+                for instance in range(2):
+                    kw = {}
+                    if study == 2:
+                        kw["BodyPartExamined"] = "HEAD"
+                    ds = make_dataset(patient, study, series, instance, **kw)
+                    write_dataset(ds, os.path.join(self.folder, "%s.dcm" % (ds.SOPInstanceUID,)))
+                    self.datasets.append(ds)
+        self.index = index.Index()
+        self.index.update_folder(self.folder)
+
+    def scan(self, query):
+        """Find query the way the example SCPs do without an index."""
+        results = []
+        level_ids_done = set()
+        for ds in self.datasets:
+            level_id = utils.get_level_identifier(ds, query.QueryRetrieveLevel)
+            if level_id in level_ids_done:
+                continue
+            level_ids_done.add(level_id)
+            is_match, result_ds = utils.match_dataset(query, ds)
+            if is_match:
+                results.append(result_ds)
+        return results
+
+    def assertFindEqual(self, query):
+        key = lambda ds: sorted((elem.tag, str(elem.value)) for elem in ds)
+        expected = sorted(key(ds) for ds in self.scan(query))
+        self.assertNotEqual(expected, [])
+        self.assertEqual(sorted(key(ds) for ds in self.index.find(query)), expected)
+
+    def test_find(self):
+        """
+        Test that find() returns what match_dataset() does on every file,
+        both for keys held in the index and keys that are not.
+        """
+        self.assertEqual(len(self.index), 12)
+        self.assertFindEqual(make_query("PATIENT", PatientID = "", PatientName = "Doe^J*"))
+        self.assertFindEqual(make_query("PATIENT", PatientID = "P1", PatientName = ""))
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "", StudyDate = "20120101-20120102", PatientName = ""))
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "1.2.3.0\\1.2.3.2", StudyDescription = "*"))
+        self.assertFindEqual(make_query("SERIES", SeriesInstanceUID = "", Modality = "MR", StudyInstanceUID = "1.2.3.1"))
+        self.assertFindEqual(make_query("IMAGE", SOPInstanceUID = "", InstanceNumber = "2", Modality = "CT"))
+        self.assertFindEqual(make_query("SERIES", SeriesInstanceUID = "1.2.3.?.1", StudyDate = "20120102-"))
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "", BodyPartExamined = "HEAD"))
+        self.assertEqual(list(self.index.find(make_query("PATIENT", PatientID = "P2"))), [])
+
+    def test_find_multi_valued(self):
+        """
+        Test that any one of the values of a multi-valued attribute matches,
+        like in match_dataset().
+        """
+        ds = make_dataset(1, 3, 0, 0, ReferringPhysicianName = ["Doe^A", "Roe^B", "Poe^C"],
+                          StudyDate = ["20120301", "20120101"])
+        write_dataset(ds, os.path.join(self.folder, "%s.dcm" % (ds.SOPInstanceUID,)))
+        self.datasets.append(ds)
+        self.index.update_folder(self.folder)
+        for name in ("Doe^A", "Roe^B", "Poe^C", "R*", "*^C"):
+            self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "", ReferringPhysicianName = name))
+        self.assertEqual(len(list(self.index.find(make_query("STUDY", StudyInstanceUID = "", ReferringPhysicianName = "Doe")))), 0)
+        self.assertFindEqual(make_query("STUDY", StudyInstanceUID = "", StudyDate = "-20120115"))
+
+    def test_files(self):
+        """
+        Test that files() returns all files below the matching entities, and
+        that removed files are forgotten. instances() adds the SOP classes.
+        """
+        files = self.index.files(make_query("STUDY", StudyInstanceUID = "1.2.3.1"))
+        self.assertEqual(sorted(os.path.basename(f) for f in files),
+                         ["1.2.3.1.%i.%i.dcm" % (series, instance) for series in range(2) for instance in range(2)])
+        self.assertEqual(len(self.index.files(make_query("PATIENT", PatientID = "P0"))), 8)
+        self.assertEqual(sorted(self.index.instances(make_query("STUDY", StudyInstanceUID = "1.2.3.1"))),
+                         [(f, utils.get_uid("CT Image Storage")) for f in sorted(files)])
+
+        for f in files:
+            os.remove(f)
+        self.index.update_folder(self.folder)
+        self.assertEqual(len(self.index), 8)
+        self.assertEqual(self.index.files(make_query("STUDY", StudyInstanceUID = "1.2.3.1")), [])
+        self.assertEqual(self.index.db.execute("SELECT COUNT(*) FROM series").fetchone()[0], 4)
+        self.assertEqual(self.index.db.execute("SELECT COUNT(*) FROM study").fetchone()[0], 2)
+        self.assertEqual(self.index.db.execute("SELECT COUNT(*) FROM patient").fetchone()[0], 2)
+
+    def test_mtimes(self):
+        """
+        Test that mtimes() reads all files in chunks, including changes made
+        without committing them.
+        """
+        self.index.mtimes_chunk_size = 5
+        mtimes = self.index.mtimes()
+        self.assertEqual(sorted(mtimes), sorted(os.path.join(self.folder, "%s.dcm" % (ds.SOPInstanceUID,)) 
+                                                for ds in self.datasets))
+        self.index.add(make_dataset(1, 2, 2, 0), "new.dcm", 1.0, commit = False)
+        self.assertEqual(self.index.mtimes(), dict(mtimes, **{"new.dcm": 1.0}))
+
+    def test_lock(self):
+        """
+        Test that reading the index waits for lock, which is held while it
+        is changed from another thread.
+        """
+        import threading
+        query = make_query("SERIES", PatientID = "P1", SeriesInstanceUID = "")
+        for f in [lambda: list(self.index.find(query)), lambda: self.index.files(query), 
+                  self.index.mtimes, lambda: self.index.get_property("x"), self.index.__len__]:
+            done = []
+            self.index.lock.acquire()
+            thread = threading.Thread(target = lambda: done.append(f()))
+            thread.start()
+            thread.join(0.05)
+            self.assertEqual(done, [])
+            self.index.lock.release()
+            thread.join()
+            self.assertEqual(len(done), 1)
+
+    @defer.inlineCallbacks
+    def test_find_in_thread(self):
+        """
+        Test that the files read by find() for keys not held in the index
+        are read in threads when the results are sent by respond_to_find().
+        """
+        in_io_thread = []
+        def read_header(path):
+            in_io_thread.append(threadable.isInIOThread())
+            return utils.read_header(path)
+        self.patch(index, "read_header", read_header)
+
+        query = make_query("STUDY", StudyInstanceUID = "", BodyPartExamined = "HEAD")
+        results = self.index.find(query)
+        self.assertEqual(in_io_thread, [])
+        uls = DIMSETester()
+        status = yield uls.respond_to_find(1, dimsemessages.C_FIND_RQ(message_id = 1), results)
+        self.assertEqual(status, 0)
+        self.assertNotEqual(in_io_thread, [])
+        self.assertEqual(set(in_io_thread), set([False]))
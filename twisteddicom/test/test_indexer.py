@@ -0,0 +1,133 @@
+"""
+Test cases for twisteddicom.indexer
+"""
+
+import os
+import threading
+from twisteddicom import index, indexer
+from twisteddicom.test.test_index import make_dataset, write_dataset
+from twisted.trial import unittest
+from twisted.internet import defer, task, reactor
+
+class IndexerTestCase(unittest.TestCase):
+    timeout = 30
+
+    def setUp(self):
+        self.folder = os.path.abspath(self.mktemp())
+        os.makedirs(self.folder)
+        for instance in range(4):
+            self.write(instance)
+        self.index = index.Index()
+        self.reads = []
+
+    def write(self, instance):
+        ds = make_dataset(0, 0, 0, instance)
+        path = os.path.join(self.folder, "%i.dcm" % (instance,))
+        write_dataset(ds, path)
+        return path
+
+    def make_indexer(self):
+        i = indexer.Indexer(self.index, self.folder)
+        read = i.read
+        def counting_read(path):
+            self.reads.append(path)
+            return read(path)
+        i.read = counting_read
+        self.addCleanup(i.stop)
+        return i
+
+    @defer.inlineCallbacks
+    def test_reconcile(self):
+        """
+        Test that reconcile() reads new and modified files only, and forgets
+        removed files.
+        """
+        i = self.make_indexer()
+        yield i.reconcile()
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(len(self.reads), 4)
+        self.assertEqual(i.pending, {})
+
+        del self.reads[:]
+        os.remove(os.path.join(self.folder, "0.dcm"))
+        path = self.write(1)
+        os.utime(path, (0, 0))
+        open(os.path.join(self.folder, "junk.dcm"), "wb").write("not DICOM")
+        yield i.reconcile()
+        self.flushLoggedErrors()
+        self.assertEqual(sorted(os.path.basename(path) for path in self.reads), ["1.dcm", "junk.dcm"])
+        self.assertEqual(sorted(os.path.basename(path) for path in self.index.mtimes()), ["1.dcm", "2.dcm", "3.dcm"])
+        self.assertEqual(self.index.mtimes()[path], 0)
+
+        del self.reads[:]
+        yield i.reconcile()
+        self.assertEqual(self.reads, [])
+
+    @defer.inlineCallbacks
+    def test_writer(self):
+        """
+        Test that the index is changed and committed in one thread, which is
+        not the reactor thread.
+        """
+        threads = []
+        def recording(method):
+            def f(*args, **kw):
+                threads.append((method.__name__, threading.current_thread()))
+                return method(*args, **kw)
+            return f
+        for name in ("add", "remove", "commit"):
+            setattr(self.index, name, recording(getattr(self.index, name)))
+        i = self.make_indexer()
+        yield i.reconcile()
+        os.remove(os.path.join(self.folder, "0.dcm"))
+        yield i.reconcile()
+        self.assertEqual(sorted(set(name for name, thread in threads)), ["add", "commit", "remove"])
+        self.assertEqual(len(set(thread for name, thread in threads)), 1)
+        self.assertNotEqual(threads[0][1], threading.current_thread())
+        self.assertEqual(len(self.index), 3)
+
+    @defer.inlineCallbacks
+    def test_start(self):
+        """
+        Test that start() reconciles the index, so that a file changed in
+        place while not running is read again, and nothing else is.
+        """
+        yield self.make_indexer().reconcile()
+        del self.reads[:]
+        path = os.path.join(self.folder, "1.dcm")
+        folder_mtime = os.path.getmtime(self.folder)
+        write_dataset(make_dataset(0, 0, 0, 1), path)
+        os.utime(path, (0, 0))
+        self.assertEqual(os.path.getmtime(self.folder), folder_mtime)
+        i = self.make_indexer()
+        i.reconcile_interval = 3600
+        i.start()
+        while self.index.mtimes()[path] != 0:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(self.reads, [path])
+        i.stop()
+        os.remove(os.path.join(self.folder, "0.dcm"))
+        i = self.make_indexer()
+        i.reconcile_interval = 3600
+        i.start()
+        while len(self.index) != 3:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(self.reads, [path])
+
+    @defer.inlineCallbacks
+    def test_notify(self):
+        """
+        Test that files are indexed as they are written when inotify is
+        available, and that the lag is measured.
+        """
+        i = self.make_indexer()
+        i.reconcile_interval = 3600
+        i.start()
+        if i.notifier == None:
+            raise unittest.SkipTest("inotify is not available")
+        yield task.deferLater(reactor, 0, lambda: None)
+        self.write(4)
+        while len(self.index) < 5:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertTrue(0 <= i.last_lag < 10)
+        self.assertEqual(i.lag(), 0)
@@ -2,6 +2,8 @@
 Test cases for twisteddicom.sockhandler
 """
 
+import struct
+
 from twisteddicom import sockhandler, pdu
 import test_factory
 from twisted.trial import unittest
@@ -23,3 +25,33 @@ class DICOMUpperLayerServiceReceiverTestCase(unittest.SynchronousTestCase):
             repacked_pdu_data = unpacked_pdu.pack()
             self.assertEqual(pdu_data, repacked_pdu_data)
 
+    def test_pack_sequence(self):
+        """
+        Test that P-DATA-TF PDUs are encoded as a sequence of strings with
+        the presentation data values as they are, given either as strings
+        or as sequences of strings.
+        """
+        fragment = "x" * 1000
+        data = pdu.P_DATA_TF([(1, "\x03" + "command"), (1, ("\x02", fragment))])
+        seq = data.pack_sequence()
+        self.assertTrue(seq[-1] is fragment)
+        self.assertEqual("".join(seq), data.pack())
+        self.assertEqual(len(data.pack()), len(data))
+        unpacked = pdu.P_DATA_TF()
+        unpacked.unpack(data.pack())
+        self.assertEqual(unpacked.data_values, [(1, "\x03command"), (1, "\x02" + fragment)])
+
+    def test_invalid_p_data_tf(self):
+        """
+        Test that malformed P-DATA-TF PDUs raise pdu.InvalidPDUError.
+        """
+        valid = pdu.P_DATA_TF([(1, "\x03command")]).pack()
+        for data in [valid[:-1],
+                     # Item length past the end of the PDU
+                     valid[:6] + struct.pack("!I", 100) + valid[10:],
+                     # Item length without a message control header
+                     valid[:6] + struct.pack("!I", 1) + valid[10:],
+                     # Trailing bytes too short for an item
+                     struct.pack("!BBI", 4, 0, len(valid) - 3) + valid[6:] + "\x00" * 3]:
+            self.assertRaises(pdu.InvalidPDUError, pdu.P_DATA_TF().unpack, data)
+
@@ -3,6 +3,8 @@ Test cases for twisteddicom.sockhandler
 """
 
 
+import struct
+
 from twisteddicom import sockhandler, pdu
 import test_factory
 from twisted.trial import unittest
@@ -36,3 +38,106 @@ class DICOMUpperLayerServiceProtocolTestCase(unittest.SynchronousTestCase):
                 self.assertEqual(len(uls.received), 1)
                 self.assertEqual(uls.received[0].pack(), test_pdu.pack())
 
+
+    def test_several_packets_per_read(self):
+        """
+        Test that several PDUs arriving in one read are all delivered, and
+        that a trailing partial PDU is kept for the next read.
+        """
+        pdus = [tf() for tf in test_factory.test_factories.itervalues()]
+        stream = "".join(p.pack() for p in pdus)
+        transport = proto_helpers.StringIOWithoutClosing()
+        uls = DICOMUpperLayerServiceTester()
+        uls.makeConnection(protocol.FileWrapper(transport))
+        uls.dataReceived(stream[:-3])
+        self.assertEqual(len(uls.received), len(pdus) - 1)
+        self.assertEqual(len(uls._framer), len(pdus[-1].pack()) - 3)
+        uls.dataReceived(stream[-3:])
+        self.assertEqual([p.pack() for p in uls.received], [p.pack() for p in pdus])
+        self.assertEqual(len(uls._framer), 0)
+
+class DICOMUpperLayerServiceStreamingTester(DICOMUpperLayerServiceTester):
+    stream_p_data = True
+
+class PDUFramerStreamingTestCase(unittest.SynchronousTestCase):
+    def test_streamed_p_data(self):
+        """
+        Test that P-DATA-TF PDUs are delivered as PDV fragments that add up
+        to the original presentation data values, for different packet sizes.
+        """
+        data_values = [(1, "\x01" + "command"), (1, "\x02"), (3, "\x00" + "x" * 37)]
+        pdu_data = pdu.P_DATA_TF(data_values).pack() + test_factory.tf_A_ABORT().pack()
+        for packet_size in range(1, len(pdu_data)):
+            transport = proto_helpers.StringIOWithoutClosing()
+            uls = DICOMUpperLayerServiceStreamingTester()
+            uls.makeConnection(protocol.FileWrapper(transport))
+            for i in range(len(pdu_data) // packet_size + 1):
+                uls.dataReceived(pdu_data[i * packet_size:(i + 1) * packet_size])
+                # Only incomplete PDV or PDU headers are ever buffered.
+                self.assertTrue(len(uls._framer) < 10)
+            fragments = [x for x in uls.received if isinstance(x, pdu.PDVFragment)]
+            self.assertTrue(fragments[0].pdu_start)
+            self.assertFalse(any(x.pdu_start for x in fragments[1:]))
+            values = []
+            for fragment in fragments:
+                if fragment.pdv_start:
+                    values.append((fragment.presentation_context_id, 
+                                   chr(fragment.message_control_header)))
+                cid, value = values[-1]
+                values[-1] = (cid, value + fragment.data)
+                if fragment.pdv_end:
+                    self.assertEqual(values[-1], data_values[len(values) - 1])
+            self.assertEqual(values, data_values)
+            self.assertEqual(uls.received[-1].__class__, pdu.A_ABORT)
+
+class DICOMUpperLayerServiceInvalidTester(DICOMUpperLayerServiceTester):
+    def __init__(self):
+        super(DICOMUpperLayerServiceInvalidTester, self).__init__()
+        self.invalid = 0
+    def unrecognized_or_invalid_PDU_received(self, data):
+        self.invalid += 1
+
+class PDUFramerInvalidTestCase(unittest.SynchronousTestCase):
+    def test_invalid_pdu(self):
+        """
+        Test that data that can not be framed as PDUs is reported once
+        through unrecognized_or_invalid_PDU_received, and that nothing
+        received after it is delivered.
+        """
+        valid = pdu.P_DATA_TF([(1, "\x03command")]).pack()
+        abort = test_factory.tf_A_ABORT().pack()
+        for stream_p_data in [False, True]:
+            for data in ["\xff" + valid[1:],
+                         valid[:6] + struct.pack("!I", 100) + valid[10:]]:
+                uls = DICOMUpperLayerServiceInvalidTester()
+                uls.stream_p_data = stream_p_data
+                uls._framer = sockhandler.PDUFramer(stream_p_data = stream_p_data)
+                uls.makeConnection(protocol.FileWrapper(proto_helpers.StringIOWithoutClosing()))
+                uls.dataReceived(abort + data + abort)
+                uls.dataReceived(abort)
+                self.assertEqual(uls.invalid, 1)
+                self.assertEqual([x.__class__ for x in uls.received], [pdu.A_ABORT])
+                self.assertEqual(len(uls._framer), 0)
+
+class PDUDispatchTestCase(unittest.SynchronousTestCase):
+    def test_dispatch(self):
+        """
+        Test that every PDU class is dispatched to its *_PDU_received
+        method, also when replaced on the instance, and that
+        register_PDU_handler overrides it.
+        """
+        uls = sockhandler.DICOMUpperLayerServiceProtocol()
+        received = []
+        for pdu_class, name in sockhandler.PDU_handler_names.iteritems():
+            setattr(uls, name, received.append)
+            data = pdu_class()
+            uls.pdu_received(data)
+            self.assertTrue(received.pop() is data)
+            delattr(uls, name)
+        uls.register_PDU_handler(pdu.A_ABORT, received.append)
+        data = pdu.A_ABORT()
+        uls.pdu_received(data)
+        self.assertEqual(received, [data])
+        uls.unrecognized_or_invalid_PDU_received = received.append
+        uls.pdu_received("unknown")
+        self.assertEqual(received[-1], "unknown")
@@ -0,0 +1,198 @@
+"""
+Test cases for twisteddicom.store
+"""
+
+import os
+from twisteddicom import dimse, dimsemessages, pdu, store, uids
+from twisteddicom.test.test_index import make_dataset, write_dataset
+from twisted.trial import unittest
+from twisted.internet import defer, protocol, reactor
+from twisted.python import threadable
+
+class PrefetcherTestCase(unittest.TestCase):
+    timeout = 30
+
+    @defer.inlineCallbacks
+    def test_get(self):
+        """
+        Test that get() returns the data sets in the order of the files,
+        reading at most size files ahead, and fails for unreadable files.
+        """
+        folder = self.mktemp()
+        os.makedirs(folder)
+        paths = []
+        for instance in range(6):
+            paths.append(os.path.join(folder, "%i.dcm" % (instance,)))
+            write_dataset(make_dataset(0, 0, 0, instance), paths[-1])
+        paths.insert(3, os.path.join(folder, "missing.dcm"))
+        read = []
+        def lazy_paths():
+            for path in paths:
+                read.append(path)
+                yield path
+
+        prefetcher = store.Prefetcher(lazy_paths(), size = 2)
+        self.assertEqual(len(read), 2)
+        uids = []
+        for i in range(3):
+            ds = yield prefetcher.get()
+            uids.append(ds.SOPInstanceUID)
+            self.assertEqual(len(read), i + 3)
+        yield self.assertFailure(prefetcher.get(), IOError)
+        while True:
+            ds = yield prefetcher.get()
+            if ds == None:
+                break
+            uids.append(ds.SOPInstanceUID)
+        self.assertEqual(uids, ["1.2.3.0.0.%i" % (instance,) for instance in range(6)])
+
+class AssociationLimiterTestCase(unittest.TestCase):
+    def test_run(self):
+        """
+        Test that run() waits while a destination has as many associations
+        as its limit, independently of other destinations.
+        """
+        limiter = store.AssociationLimiter(default_limit = 1, limits = {"a": 2})
+        associations = []
+        def associate(destination):
+            d = defer.Deferred()
+            associations.append((destination, d))
+            return d
+        results = [limiter.run(destination, associate, destination) for destination in ("a", "a", "a", "b", "b")]
+        self.assertEqual([destination for destination, d in associations], ["a", "a", "b"])
+        associations[0][1].callback(1)
+        self.assertEqual([destination for destination, d in associations], ["a", "a", "b", "a"])
+        for destination, d in associations[1:]:
+            d.callback(2)
+        self.assertEqual([destination for destination, d in associations], ["a", "a", "b", "a", "b"])
+        associations[-1][1].callback(3)
+        self.assertEqual([d.result for d in results], [1, 2, 2, 2, 3])
+        self.assertEqual(limiter.semaphores, {})
+
+class StoreSCP(dimse.DIMSEProtocol):
+    """Answers C-STORE-RQs and records what it receives."""
+    maximum_number_operations_performed = 0
+
+    def __init__(self, received, transfer_syntax = None):
+        super(StoreSCP, self).__init__(supported_abstract_syntaxes = [uids.CTImageStorage])
+        self.received = received
+        self.transfer_syntax = transfer_syntax
+
+    def validate_presentation_contexts(self, a_associate_rq):
+        pcis = super(StoreSCP, self).validate_presentation_contexts(a_associate_rq)
+        if self.transfer_syntax != None:
+            for pci in pcis:
+                pci.transfer_syntax = pdu.TransferSyntaxSubitem(self.transfer_syntax)
+        return pcis
+
+    def C_STORE_RQ_received(self, presentation_context_id, store_rq, ds):
+        self.received.append((self, ds.SOPInstanceUID))
+        self.accepted_transfer_syntax = self.presentation_contexts[presentation_context_id].transfer_syntax
+        self.send_DIMSE_command(presentation_context_id,
+                                dimsemessages.C_STORE_RSP(message_id_being_responded_to = store_rq.message_id,
+                                                          affected_sop_class_uid = store_rq.affected_sop_class_uid,
+                                                          affected_sop_instance_uid = store_rq.affected_sop_instance_uid,
+                                                          status = 0))
+
+class StoreTestCase(unittest.TestCase):
+    timeout = 30
+
+    def setUp(self):
+        self.folder = self.mktemp()
+        os.makedirs(self.folder)
+        self.paths = []
+        for instance in range(10):
+            self.paths.append(os.path.join(self.folder, "%i.dcm" % (instance,)))
+            write_dataset(make_dataset(0, 0, 0, instance), self.paths[-1])
+        self.received = []
+        self.transfer_syntax = None
+        factory = protocol.Factory()
+        factory.buildProtocol = lambda addr: StoreSCP(self.received, self.transfer_syntax)
+        self.port = reactor.listenTCP(0, factory, interface = "127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+
+    def test_read_instance(self):
+        """
+        Test that read_instance() describes a file by its File Meta
+        Information, and that read_instances() skips unreadable files.
+        """
+        instance = store.read_instance(self.paths[3])
+        self.assertEqual(instance.path, self.paths[3])
+        self.assertEqual(instance.sop_class_uid, uids.CTImageStorage)
+        self.assertEqual(instance.sop_instance_uid, "1.2.3.0.0.3")
+        self.assertEqual(instance.transfer_syntax, uids.ImplicitVRLittleEndian)
+        open(os.path.join(self.folder, "bad.dcm"), "wb").write("not DICOM")
+        instances = store.read_instances(self.paths[:2] + [os.path.join(self.folder, "bad.dcm")])
+        self.assertEqual([instance.path for instance in instances], self.paths[:2])
+        self.flushLoggedErrors()
+
+    @defer.inlineCallbacks
+    def test_store(self):
+        """
+        Test that store() sends every instance once over parallel
+        associations, and reports each instance through its Deferred.
+        """
+        instances = store.read_instances(self.paths)
+        yield store.store(instances, "127.0.0.1", self.port.getHost().port, "SCU", "SCP",
+                          parallelism = 2, window = 4)
+        self.assertEqual(sorted(uid for scp, uid in self.received), sorted("1.2.3.0.0.%i" % (i,) for i in range(10)))
+        self.assertEqual(len(set(scp for scp, uid in self.received)), 2)
+        for instance in instances:
+            rsp = yield instance.deferred
+            self.assertEqual(rsp.status, 0)
+            self.assertEqual(rsp.affected_sop_instance_uid, instance.sop_instance_uid)
+
+    @defer.inlineCallbacks
+    def test_store_encoded(self):
+        """
+        Test that files in the transfer syntax of the presentation context
+        are sent as they are, without pydicom, and that others are
+        re-encoded.
+        """
+        def read_file(*args, **kwargs):
+            raise AssertionError("File decoded")
+        patcher = self.patch(store.dicom, "read_file", read_file)
+        instances = store.read_instances(self.paths[:2])
+        encoded = open(self.paths[0], "rb").read()[instances[0].data_offset:]
+        self.assertEqual(store.read_encoded(instances[0]), encoded)
+        self.patch(store, "read_into_memory_size", 0)
+        self.assertEqual(store.read_encoded(instances[0])[:], encoded)
+        yield store.store(instances, "127.0.0.1", self.port.getHost().port, "SCU", "SCP")
+        self.assertEqual(sorted(uid for scp, uid in self.received), ["1.2.3.0.0.0", "1.2.3.0.0.1"])
+        self.assertEqual(self.received[0][0].accepted_transfer_syntax, uids.ImplicitVRLittleEndian)
+
+        patcher.restore()
+        read_file = store.dicom.read_file
+        decoded_in_thread = []
+        def read_file(path, read_file = read_file):
+            decoded_in_thread.append(not threadable.isInIOThread())
+            return read_file(path)
+        self.patch(store.dicom, "read_file", read_file)
+        self.received[:] = []
+        self.transfer_syntax = uids.ExplicitVRLittleEndian
+        instances = store.read_instances(self.paths[:2])
+        yield store.store(instances, "127.0.0.1", self.port.getHost().port, "SCU", "SCP")
+        self.assertEqual(sorted(uid for scp, uid in self.received), ["1.2.3.0.0.0", "1.2.3.0.0.1"])
+        self.assertEqual(self.received[0][0].accepted_transfer_syntax, uids.ExplicitVRLittleEndian)
+        self.assertEqual(decoded_in_thread, [True, True])
+        for instance in instances:
+            rsp = yield instance.deferred
+            self.assertEqual(rsp.status, 0)
+
+    @defer.inlineCallbacks
+    def test_store_datasets(self):
+        """
+        Test that data sets handed out by a loader are encoded in the
+        transfer syntax of the presentation context.
+        """
+        class DatasetLoader(store.InstanceLoader):
+            def load(self, instance):
+                return instance, make_dataset(0, 0, 0, int(instance.path))
+        instances = [store.Instance(str(i), uids.CTImageStorage, "1.2.3.0.0.%i" % (i,), uids.ExplicitVRLittleEndian) 
+                     for i in range(3)]
+        yield store.store(instances, "127.0.0.1", self.port.getHost().port, "SCU", "SCP", 
+                          loader = DatasetLoader(instances))
+        self.assertEqual(sorted(uid for scp, uid in self.received), ["1.2.3.0.0.%i" % (i,) for i in range(3)])
+        for instance in instances:
+            rsp = yield instance.deferred
+            self.assertEqual(rsp.status, 0)
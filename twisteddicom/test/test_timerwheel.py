@@ -0,0 +1,82 @@
+"""
+Test cases for twisteddicom.timerwheel
+"""
+
+from twisteddicom import timerwheel, upper_layer
+from twisted.trial import unittest
+from twisted.internet import error, task
+
+class TimerWheelTestCase(unittest.SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timerwheel.TimerWheel(resolution = 0.5, size = 8, reactor = self.clock)
+        self.fired = []
+
+    def test_fire(self):
+        """
+        Test that timers fire in order, never early and at most one tick
+        late, with at most one reactor call pending.
+        """
+        for delay in (0.2, 0.5, 1.7, 3.0, 11.3):
+            self.wheel.callLater(delay, lambda delay: self.fired.append((delay, self.clock.seconds())), delay)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        while self.clock.getDelayedCalls():
+            self.clock.advance(0.1)
+        self.assertEqual([delay for delay, t in self.fired], [0.2, 0.5, 1.7, 3.0, 11.3])
+        for delay, t in self.fired:
+            self.assertTrue(delay <= t + 1e-9 <= delay + 0.5 + 0.1 + 1e-9, (delay, t))
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        """
+        Test that cancelled timers do not fire, and that the wheel stops
+        ticking when it has no timers.
+        """
+        timer = self.wheel.callLater(1, self.fired.append, 1)
+        self.assertTrue(timer.active())
+        timer.cancel()
+        self.assertFalse(timer.active())
+        self.assertRaises(error.AlreadyCancelled, timer.cancel)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        timer = self.wheel.callLater(1, self.fired.append, 2)
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [2])
+        self.assertRaises(error.AlreadyCalled, timer.cancel)
+
+        timers = []
+        timers.append(self.wheel.callLater(1, lambda: timers[1].cancel()))
+        timers.append(self.wheel.callLater(1, self.fired.append, 3))
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [2])
+
+    def test_stall(self):
+        """
+        Test that timers all fire after the reactor stalls for longer than a
+        full turn of the wheel, and that timers added from a callback fire
+        on a later tick.
+        """
+        for delay in range(20):
+            self.wheel.callLater(delay, self.fired.append, delay)
+        self.wheel.callLater(100, self.fired.append, 100)
+        self.wheel.callLater(0.5, lambda: self.wheel.callLater(0, self.fired.append, "again"))
+        self.clock.advance(50)
+        self.assertEqual(sorted(self.fired), range(20) + ["again"])
+        self.assertEqual(len(self.wheel), 1)
+        self.clock.advance(50)
+        self.assertEqual(self.fired[-1], 100)
+
+    def test_ARTIM(self):
+        """
+        Test that the ARTIM timer runs on the timer wheel.
+        """
+        uls = upper_layer.DICOMUpperLayerServiceProvider()
+        uls.timer_wheel = self.wheel
+        uls.ARTIM_expired = lambda: self.fired.append("ARTIM")
+        uls.start_ARTIM()
+        uls.start_ARTIM()
+        self.assertEqual(len(self.wheel), 1)
+        self.clock.advance(uls.ARTIM_time - 1)
+        uls.stop_ARTIM()
+        uls.start_ARTIM()
+        self.clock.advance(uls.ARTIM_time)
+        self.assertEqual(self.fired, ["ARTIM"])
@@ -0,0 +1,190 @@
+"""
+Test cases for twisteddicom.utils
+"""
+
+import os
+import dicom
+from twisteddicom import utils, uids
+from twisteddicom.test.test_index import make_dataset, write_dataset
+from twisted.trial import unittest
+
+class ReadHeaderTestCase(unittest.TestCase):
+    def test_read_header(self):
+        """
+        Test that read_header() reads everything but the Pixel Data, and
+        that it rejects empty files like dicom.read_file.
+        """
+        ds = make_dataset(0, 0, 0, 0)
+        ds.PixelData = "\0" * 4096
+        fn = self.mktemp()
+        write_dataset(ds, fn)
+        header = utils.read_header(fn)
+        self.assertFalse("PixelData" in header)
+        self.assertEqual(header.SOPInstanceUID, ds.SOPInstanceUID)
+        self.assertEqual(header.PatientName, ds.PatientName)
+        self.assertEqual(header.filename, fn)
+
+        fn = self.mktemp()
+        open(fn, "wb").close()
+        self.assertRaises(dicom.filereader.InvalidDicomError, utils.read_header, fn)
+
+    def test_read_header_truncated(self):
+        """
+        Test that a file truncated while read_header() parses it raises an
+        exception, rather than killing the process like a mapped file.
+        """
+        ds = make_dataset(0, 0, 0, 0)
+        ds.PixelData = "\0" * 4096
+        fn = self.mktemp()
+        write_dataset(ds, fn)
+        class TruncatingFile(object):
+            def __init__(self, fp):
+                self.fp = fp
+            def read(self, size):
+                s = self.fp.read(size)
+                if os.path.getsize(fn) > 0:
+                    open(fn, "wb").close()
+                return s
+            def __getattr__(self, name):
+                return getattr(self.fp, name)
+        read_file = dicom.read_file
+        self.patch(dicom, "read_file", lambda fp, **kw: read_file(TruncatingFile(fp), **kw))
+        self.assertRaises(Exception, utils.read_header, fn)
+        self.assertEqual(os.path.getsize(fn), 0)
+
+class QueryTestCase(unittest.TestCase):
+    def match(self, pattern, value, vr = "LO"):
+        return utils.attribute_match(pattern, value, vr)
+
+    def test_attribute_match(self):
+        """
+        Test single value, wildcard, list of UID and range matching.
+        """
+        self.assertTrue(self.match("", "ABC"))
+        self.assertTrue(self.match("*", "ABC"))
+        self.assertTrue(self.match("ABC", "ABC"))
+        self.assertFalse(self.match("AB", "ABC"))
+        self.assertTrue(self.match("A*", "ABC"))
+        self.assertTrue(self.match("*C", "ABC"))
+        self.assertFalse(self.match("*B", "ABC"))
+        self.assertTrue(self.match("A?C", "ABC"))
+        self.assertFalse(self.match("A?", "ABC"))
+        self.assertTrue(self.match("Doe^J*", "Doe^John", "PN"))
+        self.assertFalse(self.match("1.2", "102", "UI"))
+        self.assertTrue(self.match("1.2\\1.3", "1.3", "UI"))
+        self.assertFalse(self.match("1.2\\1.3", "1.4", "UI"))
+        self.assertTrue(self.match("20120101-20120131", "20120115", "DA"))
+        self.assertFalse(self.match("20120101-20120131", "20120201", "DA"))
+        self.assertTrue(self.match("20120101-", "20120101", "DA"))
+        self.assertFalse(self.match("20120101-", "20111231", "DA"))
+        self.assertTrue(self.match("-120000", "113000", "TM"))
+        self.assertFalse(self.match("20120101", "", "DA"))
+
+    def test_compile_query(self):
+        """
+        Test that a compiled query gives the same results for many data sets
+        as match_dataset(), including sequences and multi-valued attributes.
+        """
+        query = dicom.dataset.Dataset()
+        query.QueryRetrieveLevel = "IMAGE"
+        query.PatientName = "Doe^*"
+        query.StudyDate = "20120102-"
+        query.ImageType = "DERIVED"
+        query.SOPInstanceUID = ""
+        item = dicom.dataset.Dataset()
+        item.CodeValue = "A?"
+        query.add_new(0x00081032, "SQ", dicom.sequence.Sequence([item])) # Procedure Code Sequence
+        query.add_new(0x00081140, "SQ", dicom.sequence.Sequence()) # Referenced Image Sequence
+        matcher = utils.compile_query(query)
+        self.assertEqual(len(matcher.return_keys()), 6)
+
+        datasets = []
+        for study in range(3):
+            for instance in range(2):
+                ds = make_dataset(study % 2, study, 0, instance, ImageType = ["ORIGINAL", ("PRIMARY", "DERIVED")[instance]])
+                if study != 2:
+                    item = dicom.dataset.Dataset()
+                    item.CodeValue = ("A1", "B1")[study]
+                    ds.add_new(0x00081032, "SQ", dicom.sequence.Sequence([item]))
+                    ds.add_new(0x00081140, "SQ", dicom.sequence.Sequence([dicom.dataset.Dataset()]))
+                datasets.append(ds)
+        matches = []
+        for ds in datasets:
+            is_match, result_ds = matcher.match(ds)
+            expected_match, expected_ds = utils.match_dataset(query, ds)
+            self.assertEqual((is_match, str(result_ds)), (expected_match, str(expected_ds)))
+            if is_match:
+                matches.append(result_ds)
+        self.assertEqual([ds.SOPInstanceUID for ds in matches], ["1.2.3.2.0.1"])
+        self.assertEqual(len(matches[0][0x00081032].value), 0)
+        self.assertEqual(len(matches[0][0x00081140].value), 0)
+
+        query.StudyDate = ""
+        is_match, result_ds = utils.match_dataset(query, datasets[1])
+        self.assertTrue(is_match)
+        self.assertEqual(result_ds[0x00081032].value[0].CodeValue, "A1")
+        self.assertEqual(len(result_ds[0x00081140].value), 1)
+        is_match, result_ds = utils.match_dataset(query, datasets[1], do_updates = False)
+        self.assertEqual(len(result_ds[0x00081140].value), 0)
+
+class UIDTestCase(unittest.TestCase):
+    def test_get_uid(self):
+        """
+        Test that get_uid() finds UIDs by name, and that the constants in
+        uids are the UIDs of their names.
+        """
+        self.assertEqual(utils.get_uid("Verification SOP Class"), "1.2.840.10008.1.1")
+        self.assertRaises(AssertionError, utils.get_uid, "No Such SOP Class")
+        self.assertRaises(AssertionError, utils.get_uid, "Ultrasound Image Storage") # also a retired UID
+        for name in dir(uids):
+            if name.startswith("_"):
+                continue
+            uid = getattr(uids, name)
+            self.assertEqual(utils.get_uid(dicom._UID_dict.UID_dictionary[uid][0]), uid)
+            self.assertEqual(dicom._UID_dict.UID_dictionary[uid][0].replace(" ", "").replace("-", "").replace("/", ""), name)
+
+class DateTimeTestCase(unittest.TestCase):
+    def test_date_time_ordinal(self):
+        """
+        Test that dates, times and date times give ordinals in the order of
+        their values, with offsets taken into account.
+        """
+        ordinal = utils.date_time_ordinal
+        self.assertEqual(ordinal("20120131", "DA"), 20120131)
+        self.assertEqual(ordinal("2012.01.31", "DA"), 20120131)
+        self.assertTrue(ordinal("20111231", "DA") < ordinal("20120101", "DA"))
+        self.assertEqual(ordinal("1230", "TM"), ordinal("123000.000", "TM"))
+        self.assertEqual(ordinal("12:30:00", "TM"), ordinal("123000", "TM"))
+        self.assertEqual(ordinal("000000.5", "TM"), 500000)
+        self.assertTrue(ordinal("235959.999999", "TM") > ordinal("235959.99999", "TM"))
+        self.assertEqual(ordinal("20120101120000+0100", "DT"), ordinal("20120101110000", "DT"))
+        self.assertEqual(ordinal("20120101060000-0500", "DT"), ordinal("201201011100", "DT"))
+        self.assertEqual(ordinal("2012", "DT"), ordinal("20120101000000.000000", "DT"))
+        self.assertTrue(ordinal("20111231235959.999999", "DT") < ordinal("2012", "DT"))
+        for value, vr in [("2012013", "DA"), ("20121301", "DA"), ("", "DA"), ("123", "TM"), ("2400", "TM"),
+                          ("120000.1234567", "TM"), ("201201011", "DT"), ("20120230", "DT"), ("20120101+01", "DT")]:
+            self.assertRaises(ValueError, ordinal, value, vr)
+
+    def test_date_range(self):
+        """
+        Test ranges of dates and date times, including date times with
+        negative offsets.
+        """
+        self.assertEqual(utils.split_range("20120101-0500-20120102-0500", "DT"), ("20120101-0500", "20120102-0500"))
+        self.assertEqual(utils.split_range("-20120102-0500", "DT"), (None, "20120102-0500"))
+        self.assertEqual(utils.split_range("20120101-0500-", "DT"), ("20120101-0500", None))
+        self.assertEqual(utils.split_range("20120101-0500", "DT"), ("20120101-0500", "20120101-0500"))
+        self.assertEqual(utils.split_range("2012-2013", "DT"), ("2012", "2013"))
+        self.assertRaises(ValueError, utils.split_range, "2012-2013-2014", "DT")
+
+        date_range = utils.DateRange("20120101-20120131", "DA")
+        self.assertTrue("20120101" in date_range)
+        self.assertTrue("20120131" in date_range)
+        self.assertFalse("20120201" in date_range)
+        self.assertFalse("garbage" in date_range)
+        date_range = utils.DateRange("20120101000000-0500-", "DT")
+        self.assertTrue("20120101050000+0000" in date_range)
+        self.assertFalse("20120101040000+0000" in date_range)
+        self.assertTrue(utils.attribute_match("20120101000000-0500-20120101010000-0500", "20120101053000+0000", "DT"))
+        self.assertTrue(utils.attribute_match("20120101000000-0500-20120101010000-0500", "20120101003000-0500", "DT"))
+        self.assertFalse(utils.attribute_match("20120101000000-0500-20120101010000-0500", "20120101003000+0000", "DT"))
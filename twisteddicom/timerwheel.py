@@ -0,0 +1,134 @@
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import math
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from twisted.python import log
+
+class Timer(object):
+    """A call scheduled with TimerWheel.callLater(). Can be cancelled like
+    a twisted DelayedCall."""
+    __slots__ = ['wheel', 'tick', 'seq', 'func', 'args', 'kw', 'called', 'cancelled']
+
+    def __init__(self, wheel, tick, seq, func, args, kw):
+        self.wheel = wheel
+        self.tick = tick
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.called = False
+        self.cancelled = False
+
+    def cancel(self):
+        if self.cancelled:
+            raise AlreadyCancelled()
+        if self.called:
+            raise AlreadyCalled()
+        self.cancelled = True
+        self.wheel._remove(self)
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def getTime(self):
+        return self.tick * self.wheel.resolution
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel for many coarse timeouts, such as ARTIM and DIMSE
+    operation timeouts.
+
+    Timers are put in one of size slots by the tick at which they expire,
+    so starting and cancelling a timer is O(1) and does not touch the
+    reactor. The wheel itself keeps at most one reactor.callLater pending,
+    which wakes it once per tick while there are timers. Timers fire at
+    most resolution seconds late, and never early.
+    """
+    def __init__(self, resolution = 0.25, size = 1024, reactor = None):
+        if reactor == None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.resolution = resolution
+        self.size = size
+        self._slots = [set() for i in range(size)]
+        self._count = 0
+        self._seq = 0
+        self._last_tick = int(reactor.seconds() / resolution)
+        self._call = None
+
+    def __len__(self):
+        """Number of pending timers."""
+        return self._count
+
+    def callLater(self, delay, func, *args, **kw):
+        """Call func(*args, **kw) after delay seconds, rounded up to the
+        next tick. Returns a Timer."""
+        tick = int(math.ceil((self.reactor.seconds() + delay) / self.resolution))
+        self._seq += 1
+        timer = Timer(self, max(tick, self._last_tick + 1), self._seq, func, args, kw)
+        self._slots[timer.tick % self.size].add(timer)
+        self._count += 1
+        if self._call == None:
+            self._call = self.reactor.callLater(max(0, (self._last_tick + 1) * self.resolution - self.reactor.seconds()), 
+                                                self._advance)
+        return timer
+
+    def _remove(self, timer):
+        self._slots[timer.tick % self.size].discard(timer)
+        self._count -= 1
+        if self._count == 0 and self._call != None:
+            self._call.cancel()
+            self._call = None
+
+    def _advance(self):
+        self._call = None
+        now = int(self.reactor.seconds() / self.resolution)
+        # After a long stall, every slot only has to be visited once.
+        first = max(self._last_tick + 1, now - self.size + 1)
+        for tick in xrange(first, now + 1):
+            self._last_tick = tick
+            slot = self._slots[tick % self.size]
+            due = sorted((timer for timer in slot if timer.tick <= now), key = lambda timer: (timer.tick, timer.seq))
+            for timer in due:
+                if timer.cancelled: # by an earlier timer in this slot
+                    continue
+                slot.discard(timer)
+                self._count -= 1
+                timer.called = True
+                try:
+                    timer.func(*timer.args, **timer.kw)
+                except:
+                    log.err()
+        self._last_tick = now
+        if self._count > 0 and self._call == None:
+            self._call = self.reactor.callLater(max(0, (now + 1) * self.resolution - self.reactor.seconds()), 
+                                                self._advance)
+
+_default_wheel = None
+
+def default_wheel():
+    """Return the process-wide TimerWheel, driven by the global reactor."""
+    global _default_wheel
+    if _default_wheel == None:
+        _default_wheel = TimerWheel()
+    return _default_wheel
@@ -0,0 +1,54 @@
+# Copyright (c) 2012 Bo Eric Rickard Holmberg <rickard@holmberg.info>
+
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Frequently used UIDs, see PS 3.6 Annex A.
+
+These are the values utils.get_uid() returns for the names in the
+comments, written out so that using them costs no lookup.
+"""
+
+# Application context
+DICOMApplicationContextName = "1.2.840.10008.3.1.1.1" # DICOM Application Context Name
+
+# Transfer syntaxes
+ImplicitVRLittleEndian = "1.2.840.10008.1.2" # Implicit VR Little Endian
+ExplicitVRLittleEndian = "1.2.840.10008.1.2.1" # Explicit VR Little Endian
+DeflatedExplicitVRLittleEndian = "1.2.840.10008.1.2.1.99" # Deflated Explicit VR Little Endian
+ExplicitVRBigEndian = "1.2.840.10008.1.2.2" # Explicit VR Big Endian
+
+# Verification and query/retrieve SOP classes
+VerificationSOPClass = "1.2.840.10008.1.1" # Verification SOP Class
+PatientRootQueryRetrieveInformationModelFIND = "1.2.840.10008.5.1.4.1.2.1.1" # Patient Root Query/Retrieve Information Model - FIND
+PatientRootQueryRetrieveInformationModelMOVE = "1.2.840.10008.5.1.4.1.2.1.2" # Patient Root Query/Retrieve Information Model - MOVE
+PatientRootQueryRetrieveInformationModelGET = "1.2.840.10008.5.1.4.1.2.1.3" # Patient Root Query/Retrieve Information Model - GET
+StudyRootQueryRetrieveInformationModelFIND = "1.2.840.10008.5.1.4.1.2.2.1" # Study Root Query/Retrieve Information Model - FIND
+StudyRootQueryRetrieveInformationModelMOVE = "1.2.840.10008.5.1.4.1.2.2.2" # Study Root Query/Retrieve Information Model - MOVE
+StudyRootQueryRetrieveInformationModelGET = "1.2.840.10008.5.1.4.1.2.2.3" # Study Root Query/Retrieve Information Model - GET
+PatientStudyOnlyQueryRetrieveInformationModelFIND = "1.2.840.10008.5.1.4.1.2.3.1" # Patient/Study Only Query/Retrieve Information Model - FIND
+ModalityWorklistInformationModelFIND = "1.2.840.10008.5.1.4.31" # Modality Worklist Information Model - FIND
+
+# Storage SOP classes
+CTImageStorage = "1.2.840.10008.5.1.4.1.1.2" # CT Image Storage
+MRImageStorage = "1.2.840.10008.5.1.4.1.1.4" # MR Image Storage
+SecondaryCaptureImageStorage = "1.2.840.10008.5.1.4.1.1.7" # Secondary Capture Image Storage
+RTPlanStorage = "1.2.840.10008.5.1.4.1.1.481.5" # RT Plan Storage
@@ -20,15 +20,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from twisted.internet import reactor
 from twisted.python import log
 from twisted.internet.error import AlreadyCalled, AlreadyCancelled
-from utils import get_uid
+import uids
 
 do_log = False
 
 from functools import wraps
-from twisteddicom import __version__, pdu, sockhandler
+from twisteddicom import __version__, pdu, sockhandler, timerwheel
 
 def debugrecv(f, msg=None):
     @wraps(f)
@@ -58,14 +57,17 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
         self.state = 1
         self.ARTIM_time = 10.0
         self.ARTIM = None
+        # Shared by all associations, so that starting and stopping ARTIM
+        # does not schedule a reactor call per association.
+        self.timer_wheel = timerwheel.default_wheel()
         if supported_abstract_syntaxes == None:
            self.supported_abstract_syntaxes = []
         else:
            self.supported_abstract_syntaxes = supported_abstract_syntaxes
         if supported_transfer_syntaxes == None:
-            self.supported_transfer_syntaxes = [get_uid("Implicit VR Little Endian"),
-                                                get_uid("Explicit VR Little Endian"),
-                                                get_uid("Explicit VR Big Endian")]
+            self.supported_transfer_syntaxes = [uids.ImplicitVRLittleEndian,
+                                                uids.ExplicitVRLittleEndian,
+                                                uids.ExplicitVRBigEndian]
         else:
             self.supported_transfer_syntaxes = supported_transfer_syntaxes
 
@@ -110,7 +112,7 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
 
     def start_ARTIM(self):
         self.stop_ARTIM()
-        self.ARTIM = reactor.callLater(self.ARTIM_time, self.ARTIM_expired)
+        self.ARTIM = self.timer_wheel.callLater(self.ARTIM_time, self.ARTIM_expired)
 
     def stop_ARTIM(self):
         if self.ARTIM != None:
@@ -122,6 +124,11 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
                 pass
             self.ARTIM = None
 
+    def close_transport(self):
+        """Close the transport connection, once the data written to it
+        has been sent."""
+        self.transport.loseConnection()
+
     @debugrecv
     def A_ASSOCIATE_request_received(self):
         if self.state == 1:
@@ -236,6 +243,17 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
             self.setstate(13)
             self.do_AA_8()
 
+    @debugrecv
+    def P_DATA_TF_fragment_received(self, data):
+        """Streaming counterpart of P_DATA_TF_PDU_received, see
+        sockhandler.PDUFramer. The state machine is consulted on the first
+        fragment of each PDU, fragments of a PDU that is not acceptable in
+        the current state are dropped."""
+        if self.state == 6 or self.state == 7:
+            self.P_DATA_fragment_indicated(data)
+        elif data.pdu_start:
+            self.P_DATA_TF_PDU_received(None)
+
     @debugrecv
     def A_RELEASE_request_received(self):
         if self.state == 6:
@@ -379,7 +397,7 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
     def do_AE_4(self):
         """Issue A-ASSOCIATE confirmation (reject) primitive and close transport connection."""
         self.A_ASSOCIATE_confirmation_reject_indicated()
-        self.transport.loseConnection()
+        self.close_transport()
 
     @debugaction
     def do_AE_5(self):
@@ -432,7 +450,7 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
         """Send P-DATA-TF PDU."""
         data = pdu.P_DATA_TF(data_values = data_values)
         if do_log: log.msg("Sending %s." % (data,))
-        self.transport.write(data.pack())
+        self.transport.writeSequence(data.pack_sequence())
 
     @debugaction
     def do_DT_2(self, data):
@@ -455,7 +473,7 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
     def do_AR_3(self):
         """Issue A-RELEASE confirmation primitive, and close transport connection."""
         self.A_RELEASE_confirmation_indicated()
-        self.transport.loseConnection()
+        self.close_transport()
 
     @debugaction
     def do_AR_4(self):
@@ -480,7 +498,7 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
         """Issue P-DATA-TF PDU."""
         data = pdu.P_DATA_TF(data_values = data_values)
         if do_log: log.msg("Sending %s." % (data,))
-        self.transport.write(data.pack())
+        self.transport.writeSequence(data.pack_sequence())
 
     @debugaction
     def do_AR_8(self):
@@ -511,7 +529,7 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
     def do_AA_2(self):
         """Stop ARTIM timer if running. Close transport connection."""
         self.stop_ARTIM()
-        self.transport.loseConnection()
+        self.close_transport()
         
     @debugaction
     def do_AA_3(self, reason_diag, source):
@@ -524,7 +542,7 @@ class DICOMUpperLayerServiceProvider(sockhandler.DICOMUpperLayerServiceProtocol)
             data = pdu.A_ABORT(reason_diag = reason_diag, source = source)
             if do_log: log.msg("Sending %s." % (data,))
             self.transport.write(data.pack())
-        self.transport.loseConnection()
+        self.close_transport()
         
     @debugaction
     def do_AA_4(self, reason_diag):
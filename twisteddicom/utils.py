@@ -24,14 +24,30 @@
 import dicom
 import datetime
 import re
+import shutil
+import struct
+import uids
 from twisted.python import log
 
 do_log = False
 
+_uids_by_name = None
+
 def get_uid(name):
-    candidates = [k for k,v in dicom._UID_dict.UID_dictionary.iteritems() if v[0] == name]
-    assert len(candidates) == 1
-    return candidates[0]
+    """Return the UID with the name in the pydicom UID dictionary.
+
+    The name to UID index is built on the first call. The uids module has
+    the UIDs that are used often."""
+    global _uids_by_name
+    if _uids_by_name == None:
+        uids_by_name = {}
+        for uid, entry in dicom._UID_dict.UID_dictionary.iteritems():
+            # Names that are not unique map to None
+            uids_by_name[entry[0]] = None if entry[0] in uids_by_name else uid
+        _uids_by_name = uids_by_name
+    uid = _uids_by_name.get(name)
+    assert uid != None, "No unique UID named \"%s\"" % (name,)
+    return uid
 
 def generate_uid(_uuid = None):
     """Returns a new DICOM UID based on a UUID, as specified in CP1156 (Final)."""
@@ -83,70 +99,248 @@ def parse_da_dt_tm(s, vr):
                                      int(s[8:10]), int(s[10:12]), int(s[12:14]), int(s[15:i]), 
                                      UTCOffsetTimeZone(s[i:]))
 
+def _value_text(value):
+    if isinstance(value, list):
+        return "\\".join(str(x) for x in value)
+    return str(value)
+
+def _wildcard_regex(pattern):
+    """Regular expression for a pattern with * and ? wildcards, see PS 3.4 C.2.2.2.4."""
+    regex = []
+    for c in pattern:
+        if c == "*":
+            regex.append(".*")
+        elif c == "?":
+            regex.append(".")
+        else:
+            regex.append(re.escape(c))
+    return re.compile("".join(regex) + r"\Z", re.DOTALL)
+
+# A DT value, see PS 3.5 6.2: YYYY[MM[DD[HH[MM[SS[.F{1-6}]]]]]][&ZZXX]
+_dt = r"\d{4}(?:\d{2}){0,5}(?:\.\d{1,6})?(?:[+-](?:0\d|1[0-4])[0-5]\d)?"
+_dt_value = re.compile(r"(%s)\Z" % (_dt,))
+_dt_range = re.compile(r"(%s)?-(%s)?\Z" % (_dt, _dt))
+
+def _fraction(s):
+    """Microseconds of the fractional second s, 1 to 6 digits."""
+    if not 1 <= len(s) <= 6 or not s.isdigit():
+        raise ValueError("\"%s\" is not a valid fraction of a second" % (s,))
+    return int(s) * 10 ** (6 - len(s))
+
+def _split_fraction(s):
+    i = s.find(".")
+    if i == -1:
+        return s, 0
+    return s[:i], _fraction(s[i + 1:])
+
+def date_time_ordinal(s, vr):
+    """Return an integer with the same order as the DA, TM or DT value s.
+
+    Dates give YYYYMMDD, times the microseconds since midnight and date
+    times the microseconds since 0001-01-01, in UTC when s has an offset.
+    Components left out of times and date times count as zero (or the
+    first month or day). Raises ValueError for invalid values."""
+    if s[-1:] == " ":
+        s = s.strip()
+    if vr == "DA":
+        if len(s) == 10 and s[4] == "." and s[7] == ".": # ACR-NEMA YYYY.MM.DD
+            s = s[:4] + s[5:7] + s[8:]
+        if len(s) != 8 or not s.isdigit() or not "01" <= s[4:6] <= "12" or not "01" <= s[6:8] <= "31":
+            raise ValueError("\"%s\" is not a valid DICOM date" % (s,))
+        return int(s)
+    elif vr == "TM":
+        if s.find(":") != -1: # ACR-NEMA HH:MM:SS
+            s = s.replace(":", "")
+        s, fraction = _split_fraction(s)
+        if len(s) not in (2, 4, 6) or not s.isdigit():
+            raise ValueError("\"%s\" is not a valid DICOM time" % (s,))
+        hours, seconds = divmod(int(s) * 100 ** (3 - len(s) // 2), 10000)
+        minutes, seconds = divmod(seconds, 100)
+        if hours > 23 or minutes > 59 or seconds > 60:
+            raise ValueError("\"%s\" is not a valid DICOM time" % (s,))
+        return ((hours * 60 + minutes) * 60 + seconds) * 1000000 + fraction
+    elif vr == "DT":
+        offset = 0
+        if len(s) > 5 and (s[-5] == "+" or s[-5] == "-"):
+            offset = int(s[-4:-2]) * 60 + int(s[-2:])
+            if s[-5] == "-":
+                offset = -offset
+            s = s[:-5]
+        s, fraction = _split_fraction(s)
+        if len(s) not in (4, 6, 8, 10, 12, 14) or not s.isdigit():
+            raise ValueError("\"%s\" is not a valid DICOM date time" % (s,))
+        if len(s) < 8:
+            s += "0101"[len(s) - 4:]
+        date, seconds = divmod(int(s) * 100 ** (7 - len(s) // 2), 1000000)
+        year, day = divmod(date, 10000)
+        month, day = divmod(day, 100)
+        days = datetime.date(year, month, day).toordinal()
+        hours, seconds = divmod(seconds, 10000)
+        minutes, seconds = divmod(seconds, 100)
+        if hours > 23 or minutes > 59 or seconds > 60:
+            raise ValueError("\"%s\" is not a valid DICOM date time" % (s,))
+        return (((days * 24 + hours) * 60 + minutes - offset) * 60 + seconds) * 1000000 + fraction
+    raise ValueError("%s is not a date or time VR" % (vr,))
+
+def split_range(pattern, vr):
+    """Split a DA, TM or DT pattern to (min, max), either of which is None
+    for open ranges. A single value gives the same min and max. See PS 3.4
+    C.2.2.2.5."""
+    if vr == "DT":
+        # Offsets may be negative, so a - does not always separate a range
+        if _dt_value.match(pattern):
+            return pattern, pattern
+        match = _dt_range.match(pattern)
+        if match == None:
+            raise ValueError("\"%s\" is not a valid DICOM date time range" % (pattern,))
+        return match.group(1), match.group(2)
+    if pattern.startswith("-"):
+        return None, pattern[1:]
+    elif pattern.endswith("-"):
+        return pattern[:-1], None
+    elif pattern.find("-") != -1:
+        minvalue, maxvalue = pattern.split("-")
+        return minvalue, maxvalue
+    else:
+        return pattern, pattern
+
+class DateRange(object):
+    """
+    A DA, TM or DT value or range of a query, see PS 3.4 C.2.2.2.5.
+
+    The pattern is parsed once: min and max are ordinals as returned by
+    date_time_ordinal(), or None for open ends. "value in date_range" then
+    only parses value.
+    """
+    def __init__(self, pattern, vr):
+        self.vr = vr
+        minvalue, maxvalue = split_range(pattern, vr)
+        self.min = None if minvalue == None else date_time_ordinal(minvalue, vr)
+        self.max = None if maxvalue == None else date_time_ordinal(maxvalue, vr)
+
+    def __contains__(self, value):
+        try:
+            value = date_time_ordinal(str(value), self.vr)
+        except ValueError:
+            return False
+        return (self.min == None or self.min <= value) and (self.max == None or value <= self.max)
+
+def compile_attribute(pattern, vr):
+    """Return a function telling if a value matches pattern, or None if
+    every value does. See PS 3.4 C.2.2.2."""
+    if pattern == None:
+        return None
+    pattern = _value_text(pattern)
+    if pattern == "*" or pattern == "":
+        return None
+    if (vr == "DT" or vr == "TM" or vr == "DA"):
+        return DateRange(pattern, vr).__contains__
+    if vr == "UI" and pattern.find("\\") != -1:
+        # List of UID matching
+        uids = frozenset(pattern.split("\\"))
+        return lambda value: value in uids
+    if pattern.find("*") != -1 or pattern.find("?") != -1:
+        regex = _wildcard_regex(pattern)
+        return lambda value: regex.match(str(value)) != None
+    # Single value matching
+    return lambda value: str(value) == pattern
+
 def attribute_match(pattern, value, vr):
     """See PS 3.4 C.2.2.2."""
     if do_log: log.msg("attribute_match(%s, %s, %s)" % (pattern, value, vr))
-    if pattern == "*" or pattern == "":
-        return True
-    if (vr == "DT" or vr == "TM" or vr == "DA"):
-        value = parse_da_dt_tm(value, vr)
-        if pattern.startswith("-"):
-            maxvalue = parse_da_dt_tm(pattern[1:], vr)
-            return value <= maxvalue
-        elif pattern.endswith("-"):
-            minvalue = parse_da_dt_tm(pattern[1:], vr)
-            return value >= minvalue
-        elif pattern.find("-") != -1:
-            # TODO: This is broken for DT with negative time zone offsets. FIXME!
-            minvalue, maxvalue = [parse_da_dt_tm(x, vr) for x in pattern.split("-")]
-            return minvalue <= value <= maxvalue
-        else:
-            pattern = parse_da_dt_tm(pattern, vr)
-            return value == pattern
-    if re.match(str(pattern).replace("*", ".*"), str(value)):
-        return True
-    return False
-
-def match_dataset(query, ds):
-    result_ds = dicom.dataset.Dataset()
-    for key in query.iterkeys():
-        if key == 0x00080052: # Query/Retrieve Level
-            continue 
-        if key & 0x0000ffff == 0: # Group Length
-            continue
-        if key == 0x00080005: # Specific Character set
-            continue
-        if query[key].VR == "SQ":
-            if do_updates and len(query[key].value) == 0:
-                if key in ds:
-                    result_ds[key] = ds[key]
-                else:
-                    result_ds[key] = query[key]
+    match = compile_attribute(pattern, vr)
+    return match == None or match(value)
+
+class QueryMatcher(object):
+    """
+    A C-FIND identifier compiled by compile_query().
+
+    The keys of the identifier are interpreted once: date and time ranges
+    are parsed, wildcards are compiled to regular expressions and universal
+    matches are not evaluated at all. match() then only compares values,
+    which pays off when the same query is matched against many data sets.
+    """
+    def __init__(self, query, do_updates = True):
+        self.do_updates = do_updates
+        # (key, query element, value matcher or None, sub query matcher)
+        self.keys = []
+        for key in query.iterkeys():
+            if key == 0x00080052: # Query/Retrieve Level
+                continue 
+            if key & 0x0000ffff == 0: # Group Length
                 continue
-            sub_results = []
-            for item in ds[key].value:
-                if key & 0x0000ffff == 0: # Group Length
-                    continue
-                is_match, sub_result_ds = match_dataset(query[key].value[0], item, do_updates = do_updates)
-                if not is_match: 
+            if key == 0x00080005: # Specific Character set
+                continue
+            elem = query[key]
+            if elem.VR == "SQ":
+                sub_matcher = None
+                if len(elem.value) != 0:
+                    sub_matcher = QueryMatcher(elem.value[0], do_updates = do_updates)
+                self.keys.append((key, elem, None, sub_matcher))
+            else:
+                self.keys.append((key, elem, compile_attribute(elem.value, elem.VR), None))
+
+    def return_keys(self):
+        """The tags of the attributes returned for a match."""
+        return [key for key, elem, value_match, sub_matcher in self.keys]
+
+    def match(self, ds):
+        """Return (True, result data set) if ds matches, else (False, None)."""
+        result_ds = dicom.dataset.Dataset()
+        for key, elem, value_match, sub_matcher in self.keys:
+            if elem.VR == "SQ":
+                if sub_matcher == None:
+                    if self.do_updates and key in ds:
+                        result_ds[key] = ds[key]
+                    else:
+                        result_ds[key] = elem
                     continue
-                sub_results.append(sub_result_ds)
-            if len(sub_results) == 0 and len(ds[key].value) != 0:
-                if do_log: log.msg("failed match due to key %s (no matches in sequence)" % (key,))
+                sub_results = []
+                items = ds[key].value if key in ds else []
+                for item in items:
+                    is_match, sub_result_ds = sub_matcher.match(item)
+                    if not is_match: 
+                        continue
+                    sub_results.append(sub_result_ds)
+                if len(sub_results) == 0 and len(items) != 0:
+                    if do_log: log.msg("failed match due to key %s (no matches in sequence)" % (key,))
+                    return False, None
+                result_ds[key] = dicom.dataelem.DataElement(key, elem.VR, dicom.sequence.Sequence(sub_results))
+            elif key not in ds:
+                if elem.value == None or elem.value == '': # universal matcher
+                    result_ds[key] = elem
+                else:
+                    if do_log: log.msg("failed match due to key %s (not present)" % (key,))
+                    return False, None
+            elif value_match != None and not self._match_value(value_match, ds[key].value):
+                if do_log: log.msg("failed match due to key %s (%s != %s)" % (key, elem.value, ds[key].value))
                 return False, None
-            result_ds[key] = dicom.dataelem.DataElement(key, query[key].VR, dicom.sequence.Sequence(sub_results))
-        elif key not in ds:
-            if query[key].value == None or query[key].value == '': # universal matcher
-                result_ds[key] = query[key]
             else:
-                if do_log: log.msg("failed match due to key %s (not present)" % (key,))
-                return False, None
-        elif not attribute_match(query[key].value, ds[key].value, query[key].VR):
-            if do_log: log.msg("failed match due to key %s (%s != %s)" % (key, query[key].value, ds[key].value))
-            return False, None
-        else:
-            result_ds[key] = ds[key]
-    return True, result_ds
+                result_ds[key] = ds[key]
+        return True, result_ds
+
+    def _match_value(self, value_match, value):
+        if isinstance(value, list):
+            # Any value of a multi-valued attribute may match
+            for x in value:
+                if value_match(x):
+                    return True
+            return False
+        return value_match(value)
+
+def compile_query(query, do_updates = True):
+    """Compile the C-FIND identifier query to a QueryMatcher.
+
+    With do_updates, zero length sequences in query return the sequence of
+    the matching data set, otherwise they are returned empty."""
+    return QueryMatcher(query, do_updates = do_updates)
+
+def match_dataset(query, ds, do_updates = True):
+    """Match ds against the C-FIND identifier query, see PS 3.4 C.2.2.
+
+    Returns (True, result data set) or (False, None). Use compile_query()
+    when matching the same query against many data sets."""
+    return compile_query(query, do_updates = do_updates).match(ds)
 
 def get_level_identifier(ds, level):
     if level == "IMAGE":
@@ -160,18 +354,76 @@ def get_level_identifier(ds, level):
     else:
         raise ValueError("Unknown query/retrieve level \"%s\"!" % level)
 
+implementation_class_uid = '2.25.4282708245307149051252828097685724107'
+
 def write_ds(ds, fn, default_sopclass=None):
     ds.file_meta = dicom.dataset.Dataset()
     ds.file_meta.TransferSyntaxUID = dicom.UID.ImplicitVRLittleEndian
     if default_sopclass == None:
-        default_sopclass = get_uid("Study Root Query/Retrieve Information Model - FIND")
+        default_sopclass = uids.StudyRootQueryRetrieveInformationModelFIND
     ds.file_meta.MediaStorageSOPClassUID = getattr(ds, 'SOPClassUID', default_sopclass)
     ds.file_meta.MediaStorageSOPInstanceUID = getattr(ds, 'SOPInstanceUID', generate_uid())
     ds.is_little_endian = True
     ds.is_implicit_VR = True
-    ds.file_meta.ImplementationClassUID = '2.25.4282708245307149051252828097685724107'
+    ds.file_meta.ImplementationClassUID = implementation_class_uid
     dicom.write_file(fn, ds, WriteLikeOriginal=False)
 
+def write_part10(fn, data, sop_class_uid, sop_instance_uid, transfer_syntax = None):
+    """Write an already encoded data set as a DICOM file, see DICOM PS3.10-2011 7.1.
+
+    data is a string or a dimsemessages.DatasetSink holding the data set
+    encoded in transfer_syntax (by default the transfer syntax of the sink,
+    a string needs it given). The preamble and File Meta Information are
+    written in front of the data set, which is copied to the file as it is."""
+    if transfer_syntax == None:
+        if isinstance(data, basestring):
+            raise ValueError("transfer_syntax is required for a data set given as a string")
+        transfer_syntax = data.transfer_syntax
+    meta = dicom.dataset.Dataset()
+    meta.add_new(0x00020001, 'OB', '\x00\x01') # File Meta Information Version
+    meta.MediaStorageSOPClassUID = sop_class_uid
+    meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    meta.TransferSyntaxUID = transfer_syntax
+    meta.ImplementationClassUID = implementation_class_uid
+    f = open(fn, 'wb')
+    try:
+        fp = dicom.filebase.DicomFileLike(f)
+        fp.is_implicit_VR = False
+        fp.is_little_endian = True
+        fp.write('\x00' * 128 + 'DICM')
+        group_length_tell = fp.tell()
+        fp.write(struct.pack("<HH2sHI", 0x0002, 0x0000, 'UL', 4, 0))
+        dicom.filewriter.write_dataset(fp, meta)
+        group_length = fp.tell() - group_length_tell - 12
+        fp.seek(group_length_tell)
+        fp.write(struct.pack("<HH2sHI", 0x0002, 0x0000, 'UL', 4, group_length))
+        fp.seek(0, 2)
+        if isinstance(data, basestring):
+            f.write(data)
+        else:
+            shutil.copyfileobj(data.open(), f)
+    finally:
+        f.close()
+
+# Bytes read from a file at a time by read_header()
+read_header_buffer_size = 64 * 1024
+
+def read_header(fn):
+    """Read the DICOM file fn up to, but not including, the Pixel Data.
+
+    This is all that is needed to match queries, and for large images and
+    multi-frame objects only the first blocks of the file are read. The
+    file is read through a plain buffer rather than mapped into memory, as
+    a mapped file that is truncated while it is parsed kills the process
+    with SIGBUS."""
+    f = open(fn, 'rb', read_header_buffer_size)
+    try:
+        ds = dicom.read_file(f, stop_before_pixels = True)
+    finally:
+        f.close()
+    ds.filename = fn
+    return ds
+
 def update_dataset(ds, changes):
     for key in changes.iterkeys():
         if key & 0x0000ffff == 0: # Group Length